@@ -0,0 +1,304 @@
+''' run the core components as tasks of a single asyncio loop '''
+import asyncio
+import logging
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from queue import Empty
+
+import metrics
+from queues import INBOUND_MSG_QUEUE, OUTBOUND_MSG_QUEUE, make_tx_item, unbatch
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class _LoopQueue():
+    ''' put() from any thread into an asyncio.Queue '''
+
+    def __init__(self, runtime, async_q):
+        self._runtime = runtime
+        self._async_q = async_q
+
+    def put(self, item):
+        self._runtime.call_in_loop(self._async_q.put_nowait, item)
+
+    def qsize(self):
+        return self._async_q.qsize()
+
+
+class _LoopTxQ(_LoopQueue):
+    ''' TxMessageQ look alike, the Bot calls go straight to the runtime sender '''
+
+    def __getattr__(self, attr):
+        return lambda *args, **kwargs: self.put_func_call(attr, *args, **kwargs)
+
+    def put_func_call(self, func_name, *args, **kwargs):
+        self.put(make_tx_item(func_name, args, kwargs))
+
+
+class AsyncRuntime():
+    '''
+        Alternative to the thread based runtime.
+        Router, InstanceManager jobs, RoutingTable updates, MasterInstance and
+        the outbound sender run as tasks of one asyncio loop, connected by asyncio queues.
+        They run the very same per item logic as their threads
+        (Router.route_batch, InstanceManager.handle_job, MasterInstance.handle_message,
+        OutboundScheduler + TelegramAbstractionLayer.send_item).
+        A task which fails is logged and started again, the others keep running.
+
+        Queues fed by other processes (INBOUND_MSG_QUEUE, OUTBOUND_MSG_QUEUE, ...)
+        are bridged into the loop by a blocking reader thread each, no polling.
+        Blocking work (Bot calls, process creation) runs in executors.
+        stop() cancels the tasks, shutdown doesn't wait for any timeout.
+
+        The TelegramAbstractionLayer must be started with sender=False and the
+        Router must not be sharded, the instance manager is started by run().
+    '''
+
+    # Max items moved into the loop per wake up of a bridge thread
+    BRIDGE_BATCH = 64
+
+    # Seconds before a failed task is started again
+    RESTART_DELAY = 1
+
+    def __init__(self, tal, instance_manager, router, sender_workers=4):
+        if router.shard_depths():
+            raise ValueError('AsyncRuntime needs a Router without shards')
+
+        self.tal = tal
+        self.IM = instance_manager
+        self.router = router
+
+        self._sender_pool = ThreadPoolExecutor(max_workers=sender_workers,
+                                               thread_name_prefix='async_sender')
+        self._loop = None
+        self._loop_thread = None
+        self._main_task = None
+        self._bridges = []
+        self._stopping = False
+        self._started = threading.Event()
+
+    def call_in_loop(self, func, *args):
+        ''' call func in the loop, right away if already in the loop thread '''
+        if threading.get_ident() == self._loop_thread:
+            func(*args)
+        else:
+            self._loop.call_soon_threadsafe(func, *args)
+
+    def run(self):
+        ''' run until stop() is called, blocking '''
+        try:
+            asyncio.run(self._main())
+        except asyncio.CancelledError:
+            pass
+        finally:
+            # Even if the start failed, stop() must not wait for it
+            self._started.set()
+
+    def stop(self):
+        ''' can be called from any thread, once run() was called '''
+        self._started.wait()
+        if self._main_task is None:
+            return
+        try:
+            self._loop.call_soon_threadsafe(self._main_task.cancel)
+        except RuntimeError:
+            # The loop is already closed, run() returned
+            pass
+
+    def _bridge(self, mp_q):
+        ''' asyncio.Queue fed by a thread blocking on a multiprocessing queue '''
+        async_q = asyncio.Queue()
+
+        def pump():
+            while True:
+                items = [mp_q.get()]
+                if self._stopping:
+                    break
+                while len(items) < self.BRIDGE_BATCH:
+                    try:
+                        items.append(mp_q.get_nowait())
+                    except Empty:
+                        break
+                try:
+                    self._loop.call_soon_threadsafe(self._feed, async_q, items)
+                except RuntimeError:
+                    # Loop already closed
+                    break
+
+        bridge = threading.Thread(target=pump, daemon=True,
+                                  name='async_bridge_{}'.format(len(self._bridges)))
+        bridge.start()
+        self._bridges.append((bridge, mp_q))
+        return async_q
+
+    @staticmethod
+    def _feed(async_q, items):
+        for item in items:
+            # None items are only meant to wake up readers
+            if item is not None:
+                async_q.put_nowait(item)
+
+    async def _main(self):
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._main_task = asyncio.current_task()
+
+        scheduler = self.tal.scheduler
+
+        inbound_q = self._bridge(INBOUND_MSG_QUEUE)
+        outbound_q = self._bridge(OUTBOUND_MSG_QUEUE)
+        jobs_q = self._bridge(self.IM.jobs_q)
+        routing_q = self._bridge(self.IM.routing.updates_q)
+
+        # The master shards run in the loop: their q and the output q of their
+        # sessions are asyncio queues
+        masters = []
+        for master in self.IM.get_master_instances():
+            master_q = asyncio.Queue()
+            master.input_msg_q = _LoopQueue(self, master_q)
+            master.outbound_msq_q = _LoopTxQ(self, outbound_q)
+            masters.append((master, master_q))
+            master.on_start()
+
+        self.IM.start_processes(master=False)
+
+        tasks = [
+            self._supervised('router', lambda: self._router_task(inbound_q)),
+            self._supervised('retries', self._retries_task),
+            self._supervised('jobs', lambda: self._jobs_task(jobs_q)),
+            self._supervised('routing', lambda: self._routing_task(routing_q)),
+            self._supervised('outbound', lambda: self._outbound_task(scheduler, outbound_q)),
+            self._supervised('sender', lambda: self._sender_task(scheduler)),
+        ]
+        if self.IM.idle_check_interval is not None:
+            tasks.append(self._supervised('hibernation', self._hibernation_task))
+        tasks += [self._supervised('master_{}'.format(idx), lambda m=master, q=master_q: self._master_task(m, q))
+                  for (idx, (master, master_q)) in enumerate(masters)]
+        self._started.set()
+        logger.info('Started {}'.format(type(self).__name__))
+
+        try:
+            await asyncio.gather(*tasks, return_exceptions=True)
+        finally:
+            for task in tasks:
+                task.cancel()
+            self._shutdown()
+
+    def _shutdown(self):
+        logger.info('Stopping {}'.format(type(self).__name__))
+        self._stopping = True
+        for (_, mp_q) in self._bridges:
+            mp_q.put(None)
+        for (bridge, _) in self._bridges:
+            bridge.join(2)
+
+        self.IM.stop_instances(master=False)
+        for master in self.IM.get_master_instances():
+            master.on_stop()
+        self._sender_pool.shutdown(wait=False)
+
+    def _supervised(self, name, make_coro):
+        ''' task running the coroutine make_coro() returns, started again if it fails '''
+        async def supervise():
+            while True:
+                try:
+                    await make_coro()
+                    return
+                except Exception as ex:
+                    logger.exception('Task {} of {} failed, restarting it: {}'.format(
+                        name, type(self).__name__, ex))
+                await asyncio.sleep(self.RESTART_DELAY)
+
+        return self._loop.create_task(supervise(), name=name)
+
+    def _event_setter(self, event):
+        ''' listener callback setting an asyncio.Event from any thread '''
+        return lambda: self.call_in_loop(event.set)
+
+    async def _router_task(self, inbound_q):
+        # Route whatever arrived together as one batch
+        while True:
+            batch = unbatch(await inbound_q.get())
+            while not inbound_q.empty():
+                batch.extend(unbatch(inbound_q.get_nowait()))
+            self.router.route_batch(batch)
+
+    async def _retries_task(self):
+        retries = self.router.retries
+        wake_up = asyncio.Event()
+        retries.listener = self._event_setter(wake_up)
+
+        while True:
+            wake_up.clear()
+            due, wait = retries.pop_due()
+            if due:
+                self.router.route_batch(due)
+                continue
+            try:
+                await asyncio.wait_for(wake_up.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _jobs_task(self, jobs_q):
+        while True:
+            item = await jobs_q.get()
+            # May start processes, keep it out of the loop
+            await self._loop.run_in_executor(None, self.IM.handle_job, item)
+
+    async def _hibernation_task(self):
+        while True:
+            await asyncio.sleep(self.IM.idle_check_interval)
+            self.IM.hibernate_idle_instances()
+
+    async def _routing_task(self, routing_q):
+        routing = self.IM.routing
+        while True:
+            routing.apply(await routing_q.get())
+
+    async def _master_task(self, master, master_q):
+        # Sessions time out even when nobody writes to the master
+        while True:
+            try:
+                task = await asyncio.wait_for(master_q.get(), master.next_expiry_in())
+            except asyncio.TimeoutError:
+                task = None
+
+            if task is not None:
+                metrics.handle_timed(master.handle_message, task, task.get('msg'))
+            master.expire_sessions()
+
+    async def _outbound_task(self, scheduler, outbound_q):
+        while True:
+            scheduler.push(await outbound_q.get())
+
+    @staticmethod
+    def _release_on_failure(scheduler, msg):
+        ''' done callback of a Bot call, a call that did not complete still releases its chat '''
+        def callback(future):
+            if future.cancelled():
+                scheduler.done(msg, sent=False)
+            elif future.exception() is not None:
+                logger.error('Bot call {} failed: {}'.format(msg.func_call, future.exception()))
+                scheduler.done(msg, sent=False)
+        return callback
+
+    async def _sender_task(self, scheduler):
+        ready = asyncio.Event()
+        scheduler.listener = self._event_setter(ready)
+
+        while True:
+            ready.clear()
+            msg, wait = scheduler.poll()
+            if msg is not None:
+                # Bot calls are blocking http requests
+                self._loop.run_in_executor(
+                    self._sender_pool, self.tal.send_item, msg).add_done_callback(
+                        self._release_on_failure(scheduler, msg))
+                continue
+            try:
+                await asyncio.wait_for(ready.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
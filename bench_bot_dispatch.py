@@ -0,0 +1,65 @@
+''' microbenchmark: per message cost of resolving and validating a Bot call '''
+import timeit
+
+from inspect import signature
+
+from telegram import Bot
+
+from bot_dispatch import build_dispatch_table, get_bot_call
+from queues import TxQItem
+
+N = 20000
+
+FAKE_TOKEN = '123456:BENCHMARK'
+
+
+def reflective_dispatch(bot, msg):
+    ''' what TelegramAbstractionLayer._run used to do for every message '''
+    method = getattr(bot, msg.func_call)
+    sig = signature(method)
+    args = [p.name for p in sig.parameters.values() if (p.default == p.empty) and (p.name != 'kwargs')]  # nopep8
+    kwargs = [p.name for p in sig.parameters.values() if (p.default != p.empty)]  # nopep8
+    for param in msg.kwargs:
+        if param not in kwargs:
+            pass
+    return method, len(args) == len(msg.args)
+
+
+def table_dispatch(table, msg):
+    ''' what the sender does now '''
+    call = table[msg.func_call]
+    call.validate(msg.args, msg.kwargs)
+    return call.method
+
+
+def producer_validation(msg):
+    ''' what TxMessageQ.put_func_call does before queueing '''
+    get_bot_call(msg.func_call).validate(msg.args, msg.kwargs)
+
+
+def main():
+    bot = Bot(FAKE_TOKEN)
+
+    t_build = timeit.timeit(lambda: build_dispatch_table(bot), number=1)
+    table = build_dispatch_table(bot)
+
+    messages = [
+        TxQItem('send_message', args=[1234, 'hello']),
+        TxQItem('edit_message_reply_markup',
+                kwargs={'chat_id': 1234, 'message_id': 1, 'reply_markup': None}),
+        TxQItem('answer_callback_query', args=['4321']),
+    ]
+
+    print('Dispatch table with {} methods built in {:.2f} ms'.format(
+        len(table), t_build * 1e3))
+
+    for msg in messages:
+        before = timeit.timeit(lambda: reflective_dispatch(bot, msg), number=N)
+        after = timeit.timeit(lambda: table_dispatch(table, msg), number=N)
+        producer = timeit.timeit(lambda: producer_validation(msg), number=N)
+        print('{:<28} before {:7.2f} us  after {:5.2f} us  producer {:5.2f} us  ({:.0f}x)'.format(
+            msg.func_call, before / N * 1e6, after / N * 1e6, producer / N * 1e6, before / after))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+'''
+    benchmark: Bot calls needed for bursts of game traffic, with and without coalescing
+
+    Each chat gets what a game turn typically produces: a keyboard edit, three
+    texts, a second edit of the same keyboard and an edit repeating it.
+    The scheduler runs on a simulated clock, so the drain time is the time
+    the telegram limits impose, not the time of this machine.
+'''
+from queues import TxQItem
+from rate_limiter import OutboundScheduler
+from reply_cache import inline_keyboard
+
+CHATS = 200
+
+KEYBOARD = inline_keyboard(((('Rock', 'R'), ('Paper', 'P'), ('Scissors', 'S')),))
+DONE_KEYBOARD = inline_keyboard(((('Played', 'X'),),))
+
+
+def burst(chat_id):
+    return [
+        TxQItem('edit_message_reply_markup', [chat_id], {'message_id': 1, 'reply_markup': KEYBOARD}),
+        TxQItem('send_message', [chat_id, 'Your move was registered']),
+        TxQItem('send_message', [chat_id, 'Waiting for the other player']),
+        TxQItem('send_message', [chat_id, 'Round 2 of 3']),
+        TxQItem('edit_message_reply_markup', [chat_id], {'message_id': 1, 'reply_markup': DONE_KEYBOARD}),
+        TxQItem('edit_message_reply_markup', [chat_id], {'message_id': 1, 'reply_markup': DONE_KEYBOARD}),
+    ]
+
+
+def bench(name, coalescer):
+    now = [0.0]
+    scheduler = OutboundScheduler(clock=lambda: now[0], coalescer=coalescer)
+
+    queued = 0
+    for chat_id in range(1, CHATS + 1):
+        for item in burst(chat_id):
+            scheduler.push(item)
+            queued += 1
+
+    sent = 0
+    while True:
+        item, wait = scheduler.poll()
+        if item is not None:
+            # The call is answered instantly, the limits are what takes time
+            scheduler.done(item)
+            sent += 1
+        elif wait is None:
+            break
+        else:
+            # Float rounding can leave waits too small to move the clock
+            now[0] += max(wait, 1e-6)
+
+    print('{:<12} {:5d} calls queued, {:5d} sent, drained in {:6.1f}s'.format(name, queued, sent, now[0]))
+
+
+def main():
+    bench('as queued', None)
+    bench('coalesced', True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+'''
+    benchmark: the whole pipeline end to end, with fake telegram servers
+
+    Every chat plays the onboarding of SelectGameSession: it sends /start,
+    waits for the welcome keyboard and presses a game button. The updates
+    are polled by a real Updater from a FakeTelegramServer and go
+    TelegramAbstractionLayer -> Router -> MasterInstance -> SelectGameSession
+    -> OUTBOUND_MSG_QUEUE -> sender -> Bot -> FakeTelegramServer.
+
+    Reported: inbound messages/s until the last chat got its last reply,
+    p50/p99 latency from an update being available to getUpdates to the first
+    Bot call answering it, and the RSS of all the processes.
+    Each run is appended as a JSON line to --output, with the commit it ran on,
+    to compare runs across commits.
+
+    python bench_e2e.py --chats 500 --master-shards 2
+'''
+import argparse
+import itertools
+import json
+import multiprocessing as mp
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import threading
+import time
+
+from fake_telegram import FAKE_TOKEN, FakeTelegramServer, fake_bot, fake_updater, \
+    make_callback_update, make_message_update
+from instance_manager import InstanceManager
+from rate_limiter import OutboundScheduler
+from router import Router
+from session import SelectGameSession
+from telegram_abstraction_layer import TelegramAbstractionLayer
+
+
+class Chats():
+    ''' plays the chats against the FakeTelegramServer, called back for every Bot call '''
+
+    def __init__(self, server, chat_ids):
+        self._server = server
+        self._chat_ids = list(chat_ids)
+        self._update_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+        # chat id -> perf_counter() of its update waiting for an answer
+        self._sent_at = {}
+        self.latencies = []
+        self._remaining = len(self._chat_ids)
+        self.done = threading.Event()
+        self.updates = 0
+
+    def start(self):
+        for chat_id in self._chat_ids:
+            self._send(chat_id, make_message_update(next(self._update_ids), chat_id, '/start'))
+
+    def _send(self, chat_id, update):
+        with self._lock:
+            self._sent_at[chat_id] = time.perf_counter()
+            self.updates += 1
+        self._server.push_update(update)
+
+    def on_call(self, endpoint, data):
+        now = time.perf_counter()
+        if endpoint == 'answerCallbackQuery':
+            chat_id = int(data['callback_query_id'][1:])
+        else:
+            chat_id = int(data.get('chat_id', 0))
+
+        with self._lock:
+            sent_at = self._sent_at.pop(chat_id, None)
+            if sent_at is not None:
+                self.latencies.append(now - sent_at)
+
+        if endpoint == 'sendMessage' and data.get('reply_markup'):
+            # The welcome keyboard, press the first game
+            self._send(chat_id, make_callback_update(
+                next(self._update_ids), chat_id, str(SelectGameSession.GAMES[0]['ID']),
+                message_id=1, query_id='q{}'.format(chat_id)))
+
+        elif endpoint == 'sendMessage' and 'Creating new game instance' in data.get('text', ''):
+            with self._lock:
+                self._remaining -= 1
+                if self._remaining == 0:
+                    self.done.set()
+
+
+def rss_bytes():
+    ''' resident memory of this process and of its children '''
+    total = 0
+    for pid in [os.getpid()] + [child.pid for child in mp.active_children()]:
+        try:
+            with open('/proc/{}/status'.format(pid)) as status:
+                for line in status:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+                        break
+        except OSError:
+            continue
+    return total
+
+
+def commit():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        head = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=here,
+                                       stderr=subprocess.DEVNULL, text=True).strip()
+        dirty = subprocess.check_output(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=here,
+                                        stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+    return head + ('-dirty' if dirty else '')
+
+
+def percentile(samples, pct):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+def run(args):
+    server = FakeTelegramServer(latency=args.bot_latency)
+    chats = Chats(server, range(1, args.chats + 1))
+    server.on_call = chats.on_call
+
+    bot = fake_bot(server)
+    # The flood limits would be all there is to measure
+    scheduler = None if args.flood_limits else OutboundScheduler(global_rate=1e9, global_burst=1e9,
+                                                                 chat_rate=1e9, chat_burst=1e9)
+    tal = TelegramAbstractionLayer(FAKE_TOKEN, bot=bot, updater=fake_updater(bot), scheduler=scheduler,
+                                   sender_workers=args.sender_workers)
+    im = InstanceManager(hosts=args.hosts, master_shards=args.master_shards)
+    rtr = Router(im, shards=args.router_shards)
+
+    tal.start()
+    im.start()
+    rtr.start()
+    # Let the processes come up
+    time.sleep(1)
+
+    rss_idle = rss_bytes()
+    start = time.perf_counter()
+    chats.start()
+    completed = chats.done.wait(args.timeout)
+    elapsed = time.perf_counter() - start
+    rss_loaded = rss_bytes()
+
+    rtr.stop()
+    im.stop()
+    tal.stop()
+
+    return {
+        'completed': completed,
+        'updates': chats.updates,
+        'bot_calls': server.calls,
+        'elapsed_s': elapsed,
+        'msgs_per_s': chats.updates / elapsed,
+        'latency_p50_ms': statistics.median(chats.latencies) * 1e3 if chats.latencies else None,
+        'latency_p99_ms': percentile(chats.latencies, 99) * 1e3 if chats.latencies else None,
+        'rss_idle_mb': rss_idle / 2**20,
+        'rss_loaded_mb': rss_loaded / 2**20,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--chats', type=int, default=300, help='number of concurrent chats')
+    parser.add_argument('--hosts', type=int, default=0, help='InstanceManager hosts')
+    parser.add_argument('--master-shards', type=int, default=1, help='MasterInstance processes')
+    parser.add_argument('--router-shards', type=int, default=0, help='Router shard threads')
+    parser.add_argument('--sender-workers', type=int, default=4, help='threads doing the Bot calls')
+    parser.add_argument('--bot-latency', type=float, default=0, help='seconds each Bot call takes')
+    parser.add_argument('--flood-limits', action='store_true', help='keep the telegram flood limits')
+    parser.add_argument('--timeout', type=float, default=120, help='give up after this many seconds')
+    parser.add_argument('--output', default='bench_e2e.jsonl', help='file the results are appended to')
+    args = parser.parse_args()
+
+    results = run(args)
+
+    record = {
+        'commit': commit(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'cpus': os.cpu_count(),
+        'params': {k: v for (k, v) in vars(args).items() if k not in ('output', 'timeout')},
+        'results': results,
+    }
+    with open(args.output, 'a') as output:
+        output.write(json.dumps(record) + '\n')
+
+    print(json.dumps(record, indent=2))
+    return 0 if results['completed'] else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,88 @@
+'''
+    benchmark: synthetic inbound flood, one put per message vs micro batches
+
+    N messages for CHATS chats are pushed as fast as possible into
+    INBOUND_MSG_QUEUE, the Router dispatches them to INSTANCES instance
+    processes which count what they get. Measured until every message
+    reached its instance.
+    - unbatched: one INBOUND_MSG_QUEUE.put per message, Router routes one message at a time
+    - batched:   RxBatcher in front of INBOUND_MSG_QUEUE, Router drains and routes whole
+                 batches and dispatches them grouped per instance
+'''
+import time
+
+from multiprocessing import Value
+
+from instance import Instance
+from instance_manager import InstanceManager
+from queues import INBOUND_MSG_QUEUE, RxBatcher, RxQItem, RxUpdate
+from router import Router
+
+N = 20000
+CHATS = 1000
+INSTANCES = 8
+
+# Inherited by the instance processes
+COUNTER = Value('i', 0)
+
+
+class CountingInstance(Instance):
+    ''' game instance owning some chats, only counts its messages '''
+
+    def __init__(self, id_, hosted=False, chat_ids=()):
+        super().__init__(id_, hosted)
+        self.find_by['CHAT_ID'] = list(chat_ids)
+
+    def handle_message(self, msg):
+        with COUNTER.get_lock():
+            COUNTER.value += 1
+
+
+def make_messages():
+    messages = []
+    for idx in range(N):
+        chat_id = idx % CHATS
+        messages.append(RxQItem(
+            RxQItem.TEXT_MSG, route_by=RxQItem.ROUTE_BY_CHAT_ID, chat_id=chat_id, user_id=chat_id,
+            kwargs={'update': RxUpdate(update_id=idx, chat_id=chat_id, user_id=chat_id,
+                                       message_id=idx, text='flood')}))
+    return messages
+
+
+def bench(name, batched):
+    COUNTER.value = 0
+    im = InstanceManager()
+    im.start()
+    for idx in range(INSTANCES):
+        im.create_instance(CountingInstance, chat_ids=range(idx, CHATS, INSTANCES))
+    while len(im.chat_id_to_instance_id(CHATS - 1)) < 1:
+        time.sleep(0.01)
+
+    rtr = Router(im, batch_size=256 if batched else 1)
+    rtr.start()
+    messages = make_messages()
+    batcher = RxBatcher(INBOUND_MSG_QUEUE)
+    put = batcher.put if batched else INBOUND_MSG_QUEUE.put
+
+    try:
+        start = time.perf_counter()
+        for msg in messages:
+            put(msg)
+        batcher.flush()
+        while COUNTER.value < N:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+    finally:
+        rtr.stop()
+        im.stop()
+
+    print('{:<10} {:8.0f} messages/s'.format(name, N / elapsed))
+
+
+def main():
+    bench('unbatched', False)
+    bench('batched', True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,72 @@
+'''
+    benchmark: cost of the debug log of the router for each message
+
+    'eager' formats the message before calling the logger (what the code did),
+    'lazy' passes it as an argument. With DEBUG off the lazy call never
+    touches the message. With DEBUG on, a handler writing in the calling
+    thread is compared to the QueueHandler of log_pipeline.
+'''
+import logging
+import os
+import time
+
+import log_pipeline
+from queues import RxQItem, RxUpdate
+
+from pb_cfg import LOGGER_NAME
+
+N = 20000
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+def make_msg(i):
+    update = RxUpdate.from_dict({
+        'update_id': i,
+        'message': {'message_id': i, 'date': 0, 'text': 'hello',
+                    'chat': {'id': i, 'type': 'private'},
+                    'from': {'id': i, 'is_bot': False, 'first_name': 'a'}}})
+    return RxQItem(RxQItem.TEXT_MSG, route_by=RxQItem.ROUTE_BY_CHAT_ID,
+                   chat_id=i, user_id=i, kwargs={'update': update})
+
+
+def eager(msg):
+    logger.debug('Routing -- {}'.format(msg))
+
+
+def lazy(msg):
+    logger.debug('Routing -- %s', msg)
+
+
+def bench(name, log_call, msgs):
+    start = time.perf_counter()
+    for msg in msgs:
+        log_call(msg)
+    elapsed = time.perf_counter() - start
+    print('{:<28} {:7.2f} us per message'.format(name, elapsed / len(msgs) * 1e6))
+
+
+def main():
+    msgs = [make_msg(i) for i in range(N)]
+    devnull = open(os.devnull, 'w')
+    file_handler = logging.StreamHandler(devnull)
+    file_handler.setFormatter(logging.Formatter(log_pipeline.LOG_FORMAT))
+
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(file_handler)
+    bench('DEBUG off, eager', eager, msgs)
+    bench('DEBUG off, lazy', lazy, msgs)
+
+    logger.setLevel(logging.DEBUG)
+    bench('DEBUG on, handler in thread', lazy, msgs)
+    logger.removeHandler(file_handler)
+
+    listener = log_pipeline.install(level=logging.DEBUG, handlers=[file_handler])
+    bench('DEBUG on, queue handler', lazy, msgs)
+    listener.stop()
+    devnull.close()
+
+
+if __name__ == '__main__':
+    main()
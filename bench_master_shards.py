@@ -0,0 +1,81 @@
+'''
+    benchmark: onboarding throughput of the master instance vs number of shards
+
+    N new chats are sent straight to InstanceManager.send_to_master_instance,
+    the time until every shard has opened its sessions is measured.
+    The replies of the sessions are drained from OUTBOUND_MSG_QUEUE and dropped.
+    The shards only scale with the cores they can run on, the number of cores is
+    printed with the results: compare shard counts up to that number.
+'''
+import os
+import sys
+import threading
+import time
+
+from queue import Empty
+
+from instance_manager import InstanceManager
+from master_instance import MasterInstance
+from queues import OUTBOUND_MSG_QUEUE, RxQItem, RxUpdate
+
+N = 20000
+
+
+def drain(stop):
+    while not stop.is_set():
+        try:
+            OUTBOUND_MSG_QUEUE.get(timeout=0.1)
+        except Empty:
+            pass
+
+
+def new_user(chat_id):
+    update = RxUpdate(update_id=chat_id, chat_id=chat_id, user_id=chat_id, message_id=1, text='hi')
+    msg = RxQItem(RxQItem.TEXT_MSG, chat_id=chat_id, user_id=chat_id, kwargs={'update': update})
+    return {'task': MasterInstance.TASK_HANDLE_NEW_USER, 'msg': msg}
+
+
+def bench(shards):
+    im = InstanceManager(master_shards=shards)
+    im.start_processes()
+
+    stop = threading.Event()
+    drainer = threading.Thread(target=drain, args=(stop,))
+    drainer.start()
+
+    tasks = [new_user(chat_id) for chat_id in range(N)]
+    try:
+        start = time.perf_counter()
+        for task in tasks:
+            im.send_to_master_instance(task)
+        while sum(im.master_session_counts()) < N:
+            time.sleep(0.001)
+        elapsed = time.perf_counter() - start
+        counts = im.master_session_counts()
+    finally:
+        im.stop_instances()
+        stop.set()
+        drainer.join()
+
+    print('{} shard(s): {:8.0f} new users/s  sessions per shard {}'.format(
+        shards, N / elapsed, counts))
+
+
+def usable_cpus():
+    ''' cores this process may run on '''
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count()
+
+
+def main():
+    cpus = usable_cpus()
+    print('os.cpu_count() {}, usable by this process {}'.format(os.cpu_count(), cpus))
+    for shards in [int(arg) for arg in sys.argv[1:]] or [1, 2, 4]:
+        bench(shards)
+        if shards > cpus:
+            print('  more shards than cores, not a measure of the scaling')
+
+
+if __name__ == '__main__':
+    main()
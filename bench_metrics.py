@@ -0,0 +1,82 @@
+'''
+    benchmark: instrumentation cost per message
+
+    Messages go through every instrumented point of the pipeline in batches
+    of BATCH, as the router and the instances get them: the routing hop and
+    router result (one stamp per routed batch), the instance hop and handling
+    (the end of a message is the start of the next one), the outbound queue
+    hop and the Bot call. The stamps carried by RxQItem/TxQItem are taken
+    when they are built, measured here as one monotonic() each.
+    The handler and the Bot call do nothing, only the overhead is left.
+'''
+import time
+
+import metrics
+
+N = 200000
+BATCH = 16
+
+
+def handle(msg):
+    return msg
+
+
+class Msg():
+    def __init__(self, stamp=time.monotonic):
+        self.rx_at = stamp()
+        self.routed_at = None
+        self.trace_id = None
+
+
+def plain():
+    # The same loops, without the stamps and the observations
+    msgs = [Msg(float) for _ in range(BATCH)]
+    for msg in msgs:
+        msg.routed_at = 0
+    for msg in msgs:
+        handle(msg)
+    for msg in msgs:
+        pass
+
+
+def instrumented():
+    msgs = [Msg() for _ in range(BATCH)]
+    now = time.monotonic()
+    for msg in msgs:
+        metrics.observe(metrics.HOP_RX_TO_ROUTER, now - msg.rx_at)
+        msg.routed_at = now
+        metrics.count_route(3)
+    start = None
+    for msg in msgs:
+        start = metrics.handle_timed(handle, msg, msg, start)
+    for msg in msgs:
+        queued_at = time.monotonic()
+        start = time.monotonic()
+        metrics.observe(metrics.HOP_TX_QUEUE, start - queued_at)
+        metrics.observe(metrics.HOP_BOT_CALL, time.monotonic() - start)
+
+
+def bench(func):
+    start = time.perf_counter()
+    for _ in range(N // BATCH):
+        func()
+    return (time.perf_counter() - start) / (N // BATCH * BATCH)
+
+
+def main():
+    # Warm up, starts the flusher thread
+    bench(instrumented)
+    base = min(bench(plain) for _ in range(3))
+    inst = min(bench(instrumented) for _ in range(3))
+    # What is left with METRICS_LISTEN = None: the stamps and calls to the hooks doing nothing
+    metrics.install(enabled=False)
+    off = min(bench(instrumented) for _ in range(3))
+    print('plain         {:6.3f} us per message'.format(base * 1e6))
+    print('instrumented  {:6.3f} us per message'.format(inst * 1e6))
+    print('overhead      {:6.3f} us per message, {:5.3f} us per hop'.format(
+        (inst - base) * 1e6, (inst - base) / len(metrics.HOPS) * 1e6))
+    print('disabled      {:6.3f} us per message of overhead'.format((off - base) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
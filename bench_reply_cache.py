@@ -0,0 +1,51 @@
+'''
+    benchmark: cost of the first contact reply, keyboard built per user vs cached JSON
+
+    Per reply: build the reply_markup, pickle the TxQItem (OUTBOUND_MSG_QUEUE)
+    and serialize the markup like the Bot does before the http request.
+'''
+import pickle
+import time
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyMarkup
+
+from queues import make_tx_item
+from session import SelectGameSession
+
+N = 20000
+
+
+def bot_serialize(reply_markup):
+    # What Bot._message does with reply_markup
+    return reply_markup.to_json() if isinstance(reply_markup, ReplyMarkup) else reply_markup
+
+
+def per_user_markup():
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(game['name'], callback_data=game['ID'])] for game in SelectGameSession.GAMES])
+
+
+def cached_markup():
+    return SelectGameSession.games_keyboard()
+
+
+def bench(name, build_markup):
+    size = 0
+    start = time.perf_counter()
+    for chat_id in range(N):
+        item = make_tx_item('send_message', (chat_id, SelectGameSession.WELCOME_TEXT),
+                            {'reply_markup': build_markup()})
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        bot_serialize(pickle.loads(data).kwargs['reply_markup'])
+        size = len(data)
+    elapsed = time.perf_counter() - start
+    print('{:<10} {:6.1f} us per reply, {:5d} bytes in the queue'.format(name, elapsed / N * 1e6, size))
+
+
+def main():
+    bench('per user', per_user_markup)
+    bench('cached', cached_markup)
+
+
+if __name__ == '__main__':
+    main()
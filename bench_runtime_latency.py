@@ -0,0 +1,115 @@
+'''
+    benchmark: per hop latency of the thread based runtime vs AsyncRuntime
+
+    Every ping is the first message of a new chat, it goes
+    INBOUND_MSG_QUEUE -> Router -> MasterInstance -> SelectGameSession -> sender -> Bot
+    (4 hops). Pings are sent one at a time, each one waits for its reply.
+'''
+import statistics
+import sys
+import threading
+import time
+
+from telegram import Bot
+
+from async_runtime import AsyncRuntime
+from instance_manager import InstanceManager
+from queues import INBOUND_MSG_QUEUE, RxQItem, RxUpdate
+from rate_limiter import OutboundScheduler
+from router import Router
+from telegram_abstraction_layer import TelegramAbstractionLayer
+
+N = 300
+HOPS = 4
+
+FAKE_TOKEN = '123456:BENCHMARK'
+
+
+class ReplyRecorderBot(Bot):
+    ''' Bot that never talks to telegram, it only signals the replies '''
+
+    def __init__(self):
+        super().__init__(FAKE_TOKEN)
+        self.replied = threading.Event()
+
+    def send_message(self, chat_id, text, reply_markup=None, **kwargs):
+        self.replied.set()
+
+
+def make_tal(bot):
+    # No flood limits, only the latency of the pipeline is measured
+    scheduler = OutboundScheduler(global_rate=1e9, global_burst=1e9)
+    return TelegramAbstractionLayer(FAKE_TOKEN, scheduler=scheduler, bot=bot)
+
+
+def ping(bot, chat_id):
+    bot.replied.clear()
+    start = time.perf_counter()
+    INBOUND_MSG_QUEUE.put(RxQItem(
+        RxQItem.TEXT_MSG,
+        route_by=RxQItem.ROUTE_BY_CHAT_ID | RxQItem.ROUTE_BY_USER_ID,
+        chat_id=chat_id, user_id=chat_id,
+        kwargs={'update': RxUpdate(update_id=chat_id, chat_id=chat_id, user_id=chat_id,
+                                   message_id=1, text='hi')}))
+    bot.replied.wait(5)
+    return time.perf_counter() - start
+
+
+def measure(bot, first_chat):
+    # Warm up
+    for chat_id in range(first_chat, first_chat + 10):
+        ping(bot, chat_id)
+    return [ping(bot, chat_id) for chat_id in range(first_chat + 10, first_chat + 10 + N)]
+
+
+def bench_threads():
+    bot = ReplyRecorderBot()
+    tal = make_tal(bot)
+    tal.start(receiver=False)
+    im = InstanceManager()
+    im.start()
+    rtr = Router(im)
+    rtr.start()
+    try:
+        return measure(bot, 1000)
+    finally:
+        rtr.stop()
+        im.stop()
+        tal.stop()
+
+
+def bench_asyncio():
+    bot = ReplyRecorderBot()
+    tal = make_tal(bot)
+    tal.start(sender=False, receiver=False)
+    im = InstanceManager()
+    runtime = AsyncRuntime(tal, im, Router(im))
+    loop_thread = threading.Thread(target=runtime.run)
+    loop_thread.start()
+    try:
+        return measure(bot, 100000)
+    finally:
+        start = time.perf_counter()
+        runtime.stop()
+        loop_thread.join()
+        print('AsyncRuntime shutdown took {:.1f} ms'.format((time.perf_counter() - start) * 1e3))
+
+
+def report(name, latencies):
+    latencies = sorted(latencies)
+    p50 = statistics.median(latencies)
+    p99 = latencies[int(len(latencies) * 0.99) - 1]
+    print('{:<8} end to end p50 {:7.1f} us  p99 {:7.1f} us  per hop p50 {:6.1f} us'.format(
+        name, p50 * 1e6, p99 * 1e6, p50 / HOPS * 1e6))
+
+
+def main():
+    runtimes = sys.argv[1:] if len(sys.argv) > 1 else ['threads', 'asyncio']
+    if 'threads' in runtimes:
+        report('threads', bench_threads())
+    if 'asyncio' in runtimes:
+        report('asyncio', bench_asyncio())
+
+
+if __name__ == '__main__':
+    main()
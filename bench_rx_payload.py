@@ -0,0 +1,92 @@
+''' benchmark: size and queue cost of the inbound payload, full Update vs RxUpdate '''
+import pickle
+import time
+
+from multiprocessing import Queue
+
+from telegram import Bot, Update
+
+from queues import RxQItem, RxUpdate
+
+N = 5000
+
+FAKE_TOKEN = '123456:BENCHMARK'
+
+MESSAGE_UPDATE = {
+    'update_id': 10000,
+    'message': {
+        'message_id': 42,
+        'date': 1600000000,
+        'text': 'hello there',
+        'chat': {'id': 1111, 'type': 'private', 'first_name': 'Ann', 'username': 'ann'},
+        'from': {'id': 1111, 'is_bot': False, 'first_name': 'Ann', 'username': 'ann',
+                 'language_code': 'en'},
+    },
+}
+
+CALLBACK_UPDATE = {
+    'update_id': 10001,
+    'callback_query': {
+        'id': '4382bfdwdsb323b2d9',
+        'chat_instance': '-5123412341234',
+        'data': '2',
+        'from': {'id': 1111, 'is_bot': False, 'first_name': 'Ann', 'username': 'ann'},
+        'message': {
+            'message_id': 43,
+            'date': 1600000001,
+            'text': 'Welcome ! I am the Game Master !\nWhat game you would like to play ?',
+            'chat': {'id': 1111, 'type': 'private', 'first_name': 'Ann'},
+            'from': {'id': 99, 'is_bot': True, 'first_name': 'GameMaster'},
+            'reply_markup': {'inline_keyboard': [
+                [{'text': 'Guess the picture', 'callback_data': '0'}],
+                [{'text': 'Dominos', 'callback_data': '1'}],
+                [{'text': 'Laser fights', 'callback_data': '2'}],
+                [{'text': 'Sleeper', 'callback_data': '3'}],
+            ]},
+        },
+    },
+}
+
+
+def make_item(update):
+    return RxQItem(RxQItem.TEXT_MSG,
+                   route_by=RxQItem.ROUTE_BY_CHAT_ID | RxQItem.ROUTE_BY_USER_ID,
+                   chat_id=1111, user_id=1111, kwargs={'update': update})
+
+
+def queue_round_trip(item):
+    ''' us per put()+get() through a multiprocessing Queue '''
+    q = Queue()
+    start = time.perf_counter()
+    for _ in range(N):
+        q.put(item)
+        q.get()
+    return (time.perf_counter() - start) / N * 1e6
+
+
+def main():
+    bot = Bot(FAKE_TOKEN)
+
+    try:
+        pickle.dumps(make_item(Update.de_json(MESSAGE_UPDATE, bot)))
+    except Exception as ex:
+        print('Update holding a Bot reference cannot be pickled at all: {}'.format(ex))
+
+    for (name, data) in (('message', MESSAGE_UPDATE), ('callback query', CALLBACK_UPDATE)):
+        # Without the Bot reference, the best case for the full Update
+        update = Update.de_json(data, None)
+
+        full = make_item(update)
+        slim = make_item(RxUpdate.from_update(update))
+
+        full_size = len(pickle.dumps(full, protocol=pickle.HIGHEST_PROTOCOL))
+        slim_size = len(pickle.dumps(slim, protocol=pickle.HIGHEST_PROTOCOL))
+
+        print('{:<15} pickle size     Update {:6d} B   RxUpdate {:5d} B'.format(
+            name, full_size, slim_size))
+        print('{:<15} put+get         Update {:6.1f} us  RxUpdate {:5.1f} us'.format(
+            name, queue_round_trip(full), queue_round_trip(slim)))
+
+
+if __name__ == '__main__':
+    main()
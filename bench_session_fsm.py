@@ -0,0 +1,51 @@
+'''
+    benchmark: SelectGameSession state machine driven by many simulated users
+
+    Every user goes through the whole onboarding: first contact, then a
+    game selection with the inline keyboard. The Bot calls go to a queue
+    that drops them, only the sessions are measured.
+'''
+import time
+
+from queues import RxUpdate
+from session import SelectGameSession
+
+N = 50000
+
+
+class NullTxQ():
+    ''' TxMessageQ look alike, drops every call '''
+
+    def send_message(self, *args, **kwargs):
+        pass
+
+    def answer_callback_query(self, *args, **kwargs):
+        pass
+
+    def edit_message_reply_markup(self, *args, **kwargs):
+        pass
+
+
+def main():
+    output_q = NullTxQ()
+    hello = [RxUpdate(update_id=chat_id, chat_id=chat_id, user_id=chat_id, message_id=1, text='hi')
+             for chat_id in range(N)]
+    choice = [RxUpdate(update_id=chat_id, chat_id=chat_id, user_id=chat_id, message_id=2,
+                       callback_query_id=str(chat_id), callback_data=str(chat_id % len(SelectGameSession.GAMES)))
+              for chat_id in range(N)]
+
+    start = time.perf_counter()
+    sessions = [SelectGameSession(output_q=output_q) for _ in range(N)]
+    for (session, update) in zip(sessions, hello):
+        session.iterate(update=update)
+    for (session, update) in zip(sessions, choice):
+        session.iterate(update=update)
+    elapsed = time.perf_counter() - start
+
+    assert all(session.state == SelectGameSession.S_EXIT for session in sessions)
+    print('{} sessions onboarded in {:.1f} ms, {:.2f} us per message'.format(
+        N, elapsed * 1e3, elapsed / (2 * N) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
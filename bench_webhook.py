@@ -0,0 +1,107 @@
+'''
+    benchmark: webhook ingestion, from the POST of a fake telegram client
+    to the RxQItem coming out of INBOUND_MSG_QUEUE
+
+    - latency of a single update
+    - throughput with several clients posting at once, one update or a
+      batch of updates per POST
+'''
+import http.client
+import json
+import statistics
+import threading
+import time
+
+from queues import INBOUND_MSG_QUEUE, RxQItem, unbatch
+from webhook import WebhookReceiver
+
+N = 4000
+
+
+class FakeTelegramClient():
+    ''' posts updates to a webhook the way telegram does, on a kept alive connection '''
+
+    def __init__(self, host, port, path='/', secret_token=None):
+        self._conn = http.client.HTTPConnection(host, port)
+        self._path = path
+        self._headers = {'Content-Type': 'application/json'}
+        if secret_token is not None:
+            self._headers['X-Telegram-Bot-Api-Secret-Token'] = secret_token
+        self._update_id = 0
+
+    def make_update(self, chat_id, text='hi'):
+        self._update_id += 1
+        return {
+            'update_id': self._update_id,
+            'message': {
+                'message_id': self._update_id,
+                'date': int(time.time()),
+                'text': text,
+                'chat': {'id': chat_id, 'type': 'private', 'first_name': 'Ann'},
+                'from': {'id': chat_id, 'is_bot': False, 'first_name': 'Ann'},
+            },
+        }
+
+    def post(self, updates):
+        ''' one update (dict) or a list of them, returns the http status '''
+        self._conn.request('POST', self._path, body=json.dumps(updates), headers=self._headers)
+        response = self._conn.getresponse()
+        response.read()
+        return response.status
+
+    def close(self):
+        self._conn.close()
+
+
+def latency(receiver):
+    client = FakeTelegramClient(*receiver.address, secret_token=receiver.secret_token)
+    samples = []
+    for chat_id in range(500):
+        start = time.perf_counter()
+        client.post(client.make_update(chat_id))
+        item, = unbatch(INBOUND_MSG_QUEUE.get(timeout=5))
+        samples.append(time.perf_counter() - start)
+        assert item.kind == RxQItem.TEXT_MSG and item.chat_id == chat_id
+    client.close()
+    print('single update: post -> INBOUND_MSG_QUEUE p50 {:.0f} us'.format(statistics.median(samples) * 1e6))
+
+
+def throughput(receiver, clients, batch):
+    per_client = N // clients
+
+    def run(idx):
+        client = FakeTelegramClient(*receiver.address, secret_token=receiver.secret_token)
+        for first in range(0, per_client, batch):
+            updates = [client.make_update(idx * per_client + chat_id)
+                       for chat_id in range(first, min(first + batch, per_client))]
+            client.post(updates if batch > 1 else updates[0])
+        client.close()
+
+    threads = [threading.Thread(target=run, args=(idx,)) for idx in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    received = 0
+    while received < per_client * clients:
+        received += len(unbatch(INBOUND_MSG_QUEUE.get(timeout=10)))
+    elapsed = time.perf_counter() - start
+    for thread in threads:
+        thread.join()
+    print('{} client(s), {:3d} update(s) per POST: {:8.0f} updates/s'.format(
+        clients, batch, per_client * clients / elapsed))
+
+
+def main():
+    receiver = WebhookReceiver('127.0.0.1', 0, secret_token='benchmark')
+    receiver.start()
+    try:
+        latency(receiver)
+        for clients in (1, 4):
+            for batch in (1, 50):
+                throughput(receiver, clients, batch)
+    finally:
+        receiver.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+''' precompiled dispatch table for the telegram Bot methods '''
+import logging
+
+from inspect import signature, Parameter
+
+from telegram import Bot
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class BotCall():
+    '''
+        A Bot method together with an argument validator.
+        The signature is inspected only once, when the BotCall is created.
+        validate() mimics what python would check when calling the method
+        without having to call inspect for every message.
+    '''
+    __slots__ = ('name', 'method', 'positional', 'required',
+                 'keywords', 'var_args', 'var_kwargs', 'chat_id_index')
+
+    def __init__(self, name, method, bound=True):
+        '''
+            name    -> name of the method in the Bot
+            method  -> the callable (bound method or function from the class)
+            bound   -> False if method is taken from the class and 'self' must be skipped
+        '''
+        self.name = name
+        self.method = method
+
+        params = list(signature(method).parameters.values())
+        if not bound and params:
+            params = params[1:]
+
+        # Names which can be given positionally (in order)
+        self.positional = tuple(p.name for p in params
+                                if p.kind in (Parameter.POSITIONAL_ONLY, Parameter.POSITIONAL_OR_KEYWORD))
+        # Names without default value
+        self.required = tuple(p.name for p in params
+                              if p.default is p.empty
+                              and p.kind not in (Parameter.VAR_POSITIONAL, Parameter.VAR_KEYWORD))
+        # Names which can be given as keyword
+        self.keywords = frozenset(p.name for p in params
+                                  if p.kind in (Parameter.POSITIONAL_OR_KEYWORD, Parameter.KEYWORD_ONLY))
+        self.var_args = any(p.kind == Parameter.VAR_POSITIONAL for p in params)
+        self.var_kwargs = any(p.kind == Parameter.VAR_KEYWORD for p in params)
+        # Where to find the chat the call is addressed to, None if it has none
+        self.chat_id_index = self.positional.index('chat_id') \
+            if 'chat_id' in self.positional else None
+
+    def validate(self, args, kwargs):
+        ''' raise TypeError if method(*args, **kwargs) would not be a valid call '''
+
+        if not self.var_args and len(args) > len(self.positional):
+            raise TypeError('{}() takes {} positional arguments but {} were given'.format(
+                self.name, len(self.positional), len(args)))
+
+        given_positionally = self.positional[:len(args)]
+
+        for param in kwargs:
+            if param in given_positionally:
+                raise TypeError('{}() got multiple values for argument \'{}\''.format(
+                    self.name, param))
+            if param not in self.keywords and not self.var_kwargs:
+                raise TypeError('{}() got an unexpected keyword argument \'{}\''.format(
+                    self.name, param))
+
+        for param in self.required:
+            if param not in kwargs and param not in given_positionally:
+                raise TypeError('{}() missing required argument: \'{}\''.format(
+                    self.name, param))
+
+    def chat_id(self, args, kwargs):
+        ''' chat id this call is addressed to, None if the method has no chat '''
+        if 'chat_id' in kwargs:
+            return kwargs['chat_id']
+        if self.chat_id_index is not None and self.chat_id_index < len(args):
+            return args[self.chat_id_index]
+        return None
+
+    def bind(self, args, kwargs):
+        ''' dict name -> value of the arguments of a valid call, positional ones by their name '''
+        bound = dict(zip(self.positional, args))
+        bound.update(kwargs)
+        return bound
+
+    def __call__(self, *args, **kwargs):
+        return self.method(*args, **kwargs)
+
+
+def build_dispatch_table(bot):
+    ''' map every public method name of a Bot instance to its BotCall '''
+    table = {}
+    for name in dir(type(bot)):
+        if name.startswith('_'):
+            continue
+        # Look at the class, properties of the Bot (eg. username) would hit the server
+        if not callable(getattr(type(bot), name, None)):
+            continue
+        try:
+            table[name] = BotCall(name, getattr(bot, name))
+        except (TypeError, ValueError):
+            # Builtins without an inspectable signature, nothing to send there
+            continue
+    return table
+
+
+# Validators built from the Bot class, used by the producers of TxQItems
+# which don't have a Bot instance of their own
+_CLASS_CALLS = {}
+
+
+def get_bot_call(func_name):
+    '''
+        BotCall for the Bot class method func_name (not bound to any Bot)
+        Raises AttributeError if the Bot has no such method
+    '''
+    try:
+        return _CLASS_CALLS[func_name]
+    except KeyError:
+        pass
+
+    method = getattr(Bot, func_name, None) if not func_name.startswith('_') else None
+    if not callable(method):
+        raise AttributeError('Bot has no method {}'.format(func_name))
+
+    call = BotCall(func_name, method, bound=False)
+    _CLASS_CALLS[func_name] = call
+    return call
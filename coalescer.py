@@ -0,0 +1,185 @@
+''' drop or merge outbound Bot calls made redundant by the ones queued after them '''
+import logging
+
+from collections import OrderedDict
+
+from bot_dispatch import get_bot_call
+from queues import TxQItem
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class OutboundCoalescer():
+    '''
+        Looks at each Bot call before it is queued in its chat FIFO of the
+        OutboundScheduler, with the calls of that chat still waiting to be sent:
+        - a send_message right after a plain send_message (no keyboard, same options)
+          queued less than 'window' seconds ago is merged into it, texts joined by a new line
+        - an edit of a message replaces the last edit still waiting for that message
+          if it is of the same kind
+        - an edit which would not change what the message shows is dropped. What a
+          message shows is only learnt from the edits that succeeded (see done()),
+          and only trusted while no other edit of it is queued or being sent
+        Only calls which have not been handed to a sender are touched, the order
+        of what is sent to a chat does not change.
+        Not thread safe, the scheduler calls it under its own lock.
+    '''
+
+    # Telegram refuses longer texts
+    MAX_TEXT = 4096
+
+    # Fields of a message set by each kind of edit, an edit sets all the fields
+    # of its kind (telegram drops the keyboard of an edit_message_text without reply_markup)
+    EDIT_CONTENT = {
+        'edit_message_text': ('text', 'parse_mode', 'disable_web_page_preview', 'reply_markup', 'entities'),
+        'edit_message_reply_markup': ('reply_markup',),
+        'edit_message_caption': ('caption', 'parse_mode', 'reply_markup', 'caption_entities'),
+    }
+
+    def __init__(self, window=0.5, max_text=MAX_TEXT, max_rendered=10000):
+        '''
+            window          -> seconds during which a queued text can still grow
+            max_text        -> merged texts are kept below this length
+            max_rendered    -> number of messages whose content is remembered
+        '''
+        self.window = window
+        self.max_text = max_text
+        self.max_rendered = max_rendered
+
+        # chat_id -> time the last item of its FIFO was queued
+        self._tail_at = {}
+        # (chat_id, message_id) -> {field: value} shown by the message, from the edits that succeeded
+        self._rendered = OrderedDict()
+        # (chat_id, message_id) -> number of its edits queued or being sent
+        self._unconfirmed = {}
+
+        self.merged = 0
+        self.superseded = 0
+        self.unchanged = 0
+
+    def absorb(self, chat_id, chat_q, item, now):
+        '''
+            True if item was merged into a queued call or is not needed,
+            it must not be queued then. False if it goes at the end of chat_q.
+            chat_q -> calls of the chat waiting to be sent, None if there are none
+        '''
+        try:
+            params = get_bot_call(item.func_call).bind(item.args, item.kwargs)
+        except AttributeError:
+            return False
+
+        fields = self.EDIT_CONTENT.get(item.func_call)
+        if fields is not None:
+            if self._absorb_edit(chat_id, chat_q, item, params, fields):
+                return True
+        elif item.func_call == 'send_message' and chat_q \
+                and now - self._tail_at.get(chat_id, now) <= self.window:
+            if self._merge_text(chat_q, item, params):
+                return True
+
+        self._tail_at[chat_id] = now
+        return False
+
+    def _absorb_edit(self, chat_id, chat_q, item, params, fields):
+        message_id = params.get('message_id')
+        if message_id is None:
+            return False
+        key = (chat_id, message_id)
+
+        if not self._unconfirmed.get(key):
+            rendered = self._rendered.get(key)
+            if rendered is not None and all(f in rendered and rendered[f] == _comparable(params.get(f))
+                                            for f in fields):
+                self.unchanged += 1
+                return True
+
+        # Only the last queued edit of the message can be replaced, the edits
+        # after an older one would be undone by it
+        for idx in range(len(chat_q or ()) - 1, -1, -1):
+            queued = chat_q[idx]
+            if queued.func_call not in self.EDIT_CONTENT or \
+                    get_bot_call(queued.func_call).bind(queued.args, queued.kwargs).get('message_id') != message_id:
+                continue
+            if queued.func_call == item.func_call:
+                # Keep the place of the older edit, what was sent after it may depend on it
+                chat_q[idx] = item
+                self.superseded += 1
+                return True
+            break
+
+        self._unconfirmed[key] = self._unconfirmed.get(key, 0) + 1
+        return False
+
+    def done(self, chat_id, item, sent):
+        '''
+            item, queued after absorb() returned False, was handed to the Bot
+            sent -> True if the call succeeded
+        '''
+        fields = self.EDIT_CONTENT.get(item.func_call)
+        if fields is None:
+            return
+        params = get_bot_call(item.func_call).bind(item.args, item.kwargs)
+        message_id = params.get('message_id')
+        if message_id is None:
+            return
+        key = (chat_id, message_id)
+
+        left = self._unconfirmed.get(key, 0) - 1
+        if left > 0:
+            self._unconfirmed[key] = left
+        else:
+            self._unconfirmed.pop(key, None)
+
+        if not sent:
+            # What the message shows is not known anymore
+            self._rendered.pop(key, None)
+            return
+
+        rendered = self._rendered.setdefault(key, {})
+        rendered.update((f, _comparable(params.get(f))) for f in fields)
+        self._rendered.move_to_end(key)
+        if len(self._rendered) > self.max_rendered:
+            self._rendered.popitem(last=False)
+
+    def _merge_text(self, chat_q, item, params):
+        tail = chat_q[-1]
+        if tail.func_call != 'send_message':
+            return False
+
+        tail_params = get_bot_call(tail.func_call).bind(tail.args, tail.kwargs)
+        # A keyboard belongs to the message it is sent with, the new text can't go below it
+        if tail_params.get('reply_markup') is not None:
+            return False
+
+        text = params.get('text')
+        tail_text = tail_params.get('text')
+        if not isinstance(text, str) or not isinstance(tail_text, str):
+            return False
+        if len(tail_text) + 1 + len(text) > self.max_text:
+            return False
+
+        options = {k: v for (k, v) in params.items() if k not in ('text', 'reply_markup')}
+        tail_options = {k: v for (k, v) in tail_params.items() if k not in ('text', 'reply_markup')}
+        if options != tail_options:
+            return False
+
+        merged = dict(params)
+        merged['text'] = tail_text + '\n' + text
+        chat_q[-1] = TxQItem('send_message', kwargs=merged)
+        # Waiting since the first of the merged texts
+        chat_q[-1].queued_at = tail.queued_at
+        chat_q[-1].trace_id = tail.trace_id or item.trace_id
+        self.merged += 1
+        return True
+
+    def forget(self, chat_id):
+        ''' the FIFO of chat_id is empty, nothing can be merged into it anymore '''
+        self._tail_at.pop(chat_id, None)
+
+
+def _comparable(value):
+    ''' telegram objects (eg. InlineKeyboardMarkup) compare by their JSON '''
+    to_json = getattr(value, 'to_json', None)
+    return to_json() if to_json is not None else value
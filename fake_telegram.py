@@ -0,0 +1,151 @@
+''' in process stand in for the telegram servers, to run the whole pipeline without a token '''
+import itertools
+import logging
+import time
+
+from queue import Empty, Queue
+from threading import Lock
+
+from telegram import Bot
+from telegram.ext import Updater
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# Well formed, the Bot checks the shape of its token
+FAKE_TOKEN = '123456:FAKE-TELEGRAM'
+
+BOT_USER = {'id': 123456, 'is_bot': True, 'first_name': 'Game Master', 'username': 'fake_game_bot'}
+
+
+def make_message_update(update_id, chat_id, text, user_id=None, message_id=None):
+    ''' json of an update with a text (or command) message, as telegram sends it '''
+    user_id = chat_id if user_id is None else user_id
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id if message_id is None else message_id,
+            'date': int(time.time()),
+            'text': text,
+            'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Player'},
+        },
+    }
+
+
+def make_callback_update(update_id, chat_id, data, message_id, user_id=None, query_id=None):
+    ''' json of an update with the callback query of an inline keyboard button '''
+    user_id = chat_id if user_id is None else user_id
+    return {
+        'update_id': update_id,
+        'callback_query': {
+            'id': str(update_id) if query_id is None else query_id,
+            'chat_instance': str(chat_id),
+            'data': data,
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'Player'},
+            'message': {
+                'message_id': message_id,
+                'date': int(time.time()),
+                'text': 'keyboard',
+                'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'group'},
+                'from': BOT_USER,
+            },
+        },
+    }
+
+
+class FakeTelegramServer():
+    '''
+        Takes the place of telegram.utils.request.Request in a Bot: the Bot api
+        calls are answered locally, with what telegram would answer.
+        - getUpdates long polls the updates given to push_update(), so a real
+          Updater (see fake_updater) drives the polling handlers
+        - every other call is handed to on_call(endpoint, data) and answered
+          after 'latency' seconds (the round trip to telegram)
+    '''
+
+    # Longest wait of a getUpdates, keeps Updater.stop() quick
+    MAX_POLL_WAIT = 0.1
+
+    def __init__(self, latency=0, on_call=None):
+        '''
+            latency -> seconds every Bot call (but getUpdates) takes
+            on_call -> function(endpoint, data) called for every Bot call (but getUpdates),
+                        from the thread doing the call
+        '''
+        self.latency = latency
+        self.on_call = on_call
+
+        # Read by the Updater when it is given a Bot
+        self.con_pool_size = 1024
+
+        self._updates = Queue()
+        self._message_ids = itertools.count(1)
+        self._lock = Lock()
+        self.calls = 0
+
+    def push_update(self, update):
+        ''' json (dict) of an update, returned by the next getUpdates '''
+        self._updates.put(update)
+
+    def post(self, url, data=None, timeout=None):
+        endpoint = url.rsplit('/', 1)[-1]
+        data = data or {}
+
+        if endpoint == 'getUpdates':
+            return self._get_updates(data)
+
+        with self._lock:
+            self.calls += 1
+        if self.on_call is not None:
+            self.on_call(endpoint, data)
+        if self.latency:
+            time.sleep(self.latency)
+
+        if endpoint == 'getMe':
+            return dict(BOT_USER)
+        if endpoint.startswith('send'):
+            return self._message(data, next(self._message_ids))
+        if endpoint.startswith('edit') and 'chat_id' in data:
+            return self._message(data, data.get('message_id'))
+        # answerCallbackQuery, deleteWebhook, setWebhook, deleteMessage, ...
+        return True
+
+    def _get_updates(self, data):
+        updates = []
+        try:
+            updates.append(self._updates.get(timeout=min(data.get('timeout') or 0, self.MAX_POLL_WAIT)))
+        except Empty:
+            return updates
+        limit = data.get('limit') or 100
+        while len(updates) < limit:
+            try:
+                updates.append(self._updates.get_nowait())
+            except Empty:
+                break
+        return updates
+
+    @staticmethod
+    def _message(data, message_id):
+        chat_id = data.get('chat_id')
+        return {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': int(chat_id), 'type': 'private' if int(chat_id) > 0 else 'group'},
+            'from': BOT_USER,
+            'text': data.get('text', ''),
+        }
+
+    def stop(self):
+        ''' Request interface '''
+
+
+def fake_bot(server):
+    ''' Bot talking to a FakeTelegramServer '''
+    return Bot(FAKE_TOKEN, request=server)
+
+
+def fake_updater(bot):
+    ''' Updater polling the FakeTelegramServer of a fake_bot '''
+    return Updater(bot=bot, use_context=True)
@@ -0,0 +1,51 @@
+''' on disk snapshots of idle instances '''
+import logging
+import os
+import pickle
+import tempfile
+import zlib
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class HibernationStore():
+    '''
+        One file per hibernated instance: zlib compressed pickle of (kind, state)
+        where state is what Instance.save_state() returned.
+        Files are written to a temporary name and renamed, a snapshot is either
+        complete or not there.
+        Only holds a directory path, can be passed to other processes.
+    '''
+    EXTENSION = '.snap'
+
+    def __init__(self, directory=None):
+        self.directory = directory if directory else tempfile.mkdtemp(prefix='hibernation_')
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, inst_id):
+        return os.path.join(self.directory, '{}{}'.format(inst_id, self.EXTENSION))
+
+    def save(self, inst_id, kind, state):
+        data = zlib.compress(pickle.dumps((kind, state), protocol=pickle.HIGHEST_PROTOCOL))
+        path = self._path(inst_id)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as snap:
+            snap.write(data)
+        os.replace(tmp_path, path)
+        return len(data)
+
+    def load(self, inst_id):
+        ''' returns (kind, state), raises OSError if there is no snapshot '''
+        with open(self._path(inst_id), 'rb') as snap:
+            return pickle.loads(zlib.decompress(snap.read()))
+
+    def delete(self, inst_id):
+        try:
+            os.remove(self._path(inst_id))
+        except FileNotFoundError:
+            pass
+
+    def exists(self, inst_id):
+        return os.path.exists(self._path(inst_id))
@@ -2,16 +2,31 @@
 import logging
 
 from multiprocessing import Queue
-from queues import OUTBOUND_MSG_QUEUE, INBOUND_MSG_QUEUE
+import metrics
+from queue import Empty
+from queues import OUTBOUND_MSG_QUEUE, INBOUND_MSG_QUEUE, ROUTING_UPDATES_QUEUE, unbatch
 from misc import StoppableProcess
+from routing_table import publish_register, publish_unregister
 
 from pb_cfg import LOGGER_NAME
 logger = logging.getLogger(LOGGER_NAME)
 
 
 class Instance(StoppableProcess):
+    '''
+        Base class of the game instances.
+        An instance either runs in its own process (start()/stop()) or is
+        hosted, together with many others, by an InstanceHost process which
+        calls on_start(), handle_message() and on_stop() for it.
+        Subclasses implement handle_message() and pass 'hosted' on to this constructor.
+        Subclasses with state of their own extend save_state()/restore_state()
+        so the instance can be hibernated.
+    '''
 
-    def __init__(self, id_,):
+    # Control message: (CTRL_HIBERNATE, HibernationStore) in the input q
+    CTRL_HIBERNATE = 'CTRL_HIBERNATE'
+
+    def __init__(self, id_, hosted=False):
         super().__init__()
 
         self.id_ = id_
@@ -22,15 +37,106 @@ class Instance(StoppableProcess):
             'GAME_CODE': None
         }
 
+        # Keyword arguments of the constructor (besides id_ and hosted), set by
+        # whoever creates the instance. Part of the snapshot, to build it again
+        self.create_kwargs = {}
+
         # Q where the router will put the messages belonging to this instance
-        self.input_msg_q = Queue()
+        # Hosted instances get their messages from the q of their host
+        self.input_msg_q = None if hosted else Queue()
         # Q where outbound messages should be put
         self.inbound_msq_q = INBOUND_MSG_QUEUE
         # Q where inbound/internal messages should be put
         self.outbound_msq_q = OUTBOUND_MSG_QUEUE
+        # Q where changes to find_by are published for the router
+        self.routing_q = ROUTING_UPDATES_QUEUE
+
+    def register(self, chat_ids=(), user_ids=(), game_code=None):
+        '''
+            Make this instance reachable by the given chat ids/user ids/game code
+            Can be called from the instance process, the change is published to the router
+        '''
+        for chat_id in chat_ids:
+            if chat_id not in self.find_by['CHAT_ID']:
+                self.find_by['CHAT_ID'].append(chat_id)
+        for user_id in user_ids:
+            if user_id not in self.find_by['USER_ID']:
+                self.find_by['USER_ID'].append(user_id)
+        if game_code is not None:
+            self.find_by['GAME_CODE'] = game_code
+
+        publish_register(self.routing_q, self.id_,
+                         chat_ids, user_ids, game_code)
+
+    def unregister(self, chat_ids=(), user_ids=(), game_code=None):
+        ''' opposite of register() '''
+        for chat_id in chat_ids:
+            if chat_id in self.find_by['CHAT_ID']:
+                self.find_by['CHAT_ID'].remove(chat_id)
+        for user_id in user_ids:
+            if user_id in self.find_by['USER_ID']:
+                self.find_by['USER_ID'].remove(user_id)
+        if game_code is not None and self.find_by['GAME_CODE'] == game_code:
+            self.find_by['GAME_CODE'] = None
+
+        publish_unregister(self.routing_q, self.id_,
+                           chat_ids, user_ids, game_code)
+
+    def on_start(self):
+        ''' called in the process running the instance before its first message (also after a wake up) '''
+
+    def on_stop(self):
+        ''' called in the process running the instance after its last message (also before hibernating) '''
+
+    def save_state(self):
+        ''' picklable snapshot of the instance, the queues are not part of it '''
+        return {'find_by': self.find_by, 'create_kwargs': self.create_kwargs}
+
+    def restore_state(self, state):
+        '''
+            opposite of save_state, called on a freshly constructed instance
+            (constructed with state['create_kwargs'], see create_kwargs_of)
+        '''
+        self.find_by = state['find_by']
+        self.create_kwargs = create_kwargs_of(state)
+
+    def hibernate(self, store):
+        ''' save a snapshot in a HibernationStore, returns its size in bytes '''
+        return store.save(self.id_, type(self), self.save_state())
+
+    def handle_message(self, msg):
+        ''' process one message routed to this instance, to be implemented by child class '''
 
     def _run(self):
-        pass
+        self.on_start()
+        while True:
+
+            if self.should_stop():
+                break
+
+            try:
+                msg = self.input_msg_q.get(timeout=1)
+            except Empty:
+                continue
+
+            if type(msg) is tuple and msg[0] == self.CTRL_HIBERNATE:
+                self.on_stop()
+                self.hibernate(msg[1])
+                # The process is done, the instance manager starts a new one on wake up
+                return
+
+            # The router hands over lists when it routed several messages at once
+            start = None
+            for one_msg in unbatch(msg):
+                start = metrics.handle_timed(self.handle_message, one_msg, one_msg, start)
+
+        self.on_stop()
+
+
+def create_kwargs_of(state):
+    ''' keyword arguments to construct the instance a snapshot was taken of '''
+    # Snapshots taken before the kwargs were part of them
+    return state.get('create_kwargs', {})
 
 
 def main():
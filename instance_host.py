@@ -0,0 +1,237 @@
+''' processes hosting many game instances each '''
+import logging
+
+from multiprocessing import Queue, Value
+from queue import Empty
+
+import metrics
+from instance import create_kwargs_of
+from misc import StoppableProcess
+from queues import unbatch
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class InstanceHost(StoppableProcess):
+    '''
+        Process running many instances cooperatively.
+        Instances are created inside the host and get their messages one at a
+        time through the host input q, tagged with their instance id.
+        Creating an instance is only a put() in that q, no new process.
+        Hibernated instances are woken up by OP_WAKE, or by the first message
+        that reaches them, whatever comes first.
+    '''
+    OP_CREATE = 0
+    OP_DESTROY = 1
+    OP_MSG = 2
+    OP_HIBERNATE = 3
+    OP_WAKE = 4
+    OP_STOP = 5
+
+    def __init__(self, id_, jobs_q=None):
+        '''
+            jobs_q -> job q of the InstanceManager, told about the instances the host
+                        could not create ({'op': 'CREATE_FAILED', 'ARGS': (inst_id,)})
+        '''
+        super().__init__()
+
+        self.id_ = id_
+        self._jobs_q = jobs_q
+
+        # (OP_*, instance id, ...) items
+        self.input_msg_q = Queue()
+
+        # Number of instances placed in this host, kept by the InstanceManager
+        self.load = 0
+        # Number of instances really running, kept by the host process
+        self.running = Value('i', 0)
+
+    def create(self, inst_id, kind, kwargs, state=None, staged=None):
+        '''
+            ask the host to create an instance, returns the handle for the main process
+            state -> what Instance.save_state() returned, to resume a saved instance
+            staged -> (StateStore, key) of the staged snapshot state comes from,
+                        deleted by the host once the instance is created
+        '''
+        self.input_msg_q.put((self.OP_CREATE, inst_id, kind, kwargs, state, staged))
+        self.load += 1
+        handle = HostedInstance(inst_id, self)
+        if state is not None:
+            handle.find_by = state['find_by']
+        return handle
+
+    def stop(self):
+        # Everything already in the q (eg. hibernations on shutdown) is handled first
+        self.input_msg_q.put((self.OP_STOP, None))
+        return super().stop()
+
+    def destroy(self, inst_id):
+        ''' ask the host to stop and forget an instance '''
+        self.input_msg_q.put((self.OP_DESTROY, inst_id))
+        self.load -= 1
+
+    def hibernate(self, inst_id, store):
+        ''' ask the host to snapshot an instance in a HibernationStore and release it '''
+        self.input_msg_q.put((self.OP_HIBERNATE, inst_id, store))
+        self.load -= 1
+
+    def wake(self, inst_id, store):
+        ''' ask the host to restore an instance from a HibernationStore '''
+        self.input_msg_q.put((self.OP_WAKE, inst_id, store))
+        self.load += 1
+
+    def _run(self):
+
+        # instance id -> instance
+        instances = {}
+        # instance id -> HibernationStore holding its snapshot
+        hibernated = {}
+
+        while True:
+
+            try:
+                item = self.input_msg_q.get(timeout=1)
+            except Empty:
+                if self.should_stop():
+                    break
+                continue
+
+            op, inst_id = item[0], item[1]
+
+            if op == self.OP_STOP:
+                break
+
+            elif op == self.OP_MSG:
+                inst = instances.get(inst_id)
+                if inst is None and inst_id in hibernated:
+                    # Message raced with the hibernation, wake the instance up here
+                    inst = self._wake(instances, inst_id, hibernated.pop(inst_id))
+                if inst is None:
+                    logger.error('Host {} has no instance {}'.format(self.id_, inst_id))
+                    continue
+                start = None
+                for msg in unbatch(item[2]):
+                    # None (a new stamp) after a failure
+                    start = self._call(inst, metrics.handle_timed, inst.handle_message, msg, msg, start)
+
+            elif op == self.OP_CREATE:
+                kind, kwargs, state, staged = item[2], item[3], item[4], item[5]
+                try:
+                    inst = kind(inst_id, hosted=True, **kwargs)
+                    inst.create_kwargs = kwargs
+                    if state is not None:
+                        inst.restore_state(state)
+                except Exception as ex:
+                    logger.error('Failed to create instance of {} because of {}'.format(
+                        kind.__name__, ex))
+                    # The manager already handed out the id, it has to release it
+                    if self._jobs_q is not None:
+                        self._jobs_q.put({'op': 'CREATE_FAILED', 'ARGS': (inst_id,)})
+                    continue
+                if staged is not None:
+                    store, key = staged
+                    store.delete_staged(key)
+                instances[inst_id] = inst
+                self.running.value = len(instances)
+                self._call(inst, inst.on_start)
+
+            elif op == self.OP_DESTROY:
+                inst = instances.pop(inst_id, None)
+                self.running.value = len(instances)
+                if inst is not None:
+                    self._call(inst, inst.on_stop)
+                store = hibernated.pop(inst_id, None)
+                if store is not None:
+                    store.delete(inst_id)
+
+            elif op == self.OP_HIBERNATE:
+                inst = instances.pop(inst_id, None)
+                self.running.value = len(instances)
+                if inst is None:
+                    continue
+                self._call(inst, inst.on_stop)
+                store = item[2]
+                self._call(inst, inst.hibernate, store)
+                hibernated[inst_id] = store
+
+            elif op == self.OP_WAKE:
+                store = hibernated.pop(inst_id, None)
+                if store is not None:
+                    self._wake(instances, inst_id, store)
+
+            else:
+                logger.error('Queue item with incorrect format {}'.format(item))
+
+        for inst in instances.values():
+            self._call(inst, inst.on_stop)
+
+    def _wake(self, instances, inst_id, store):
+        ''' rebuild an instance from its snapshot, None if it failed '''
+        try:
+            kind, state = store.load(inst_id)
+            inst = kind(inst_id, hosted=True, **create_kwargs_of(state))
+            inst.restore_state(state)
+        except Exception as ex:
+            logger.error('Failed to wake up instance {} because of {}'.format(inst_id, ex))
+            return None
+        store.delete(inst_id)
+
+        instances[inst_id] = inst
+        self.running.value = len(instances)
+        self._call(inst, inst.on_start)
+        return inst
+
+    def _call(self, inst, func, *args):
+        ''' one failing instance must not take the whole host down, returns what func returned '''
+        try:
+            return func(*args)
+        except Exception as ex:
+            logger.exception('Instance {} failed: {}'.format(inst.id_, ex))
+
+
+class _HostedInputQ():
+    ''' what the router sees as input_msg_q of a hosted instance '''
+    __slots__ = ('_host_q', '_inst_id')
+
+    def __init__(self, host_q, inst_id):
+        self._host_q = host_q
+        self._inst_id = inst_id
+
+    def put(self, msg):
+        self._host_q.put((InstanceHost.OP_MSG, self._inst_id, msg))
+
+
+class HostedInstance():
+    '''
+        Stand in, in the main process, for an instance running in an InstanceHost.
+        Quacks like an Instance for the InstanceManager and the Router.
+    '''
+
+    def __init__(self, id_, host):
+        self.id_ = id_
+        self.host = host
+        self.find_by = {
+            'CHAT_ID': [],
+            'USER_ID': [],
+            'GAME_CODE': None
+        }
+        self.input_msg_q = _HostedInputQ(host.input_msg_q, id_)
+
+    def stop(self):
+        self.host.destroy(self.id_)
+        return True
+
+    def request_hibernate(self, store):
+        self.host.hibernate(self.id_, store)
+
+    def request_wake(self, store):
+        self.host.wake(self.id_, store)
+
+    def terminate(self):
+        # Never kill the host for one of its instances
+        pass
+
+    def get_name(self):
+        return 'instance {} in host {}'.format(self.id_, self.host.id_)
@@ -1,12 +1,18 @@
 ''' manage instance creation/destruction '''
 import logging
 
+import time
+
 from misc import StoppableThread
 from queue import Empty
 from threading import Thread
 from multiprocessing import Queue
-from instance import Instance
-from master_instance import MasterInstance
+from instance import Instance, create_kwargs_of
+from instance_host import InstanceHost, HostedInstance
+from hibernation import HibernationStore
+from master_instance import MasterInstance, master_shard_of
+from routing_table import RoutingTable
+from slot_allocator import SlotAllocator
 from pb_cfg import LOGGER_NAME
 
 
@@ -16,14 +22,57 @@ logger = logging.getLogger(LOGGER_NAME)
 class InstanceManager(StoppableThread):
     ''' manage instance creation/destruction '''
 
-    def __init__(self, max_instances=10):
+    # Seconds an instance process gets to save its snapshot on stop
+    SAVE_TIMEOUT = 5
+
+    def __init__(self, max_instances=4096, initial_instances=16, hosts=0,
+                 hibernate_after=None, hibernation_dir=None, master_shards=1, state_store=None):
+        '''
+            max_instances       -> max number of instances alive at the same time
+            initial_instances   -> slots allocated upfront, grown on demand up to max_instances
+            hosts               -> number of InstanceHost processes to run the instances in
+                                    0 to give each instance its own process
+            hibernate_after     -> seconds without messages after which an instance is
+                                    snapshot to disk and its resources released. None to disable
+            hibernation_dir     -> where to keep the snapshots (temporary directory if None)
+            master_shards       -> number of master instance processes. Messages for the
+                                    master are spread by chat id, a chat always gets the same shard
+            state_store         -> StateStore keeping the master sessions and the instance snapshots
+                                    (hibernated ones too) across restarts. None to lose them on stop
+        '''
         super().__init__()
 
-        self._active_instances = [None for x in range(max_instances)]
+        # Instance ids are handed out by the allocator, _active_instances is indexed by slot
+        self._slots = SlotAllocator(initial_instances, max_instances)
+        self._active_instances = [None for x in range(self._slots.capacity)]
+
+        # chat id / user id / game code -> instance ids
+        # Also fed by the instance processes themselves
+        self.routing = RoutingTable()
+
+        # Hibernation of idle instances
+        self._hibernate_after = hibernate_after
+        self._state_store = state_store
+        if state_store is not None:
+            self._hibernation = state_store
+        else:
+            self._hibernation = HibernationStore(hibernation_dir) \
+                if hibernate_after is not None else None
+        # instance id -> time.monotonic() of its last message
+        self._last_activity = {}
+        self._last_idle_check = time.monotonic()
+        self._hibernated = set()
+        # Wake ups requested but not done yet
+        self._waking = set()
 
         self._pending_jobs = Queue()
 
-        self._master_instance = MasterInstance("Master Instance")
+        # Pre-forked processes running the instances, started with the manager
+        self._hosts = [InstanceHost(idx, self._pending_jobs) for idx in range(hosts)]
+
+        shards = max(1, master_shards)
+        self._master_instances = [MasterInstance("Master Instance {}".format(idx), idx, shards, state_store)
+                                  for idx in range(shards)]
 
     def create_instance(self, kind: Instance, created_callback=None, **kwargs):
         ''' 
@@ -44,71 +93,186 @@ class InstanceManager(StoppableThread):
         op = {'op': 'DESTROY', 'ARGS': (inst_id, destroyed_callback)}
         self._pending_jobs.put(op)
 
+    @property
+    def jobs_q(self):
+        ''' q of the pending jobs, consumed by the thread or by handle_job() '''
+        return self._pending_jobs
+
+    @property
+    def idle_check_interval(self):
+        ''' seconds between two looks for idle instances, None if they don't hibernate '''
+        if self._hibernate_after is None:
+            return None
+        # No need to look more often than a fraction of the threshold
+        return max(1, self._hibernate_after / 4)
+
     def start(self):
         super().start()
-        self._master_instance.start()
+        self.routing.start()
+        self.start_processes()
+
+    def start_processes(self, master=True):
+        '''
+            start the processes of the manager: instance hosts and master instance
+            master  -> False when the master instance is run by someone else (eg. AsyncRuntime)
+        '''
+        if master:
+            for master_instance in self._master_instances:
+                master_instance.start()
+        for host in self._hosts:
+            host.start()
+        self._resume_instances()
 
     def _run(self):
         while True:
 
             # If we should stop, stop all child processes first
             if self.should_stop():
-                self._stop_all_instances()
+                self.stop_instances()
                 break
 
             try:
                 item = self._pending_jobs.get(timeout=1)
             except Empty:
+                item = None
+
+            if self._hibernate_after is not None:
+                self.hibernate_idle_instances()
+
+            if item is None:
                 continue
 
-            if item and 'CREATE' in item:
-                kind, callback, kwargs = item['ARGS']
-                inst_id = self._create_instance(kind, **kwargs)
+            self.handle_job(item)
 
-                # Do the callback
-                # TODO not sure if this will work since garbage collection maybe kills the thread ??
-                Thread(target=callback, args=(inst_id)).start()
+    def handle_job(self, item):
+        ''' execute one item of the pending job queue '''
 
-            elif item and 'DESTROY' in item:
-                inst_id, callback = item['ARGS']
-                self._destroy_instance(inst_id)
+        if item.get('op') == 'WAKE':
+            inst_id, = item['ARGS']
+            self._wake_instance(inst_id)
 
-                # Do the callback
-                # TODO not sure if this will work since garbage collection maybe kills the thread ??
+        elif item.get('op') == 'CREATE':
+            kind, callback, kwargs = item['ARGS']
+            inst_id = self._create_instance(kind, **kwargs)
+
+            # Do the callback
+            # TODO not sure if this will work since garbage collection maybe kills the thread ??
+            if callback:
+                Thread(target=callback, args=(inst_id,)).start()
+
+        elif item.get('op') == 'CREATE_FAILED':
+            inst_id, = item['ARGS']
+            self._release_failed_instance(inst_id)
+
+        elif item.get('op') == 'DESTROY':
+            inst_id, callback = item['ARGS']
+            self._destroy_instance(inst_id)
+
+            # Do the callback
+            # TODO not sure if this will work since garbage collection maybe kills the thread ??
+            if callback:
                 Thread(target=callback).start()
-            else:
-                logger.error(
-                    'Queue item with incorrect format {}'.format(item))
+        else:
+            logger.error(
+                'Queue item with incorrect format {}'.format(item))
 
-    def _create_instance(self, kind: Instance, **kwargs):
+    def _create_instance(self, kind: Instance, state=None, staged=None, **kwargs):
         ''' 
             Create an instance of type kind 
+            state -> what Instance.save_state() returned, to resume a saved instance
+            staged -> key of the staged snapshot state comes from, deleted from the
+                        state store once the instance is created
             Returns the instance id of new instance
             None if could not create    
         '''
 
-        empty_slot = self.get_next_free_instance_slot()
+        inst_id = self._slots.acquire()
 
-        if empty_slot is None:
+        if inst_id is None:
             logger.info(
                 'Could not create instance since all instance slots are full')
             return None
 
+        slot = self._slots.slot_of(inst_id)
+        if slot >= len(self._active_instances):
+            # The allocator grew
+            self._active_instances.extend(
+                [None] * (self._slots.capacity - len(self._active_instances)))
+
+        # Known to the routing table before the instance runs, the registrations
+        # it sends from its own process would be ignored otherwise
+        self.routing.add_instance(inst_id)
+
         try:
             # Create new instance
-            self._active_instances[empty_slot] = kind(
-                empty_slot, **kwargs)
+            if self._hosts:
+                # In the least loaded host
+                host = min(self._hosts, key=lambda h: h.load)
+                inst = host.create(inst_id, kind, kwargs, state,
+                                   (self._state_store, staged) if staged is not None else None)
+            else:
+                inst = kind(inst_id, **kwargs)
+                inst.create_kwargs = kwargs
+                if state is not None:
+                    inst.restore_state(state)
+                inst.start()
+                if staged is not None:
+                    self._state_store.delete_staged(staged)
         except Exception as ex:
             logger.error('Failed to create instance of {} because of {}'.format(
                 type(kind).__name__, ex))
-            self._active_instances[empty_slot] = None
+            self.routing.drop_instance(inst_id)
+            self._slots.release(inst_id)
             return None
 
-        return empty_slot
+        self._active_instances[slot] = inst
+        self._last_activity[inst_id] = time.monotonic()
+
+        # Index whatever the instance was created with
+        self.register_member(inst_id,
+                             chat_ids=inst.find_by['CHAT_ID'],
+                             user_ids=inst.find_by['USER_ID'],
+                             game_code=inst.find_by['GAME_CODE'])
+
+        return inst_id
+
+    def _release_failed_instance(self, inst_id):
+        ''' the host of inst_id could not create it, forget its handle and free its slot '''
+        inst = self.get(inst_id)
+        if inst is None:
+            return
+
+        logger.error('Releasing instance {}, {} could not create it'.format(inst_id, inst.get_name()))
+        self.routing.drop_instance(inst_id)
+        self._active_instances[self._slots.slot_of(inst_id)] = None
+        self._slots.release(inst_id)
+        self._last_activity.pop(inst_id, None)
+        self._hibernated.discard(inst_id)
+        self._waking.discard(inst_id)
+        inst.host.load -= 1
 
     def _destroy_instance(self, inst_id):
 
-        inst = self._active_instances[inst_id]
+        inst = self.get(inst_id)
+        if inst is None:
+            logger.error('No instance with id {}'.format(inst_id))
+            return
+
+        self.routing.drop_instance(inst_id)
+        self._active_instances[self._slots.slot_of(inst_id)] = None
+        self._slots.release(inst_id)
+        self._last_activity.pop(inst_id, None)
+
+        if inst_id in self._hibernated:
+            self._hibernated.discard(inst_id)
+            self._waking.discard(inst_id)
+            if isinstance(inst, HostedInstance):
+                # The host forgets the snapshot
+                inst.stop()
+            else:
+                # The process already exited when it hibernated
+                self._hibernation.delete(inst_id)
+            return
 
         if not inst.stop():
             logger.error(
@@ -118,65 +282,220 @@ class InstanceManager(StoppableThread):
 
             inst.terminate()
 
-    def _stop_all_instances(self):
-        ''' attempt to stop all instances '''
+    def stop_instances(self, master=True):
+        '''
+            attempt to stop all instances
+            master  -> False if the master instance was not started as a process
+        '''
 
-        if not self._master_instance.stop():
-            logger.error('Failed to gracefully master instance')
-            logger.error('Attempting to kill it')
-            self._master_instance.terminate()
+        for master_instance in self._master_instances if master else ():
+            if not master_instance.stop():
+                logger.error('Failed to gracefully stop {}'.format(master_instance.id_))
+                logger.error('Attempting to kill it')
+                master_instance.terminate()
 
-        for (idx, inst) in enumerate(self._active_instances):
-            if inst:
-                logger.info('Stopping instance {} ...'.format(idx))
-                # TODO inst.save_state()
-                self._destroy_instance(idx)
-                inst = None
+        for inst in self._active_instances[:]:
+            if not inst:
+                continue
+            if self._state_store is not None:
+                # Resumed by the next start
+                logger.info('Saving instance {} ...'.format(inst.id_))
+                self._save_instance(inst)
+            else:
+                logger.info('Stopping instance {} ...'.format(inst.id_))
+                self._destroy_instance(inst.id_)
+
+        for host in self._hosts:
+            if not host.stop():
+                logger.error('Failed to gracefully stop host {}'.format(host.id_))
+                host.terminate()
+
+        if self.routing.is_running():
+            self.routing.stop()
+
+    def _save_instance(self, inst):
+        ''' snapshot an instance in the state store and stop it '''
+        inst_id = inst.id_
+        self.routing.drop_instance(inst_id)
+        self._active_instances[self._slots.slot_of(inst_id)] = None
+        self._slots.release(inst_id)
+        self._last_activity.pop(inst_id, None)
+
+        if inst_id in self._hibernated:
+            # Its snapshot is already in the state store
+            self._hibernated.discard(inst_id)
+            self._waking.discard(inst_id)
+            return
+
+        if isinstance(inst, HostedInstance):
+            # The host handles it before stopping
+            inst.request_hibernate(self._state_store)
+            return
+
+        # Saves the snapshot and exits the instance process
+        inst.input_msg_q.put((Instance.CTRL_HIBERNATE, self._state_store))
+        inst._process.join(self.SAVE_TIMEOUT)
+        if inst._process.exitcode is None:
+            logger.error('Instance {} did not save its state in time'.format(inst_id))
+            inst.terminate()
 
-    def send_to_master_instance(self, msg):
-        ''' getter for master instance '''
-        return self._master_instance.input_msg_q.put(msg)
+    def _resume_instances(self):
+        ''' recreate the instances saved in the state store by the previous run '''
+        if self._state_store is None:
+            return
 
-    def get_next_free_instance_slot(self):
-        ''' Find the next available instance slot '''
-        for idx, content in enumerate(self._active_instances):
-            if not content:
-                return idx
+        # The ids of the previous run mean nothing now, the instances get new ones
+        resumed = 0
+        for key in self._state_store.stage_instances():
+            try:
+                kind, state = self._state_store.load_staged(key)
+            except Exception as ex:
+                logger.error('Dropping unreadable snapshot {} because of {}'.format(key, ex))
+                self._state_store.delete_staged(key)
+                continue
 
-        return None
+            # The snapshot is only deleted once the instance exists again,
+            # otherwise the next start tries again
+            if self._create_instance(kind, state=state, staged=key, **create_kwargs_of(state)) is None:
+                logger.error('Could not resume an instance of {}'.format(kind.__name__))
+            else:
+                resumed += 1
+
+        if resumed:
+            logger.info('Resumed {} instances'.format(resumed))
+
+    def touch(self, inst_id):
+        ''' an instance just got a message, called by the router '''
+        self._last_activity[inst_id] = time.monotonic()
+
+    def is_active(self, inst_id):
+        ''' False if the instance is hibernated '''
+        return inst_id not in self._hibernated
+
+    def wake_instance(self, inst_id):
+        ''' ask for a hibernated instance to be restored, can be called from any thread '''
+        if inst_id in self._hibernated and inst_id not in self._waking:
+            self._waking.add(inst_id)
+            self._pending_jobs.put({'op': 'WAKE', 'ARGS': (inst_id,)})
+
+    def hibernate_idle_instances(self):
+        ''' hibernate the instances without messages for more than hibernate_after seconds '''
+        now = time.monotonic()
+        if now - self._last_idle_check < self.idle_check_interval:
+            return
+        self._last_idle_check = now
+
+        for (inst_id, last) in list(self._last_activity.items()):
+            if now - last > self._hibernate_after and inst_id not in self._hibernated:
+                self._hibernate_instance(inst_id)
+
+    def _hibernate_instance(self, inst_id):
+        inst = self.get(inst_id)
+        if inst is None:
+            return
+
+        logger.debug('Hibernating idle instance %s', inst_id)
+        # From now on the router will ask for a wake up instead of dispatching
+        self._hibernated.add(inst_id)
+
+        if isinstance(inst, HostedInstance):
+            inst.request_hibernate(self._hibernation)
+        else:
+            # Saves the snapshot and exits the instance process
+            inst.input_msg_q.put((Instance.CTRL_HIBERNATE, self._hibernation))
+
+    def _wake_instance(self, inst_id):
+        inst = self.get(inst_id)
+        self._waking.discard(inst_id)
+        if inst is None or inst_id not in self._hibernated:
+            return
+
+        logger.debug('Waking up instance %s', inst_id)
+
+        if isinstance(inst, HostedInstance):
+            # Snapshot and wake up are handled in order by the host
+            inst.request_wake(self._hibernation)
+        else:
+            # Make sure the old process is done writing the snapshot
+            inst._process.join(2)
+            try:
+                kind, state = self._hibernation.load(inst_id)
+                woken = kind(inst_id, **create_kwargs_of(state))
+                woken.restore_state(state)
+            except Exception as ex:
+                logger.error('Failed to wake up instance {} because of {}'.format(inst_id, ex))
+                return
+            self._hibernation.delete(inst_id)
+            # Messages put after the hibernation request are still in the old q
+            woken.input_msg_q = inst.input_msg_q
+            woken.start()
+            self._active_instances[self._slots.slot_of(inst_id)] = woken
+
+        self._hibernated.discard(inst_id)
+        self._last_activity[inst_id] = time.monotonic()
 
-    def chat_id_to_instance_id(self, chat_id):
-        ''' given a chat id find the matching instance id '''
+    def send_to_master_instance(self, msg):
+        ''' send a task to the master shard in charge of its chat '''
+        rx_item = msg.get('msg')
+        key = rx_item.chat_id if rx_item is not None and rx_item.chat_id is not None \
+            else getattr(rx_item, 'user_id', None)
+        return self.get_master_instance(self.master_shard_of(key)).input_msg_q.put(msg)
+
+    def master_shard_of(self, chat_id):
+        ''' index of the master shard handling chat_id '''
+        return master_shard_of(chat_id, len(self._master_instances))
+
+    def get_master_instance(self, shard=0):
+        return self._master_instances[shard]
+
+    def get_master_instances(self):
+        return list(self._master_instances)
+
+    def master_session_counts(self):
+        ''' number of onboarding sessions alive in each master shard '''
+        return [master_instance.session_count.value for master_instance in self._master_instances]
+
+    def queue_depths(self):
+        ''' dict queue name -> depth of the input qs of the masters, hosts or instances, for the MetricsServer '''
+        depths = {'master_{}'.format(idx): master_instance.input_msg_q.qsize()
+                  for (idx, master_instance) in enumerate(self._master_instances)}
+        if self._hosts:
+            depths.update(('host_{}'.format(host.id_), host.input_msg_q.qsize()) for host in self._hosts)
+            return depths
+        for inst in self._active_instances:
+            if inst is not None and inst.id_ not in self._hibernated:
+                depths['instance_{}'.format(inst.id_)] = inst.input_msg_q.qsize()
+        return depths
+
+    def register_member(self, inst_id, chat_ids=(), user_ids=(), game_code=None):
+        '''
+            make an instance reachable by the given chat ids, user ids and/or game code
+            For the main process, instances publish their own changes with Instance.register()
+        '''
+        self.routing.register(inst_id, chat_ids, user_ids, game_code)
 
-        matches = []
-        for inst in self._active_instances[:]:
-            if inst and chat_id in inst.find_by['CHAT_ID']:
-                matches += inst.id_
+    def unregister_member(self, inst_id, chat_ids=(), user_ids=(), game_code=None):
+        ''' opposite of register_member '''
+        self.routing.unregister(inst_id, chat_ids, user_ids, game_code)
 
-        return matches
+    def chat_id_to_instance_id(self, chat_id):
+        ''' given a chat id find the matching instance ids '''
+        return list(self.routing.by_chat_id(chat_id))
 
     def user_id_to_instance_id(self, user_id):
-        ''' given a user id find the matching instance id '''
-
-        matches = []
-        for inst in self._active_instances[:]:
-            if inst and user_id in inst.find_by['USER_ID']:
-                matches += inst.id_
-
-        return matches
+        ''' given a user id find the matching instance ids '''
+        return list(self.routing.by_user_id(user_id))
 
     def game_code_to_instance_id(self, game_code):
-        ''' given a game code find the matching instance id '''
-
-        matches = []
-        for inst in self._active_instances[:]:
-            if inst and game_code == inst.find_by['GAME_CODE']:
-                matches += inst.id_
-
-        return matches
+        ''' given a game code find the matching instance ids '''
+        return list(self.routing.by_game_code(game_code))
 
     def get(self, inst_id):
-        return self._active_instances[inst_id]
+        ''' instance with id inst_id, None if it does not exist (anymore) '''
+        slot = self._slots.slot_of(inst_id)
+        if slot is None:
+            return None
+        return self._active_instances[slot]
 
 
 instanceManager = InstanceManager()
@@ -0,0 +1,99 @@
+''' logging of every process through one writer thread '''
+import logging
+import multiprocessing as mp
+import os
+
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
+
+import coloredlogs
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+LOG_FORMAT = '%(asctime)s %(levelname)-5s %(lineno)-4d:%(filename)-30s - %(message)s'
+
+# Records of every process go through this q to the QueueListener of the main process
+# Created at import like the message queues, the forked processes inherit it
+LOG_QUEUE = mp.Queue()
+
+# Arguments that can't change before the listener formats the record
+_IMMUTABLE_ARGS = (str, int, float, bytes, type(None))
+
+
+class ProcessAwareQueueHandler(QueueHandler):
+    '''
+        In the process which installed it, records go as they are to a local q:
+        the message is only formatted by the listener thread, unless an argument
+        is mutable (eg. an update dict), it could change before the listener gets to it.
+        In the processes forked afterwards they go to LOG_QUEUE, formatted
+        beforehand as their arguments may not survive pickling.
+    '''
+
+    def __init__(self, local_q, process_q):
+        super().__init__(process_q)
+        self.local_q = local_q
+        self.pid = os.getpid()
+
+    def emit(self, record):
+        if os.getpid() != self.pid:
+            super().emit(record)
+            return
+        try:
+            if record.args and (type(record.args) is not tuple
+                                or not all(isinstance(arg, _IMMUTABLE_ARGS) for arg in record.args)):
+                # Rendered as it is now
+                record.msg = record.getMessage()
+                record.args = None
+            self.local_q.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class _Listeners():
+    ''' the listeners of the local q and of LOG_QUEUE, started and stopped together '''
+
+    def __init__(self, *listeners):
+        self._listeners = listeners
+
+    def start(self):
+        for listener in self._listeners:
+            listener.start()
+
+    def stop(self):
+        for listener in self._listeners:
+            listener.stop()
+
+
+def install(level=logging.DEBUG, fmt=LOG_FORMAT, handlers=None):
+    '''
+        Send the records of LOGGER_NAME to LOG_QUEUE and start the listener writing them
+        Returns a listener, stop() it once everything else is stopped.
+        To be called in the main process before starting the other processes:
+        they inherit the handler and only pay for formatting and pickling the
+        records they emit, writing happens in the listener threads.
+        level       -> records below it are discarded by the logger itself, the
+                        lazy %s arguments of the discarded calls are never formatted
+        fmt         -> format of the default coloredlogs console handler
+        handlers    -> handlers used by the listener instead of the console one
+    '''
+    if handlers is None:
+        console = logging.StreamHandler()
+        console.setFormatter(coloredlogs.ColoredFormatter(fmt=fmt))
+        handlers = [console]
+
+    local_q = SimpleQueue()
+    listener = _Listeners(QueueListener(local_q, *handlers, respect_handler_level=True),
+                          QueueListener(LOG_QUEUE, *handlers, respect_handler_level=True))
+
+    for handler in list(logger.handlers):
+        logger.removeHandler(handler)
+    logger.addHandler(ProcessAwareQueueHandler(local_q, LOG_QUEUE))
+    logger.setLevel(level)
+    # The listener handlers are the only output, nothing goes up to the root logger
+    logger.propagate = False
+
+    listener.start()
+    return listener
+
@@ -2,58 +2,121 @@
 
 
 import logging
+import secrets
+import sys
 import time
 
-import coloredlogs
-
 from queues import INBOUND_MSG_QUEUE, OUTBOUND_MSG_QUEUE
 from telegram_abstraction_layer import TelegramAbstractionLayer
 from instance_manager import InstanceManager
 from router import Router
-
-
-from pb_cfg import LOGGER_NAME
+from async_runtime import AsyncRuntime
+import log_pipeline
+import metrics
+import tracing
+from metrics import MetricsServer, core_queue_depths
+from state_store import StateStore
+from update_log import UpdateRecorder
+from webhook import WebhookReceiver
+
+
+from pb_cfg import LOGGER_NAME, LOG_LEVEL, METRICS_LISTEN, RECORD_UPDATES_PATH, STATE_DB_PATH, \
+    TRACE_DUMP_PATH, TRACE_SAMPLE_RATE, WEBHOOK_LISTEN, WEBHOOK_URL
 from pvt_cfg import TELEGRAM_API_TOKEN
 
 
 logger = logging.getLogger(LOGGER_NAME)
 
 
-def main():
+def make_tal():
+    ''' telegram abstraction layer, polling unless a webhook url is configured '''
+    recorder = UpdateRecorder(RECORD_UPDATES_PATH) if RECORD_UPDATES_PATH else None
+    if WEBHOOK_URL:
+        host, port = WEBHOOK_LISTEN
+        # Registered with set_webhook on every start, the posts without it are refused
+        secret_token = secrets.token_urlsafe(32)
+        return TelegramAbstractionLayer(TELEGRAM_API_TOKEN,
+                                        webhook=WebhookReceiver(host, port, secret_token=secret_token),
+                                        webhook_url=WEBHOOK_URL,
+                                        recorder=recorder)
+    return TelegramAbstractionLayer(TELEGRAM_API_TOKEN, recorder=recorder)
+
+
+def start_metrics(tal, im, rtr):
+    ''' serve the metrics of the whole pipeline, None if not configured '''
+    if not METRICS_LISTEN:
+        return None
+    host, port = METRICS_LISTEN
+    server = MetricsServer(host, port, queue_depths=(
+        core_queue_depths, tal.queue_depths, im.queue_depths, rtr.queue_depths))
+    server.start()
+    return server
+
+
+def main(use_asyncio=False):
+    '''
+        use_asyncio -> run router, instance manager, master instance and sender
+                       as tasks of one asyncio loop instead of threads/processes
+    '''
 
     if INBOUND_MSG_QUEUE is None or OUTBOUND_MSG_QUEUE is None:
         raise "Queues not running"
 
+    if use_asyncio:
+        return main_asyncio()
+
     # Start the telegram abstraction layer
-    tal = TelegramAbstractionLayer(TELEGRAM_API_TOKEN)
+    tal = make_tal()
     tal.start()
 
-    # Start the instance manager
-    im = InstanceManager()
+    # Start the instance manager, resuming what the previous run saved
+    im = InstanceManager(state_store=StateStore(STATE_DB_PATH))
     im.start()
 
     # Start the router
     rtr = Router(im)
     rtr.start()
 
+    metrics_server = start_metrics(tal, im, rtr)
+
     try:
         while True:
             time.sleep(1)
     finally:
+        if metrics_server is not None:
+            metrics_server.stop()
         rtr.stop()
         im.stop()
         tal.stop()
 
 
-if __name__ == '__main__':
-    # logger.setLevel(level=logging.DEBUG)
-    # console_log = logging.StreamHandler()
-    # formatter = logging.Formatter(
-    #     '%(asctime)s %(levelname)s %(lineno)d:%(filename)s(%(process)d) - %(message)s')
+def main_asyncio():
+
+    # The sender runs in the loop, only start the updater
+    tal = make_tal()
+    tal.start(sender=False)
+
+    im = InstanceManager(state_store=StateStore(STATE_DB_PATH))
+    rtr = Router(im)
+
+    runtime = AsyncRuntime(tal, im, rtr)
+    metrics_server = start_metrics(tal, im, rtr)
+    try:
+        runtime.run()
+    finally:
+        if metrics_server is not None:
+            metrics_server.stop()
+        tal.stop()
 
-    coloredlogs.install(level='DEBUG', logger=logger,
-                        fmt='%(asctime)s %(levelname)-5s %(lineno)-4d:%(filename)-30s - %(message)s')
 
-    # console_log.setFormatter(formatter)
-    # logger.addHandler(console_log)
-    main()
+if __name__ == '__main__':
+    # Every process logs through the queue of the listener started here
+    log_listener = log_pipeline.install(level=LOG_LEVEL)
+    # Before any process is started, they all answer the dump signal
+    tracing.install(TRACE_SAMPLE_RATE, TRACE_DUMP_PATH)
+    # Nothing recorded if nothing serves it
+    metrics.install(enabled=bool(METRICS_LISTEN))
+    try:
+        main(use_asyncio='--asyncio' in sys.argv)
+    finally:
+        log_listener.stop()
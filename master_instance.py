@@ -3,10 +3,14 @@
 import logging
 import time
 
+from functools import partial
+from multiprocessing import Value
 from queue import Empty
+import metrics
 from queues import RxQItem, TxQItem
 from instance import Instance
 from session import SelectGameSession
+from timer_wheel import TimerWheel
 
 from misc import get_chat_id_from_update
 
@@ -15,6 +19,11 @@ from pb_cfg import LOGGER_NAME
 logger = logging.getLogger(LOGGER_NAME)
 
 
+def master_shard_of(chat_id, shards):
+    ''' index of the master shard in charge of chat_id '''
+    return hash(chat_id) % shards
+
+
 class MasterInstance(Instance):
     '''
         Master Instance
@@ -26,48 +35,121 @@ class MasterInstance(Instance):
     TASK_HANDLE_NEW_USER = 0
     TASK_CREATE_NEW_INSTANCE = 1
 
-    def __init__(self, id_):
+    def __init__(self, id_, shard=0, shards=1, state_store=None):
+        '''
+            shard, shards   -> this master handles the chats for which master_shard_of() is shard
+            state_store     -> StateStore where the sessions are saved, None to keep them in memory only
+        '''
         super().__init__(id_)
         self.sessions = {}
 
+        self.shard = shard
+        self.shards = shards
+        self.state_store = state_store
+
+        # Number of live sessions, readable from the main process
+        self.session_count = Value('i', 0, lock=False)
+
+        # chat_id -> session timeout, re-armed by the sessions themselves
+        self.session_expiry = TimerWheel(tick=1)
+
     def _run(self):
+        self.on_start()
         while True:
 
             if self.should_stop():
                 break
 
+            # Wake up for the next tick of the wheel even without traffic
             try:
-                task = self.input_msg_q.get(timeout=1)
+                task = self.input_msg_q.get(timeout=self.next_expiry_in())
             except Empty:
+                task = None
+
+            if task is not None:
+                metrics.handle_timed(self.handle_message, task, task.get('msg'))
+
+            self.expire_sessions()
+
+        self.on_stop()
+
+    def stop(self):
+        # Don't wait for the get() timeout
+        self.input_msg_q.put(None)
+        return super().stop()
+
+    def on_start(self):
+        ''' resume the sessions of this shard saved by a previous run '''
+        if self.state_store is None:
+            return
+
+        now = time.time()
+        for (chat_id, kind, state) in self.state_store.load_sessions():
+            if master_shard_of(chat_id, self.shards) != self.shard:
+                continue
+            session = self._new_session(chat_id, kind)
+            session.restore_state(state)
+            if now - session.alive_timestamp > session.TIMEOUT:
+                # Timed out while we were down
+                self.state_store.delete_session(chat_id)
                 continue
+            self.sessions[chat_id] = session
+            self._arm_expiry(chat_id, session)
+
+        self.session_count.value = len(self.sessions)
+        logger.info('{} resumed {} sessions'.format(self.id_, len(self.sessions)))
+
+    def on_stop(self):
+        if self.state_store is not None:
+            self.state_store.close()
+
+    def _new_session(self, chat_id, kind=SelectGameSession):
+        return kind(output_q=self.outbound_msq_q,
+                    on_refresh=partial(self._arm_expiry, chat_id))
 
-            if task['task'] == self.TASK_HANDLE_NEW_USER:
+    def next_expiry_in(self):
+        ''' seconds until sessions may have to be expired, at most 1 '''
+        return min(1, self.session_expiry.next_tick_in())
 
-                if 'msg' not in task or 'update' not in task['msg'].kwargs:
-                    continue
-                # Find chat ID/user ID
-                update = task['msg'].kwargs['update']
+    def handle_message(self, task):
+        ''' process one task sent to the master instance '''
 
-                chat_id = get_chat_id_from_update(update)
+        if task['task'] == self.TASK_HANDLE_NEW_USER:
 
-                # If there is no session for this chat id start a new one
-                if chat_id not in self.sessions:
-                    self.sessions[chat_id] = SelectGameSession(
-                        output_q=self.outbound_msq_q)
+            if 'msg' not in task or 'update' not in task['msg'].kwargs:
+                return
+            # Find chat ID/user ID
+            update = task['msg'].kwargs['update']
 
-                # Pass the new message to the session
-                self.sessions[chat_id].iterate(update=update)
+            chat_id = get_chat_id_from_update(update)
 
-            else:
-                pass
+            # If there is no session for this chat id start a new one
+            if chat_id not in self.sessions:
+                self.sessions[chat_id] = self._new_session(chat_id)
+                self.session_count.value = len(self.sessions)
 
-            # Periodically check if the sessions should be deleted because of timeout
-            for chat_id in list(self.sessions.keys()):
-                session = self.sessions[chat_id]
-                curr_time = time.time()
-                if curr_time - session.alive_timestamp > session.TIMEOUT:
-                    session.end_session()
+            # Pass the new message to the session
+            session = self.sessions[chat_id]
+            session.iterate(update=update)
+
+            if self.state_store is not None:
+                self.state_store.put_session(chat_id, type(session), session.save_state())
+
+        else:
+            pass
+
+    def _arm_expiry(self, chat_id, session):
+        self.session_expiry.schedule(chat_id, session.alive_timestamp + session.TIMEOUT)
+
+    def expire_sessions(self):
+        ''' end and delete the sessions which timed out '''
+        for chat_id in self.session_expiry.advance(time.time()):
+            session = self.sessions.pop(chat_id, None)
+            if session is None:
+                continue
+            session.end_session()
+            self.session_count.value = len(self.sessions)
+            if self.state_store is not None:
+                self.state_store.delete_session(chat_id)
 
-                    logger.debug(
-                        'Deleting timedout session for chat {}'.format(chat_id))
-                    del self.sessions[chat_id]
+            logger.debug('Deleting timedout session for chat %s', chat_id)
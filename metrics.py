@@ -0,0 +1,318 @@
+''' per stage latency, router results and queue depths, aggregated over all the processes '''
+import logging
+import multiprocessing as mp
+import os
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from multiprocessing.util import Finalize
+from threading import Lock, Thread
+from time import monotonic, sleep
+
+import tracing
+from queues import INBOUND_MSG_QUEUE, OUTBOUND_MSG_QUEUE
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# Upper bounds (seconds) of the histogram buckets, +Inf is implicit
+BUCKETS = (50e-6, 100e-6, 250e-6, 500e-6, 1e-3, 2.5e-3, 5e-3, 10e-3, 25e-3,
+           50e-3, 100e-3, 250e-3, 500e-3, 1, 2.5, 5, 10)
+
+# Layout of the values: per hop, one count per bucket (+Inf last) and the sum,
+# then one counter per router result
+_SUM = len(BUCKETS) + 1
+_HIST_LEN = len(BUCKETS) + 2
+
+# Hops of a message, timed with the stamps carried by RxQItem/TxQItem (time.monotonic(),
+# the same clock in every process). Each one is the offset of its histogram in the values
+HOPS = ('rx_to_router', 'router_to_instance', 'handle', 'tx_queue', 'bot_call')
+HOP_RX_TO_ROUTER = 0 * _HIST_LEN        # RxQItem created by the TAL -> routed by the Router
+HOP_ROUTER_TO_INSTANCE = 1 * _HIST_LEN  # routed -> picked up by its instance (or master)
+HOP_HANDLE = 2 * _HIST_LEN              # handle_message() of the instance (or master)
+HOP_TX_QUEUE = 3 * _HIST_LEN            # TxQItem created -> Bot call starts (flood limits included)
+HOP_BOT_CALL = 4 * _HIST_LEN            # the Bot call itself
+
+# Indexed by the Router result codes
+ROUTER_RESULTS = ('COULD_NOT_ROUTE', 'TGT_INSTANCE_NOT_ACTIVE', 'MULTIPLE_TGT_INSTANCES', 'COULD_ROUTE')
+_ROUTER_AT = len(HOPS) * _HIST_LEN
+_SIZE = _ROUTER_AT + len(ROUTER_RESULTS)
+
+# Seconds a process keeps its observations before adding them to the shared values
+FLUSH_INTERVAL = 0.5
+
+# Totals of all the processes
+# Created at import like the message queues, the forked processes inherit it
+_SHARED = mp.Array('d', _SIZE)
+
+
+class _Accumulator():
+    '''
+        Observations of one process, only ever growing, a flusher thread adds
+        what changed since its last pass to _SHARED.
+        Recording one is a couple of list updates without any lock: the flusher
+        only reads the list, a concurrent update from two threads of the
+        process may rarely lose one count, which a histogram can afford.
+        _SHARED (and its process shared lock) is only touched every FLUSH_INTERVAL.
+    '''
+
+    def __init__(self):
+        self.values = [0.0] * _SIZE
+        self._flushed = [0.0] * _SIZE
+        self._lock = Lock()
+
+        self._flusher = Thread(target=self._flush_loop, name='metrics_flusher')
+        self._flusher.daemon = True
+        self._flusher.start()
+        # Last flush when the process exits (multiprocessing runs it for its children too)
+        Finalize(self, self.flush, exitpriority=10)
+
+    def _flush_loop(self):
+        while True:
+            sleep(FLUSH_INTERVAL)
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            # A copy of a list is atomic for the other threads
+            values = self.values[:]
+            deltas = [(idx, value - flushed) for (idx, (value, flushed))
+                      in enumerate(zip(values, self._flushed)) if value != flushed]
+            if not deltas:
+                return
+            self._flushed = values
+
+            with _SHARED.get_lock():
+                for (idx, delta) in deltas:
+                    _SHARED[idx] += delta
+
+
+_values = None
+_acc = None
+_acc_lock = Lock()
+
+
+def _accumulator():
+    global _acc, _values
+    with _acc_lock:
+        if _acc is None:
+            _acc = _Accumulator()
+            _values = _acc.values
+    return _values
+
+
+def _forget_parent():
+    # What the parent observed is flushed by the parent, the child starts its own
+    global _acc, _acc_lock, _values
+    _acc = None
+    _values = None
+    _acc_lock = Lock()
+
+
+os.register_at_fork(after_in_child=_forget_parent)
+
+
+def observe(hop, seconds):
+    ''' record the duration of one HOP_* '''
+    values = _values if _values is not None else _accumulator()
+    values[hop + bisect_left(BUCKETS, seconds)] += 1
+    values[hop + _SUM] += seconds
+
+
+def count_route(result):
+    ''' count one Router result code '''
+    values = _values if _values is not None else _accumulator()
+    values[_ROUTER_AT + result] += 1
+
+
+def handle_timed(handle, msg, rx_item, start=None):
+    '''
+        handle(msg), timing how long rx_item took to get here from the router and the handling
+        A traced rx_item gets its spans, and is the current trace while handled
+        rx_item -> the RxQItem msg is about, None (or anything else) if there is none
+        start   -> monotonic() taken right before, eg. the end of the previous message of a batch
+        Returns monotonic() at the end of the handling, to start the next message of a batch with
+    '''
+    if start is None:
+        start = monotonic()
+    routed_at = getattr(rx_item, 'routed_at', None)
+    if routed_at is not None:
+        observe(HOP_ROUTER_TO_INSTANCE, start - routed_at)
+
+    trace_id = getattr(rx_item, 'trace_id', None)
+    if trace_id is None:
+        try:
+            handle(msg)
+        finally:
+            end = monotonic()
+            observe(HOP_HANDLE, end - start)
+        return end
+
+    try:
+        with tracing.handling(trace_id):
+            handle(msg)
+    finally:
+        end = monotonic()
+        observe(HOP_HANDLE, end - start)
+        if routed_at is not None:
+            tracing.span(trace_id, 'instance_queue', routed_at, start)
+        tracing.span(trace_id, 'handle', start, end)
+    return end
+
+
+def _observe_off(hop, seconds):
+    pass
+
+
+def _count_route_off(result):
+    pass
+
+
+def _handle_untimed(handle, msg, rx_item, start=None):
+    ''' handle_timed() without the metrics, a traced rx_item still gets its spans '''
+    if getattr(rx_item, 'trace_id', None) is None:
+        handle(msg)
+        return None
+    return _recording[2](handle, msg, rx_item, start)
+
+
+_recording = (observe, count_route, handle_timed)
+
+
+def install(enabled):
+    '''
+        To be called in the main process before starting the other processes, they inherit it
+        enabled -> False to bind observe(), count_route() and handle_timed() to versions
+                    recording nothing, for when the metrics are not served
+    '''
+    global observe, count_route, handle_timed
+    if enabled:
+        observe, count_route, handle_timed = _recording
+    else:
+        observe, count_route, handle_timed = _observe_off, _count_route_off, _handle_untimed
+
+
+def snapshot():
+    ''' totals of all the processes, those of the last FLUSH_INTERVAL of other processes may be missing '''
+    if _acc is not None:
+        _acc.flush()
+    with _SHARED.get_lock():
+        return _SHARED[:]
+
+
+def core_queue_depths():
+    ''' depth of the queues between the TAL and the router '''
+    return {'inbound': INBOUND_MSG_QUEUE.qsize(), 'outbound': OUTBOUND_MSG_QUEUE.qsize()}
+
+
+def render(values, queue_depths):
+    '''
+        Prometheus text exposition of snapshot() values
+        queue_depths -> dict queue name -> number of items waiting
+    '''
+    lines = ['# HELP bot_hop_latency_seconds Time spent by the messages in each hop of the pipeline',
+             '# TYPE bot_hop_latency_seconds histogram']
+    for (hop_idx, hop) in enumerate(HOPS):
+        base = hop_idx * _HIST_LEN
+        cumulative = 0
+        for (idx, bound) in enumerate(BUCKETS):
+            cumulative += values[base + idx]
+            lines.append('bot_hop_latency_seconds_bucket{{hop="{}",le="{}"}} {:.0f}'.format(
+                hop, bound, cumulative))
+        cumulative += values[base + len(BUCKETS)]
+        lines.append('bot_hop_latency_seconds_bucket{{hop="{}",le="+Inf"}} {:.0f}'.format(hop, cumulative))
+        lines.append('bot_hop_latency_seconds_sum{{hop="{}"}} {!r}'.format(hop, values[base + _SUM]))
+        lines.append('bot_hop_latency_seconds_count{{hop="{}"}} {:.0f}'.format(hop, cumulative))
+
+    lines.append('# HELP bot_router_results_total Messages routed, by result of the routing')
+    lines.append('# TYPE bot_router_results_total counter')
+    for (idx, result) in enumerate(ROUTER_RESULTS):
+        lines.append('bot_router_results_total{{result="{}"}} {:.0f}'.format(
+            result, values[_ROUTER_AT + idx]))
+
+    lines.append('# HELP bot_queue_depth Items waiting in each queue')
+    lines.append('# TYPE bot_queue_depth gauge')
+    for (name, depth) in queue_depths.items():
+        lines.append('bot_queue_depth{{queue="{}"}} {}'.format(name, depth))
+
+    return '\n'.join(lines) + '\n'
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.server.metrics.exposition().encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class MetricsServer():
+    '''
+        Serves GET /metrics in the Prometheus text format, for a local scraper.
+        The histograms and counters come from every process, the queue depths
+        are read when scraped.
+    '''
+
+    def __init__(self, host='127.0.0.1', port=9100, queue_depths=(core_queue_depths,)):
+        '''
+            host, port      -> where to listen, port 0 picks a free one (see address)
+            queue_depths    -> callables returning a dict queue name -> depth each
+        '''
+        self.host = host
+        self.port = port
+        self._queue_depths = list(queue_depths)
+
+        self._server = None
+        self._server_thread = None
+
+    @property
+    def address(self):
+        ''' (host, port) the server is bound to '''
+        return self._server.server_address if self._server else (self.host, self.port)
+
+    def exposition(self):
+        depths = {}
+        for source in self._queue_depths:
+            try:
+                depths.update(source())
+            except (NotImplementedError, OSError) as ex:
+                # qsize() is not available everywhere
+                logger.error('Could not read queue depths from {}: {}'.format(source, ex))
+        return render(snapshot(), depths)
+
+    def start(self):
+        logger.info('Staring {}'.format(type(self).__name__))
+
+        self._server = ThreadingHTTPServer((self.host, self.port), _MetricsHandler)
+        self._server.daemon_threads = True
+        self._server.metrics = self
+
+        self._server_thread = Thread(target=self._server.serve_forever,
+                                     name='{}:server'.format(type(self).__name__))
+        self._server_thread.daemon = True
+        self._server_thread.start()
+        logger.info('Metrics on http://{}:{}/metrics'.format(*self.address))
+
+    def stop(self):
+        if self._server is None:
+            logger.error('{} is not currently running !'.format(type(self).__name__))
+            return
+
+        logger.info('Stopping {}'.format(type(self).__name__))
+        self._server.shutdown()
+        self._server.server_close()
+        self._server_thread.join(2)
+        self._server = None
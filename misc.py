@@ -57,6 +57,9 @@ class StoppableThread(ABC):
     def should_stop(self):
         return self._exit_lock.acquire(blocking=False)
 
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+
 
 class StoppableProcess(ABC):
     ''' Abstract class with a thread that can be stopped '''
@@ -113,11 +116,6 @@ class StoppableProcess(ABC):
 
 
 def get_chat_id_from_update(update):
-
-    if update.callback_query is not None:
-        # Callback querry message, chat id is in callback_querry.message.chat.id
-        return update.callback_query.message.chat.id
-    elif update.message is not None:
-        return update.message.chat.id
-    else:
-        return None
+    ''' chat id of an RxUpdate, None if it has none '''
+    # For callback querries RxUpdate already holds callback_querry.message.chat.id
+    return update.chat_id
@@ -1,3 +1,25 @@
 ''' global public variables '''
 
 LOGGER_NAME = 'GAME_LOGGER'
+# 'DEBUG' also builds and writes the records of the message path, which slows it down
+LOG_LEVEL = 'INFO'
+
+# Sessions and instance snapshots survive restarts in this database
+STATE_DB_PATH = 'game_state.db'
+
+# Public https url telegram posts the updates to, None to poll for them instead
+WEBHOOK_URL = None
+# Where the webhook receiver listens, behind the TLS proxy serving WEBHOOK_URL
+WEBHOOK_LISTEN = ('0.0.0.0', 8443)
+
+# File the inbound updates are appended to (.gz to compress), for replay_updates.py. None to not record
+RECORD_UPDATES_PATH = None
+
+# Where the Prometheus metrics are served (GET /metrics), eg. ('127.0.0.1', 9100)
+# None to not serve them, nor record them: they cost a couple of microseconds per message
+METRICS_LISTEN = None
+
+# Fraction of the inbound messages traced across the processes (0 for none)
+TRACE_SAMPLE_RATE = 0.0
+# kill -USR1 <main pid> writes the traces there, as Chrome trace JSON (chrome://tracing, ui.perfetto.dev)
+TRACE_DUMP_PATH = 'trace.json'
@@ -1,15 +1,113 @@
 ''' All queues items with 'enums' '''
 import logging
+import time
 
 from multiprocessing import Queue
+from threading import Condition, Thread
 import multiprocessing as mp
 import multiprocessing.queues as mpq
 
+import tracing
+from bot_dispatch import get_bot_call
 from pb_cfg import LOGGER_NAME
 
 logger = logging.getLogger(LOGGER_NAME)
 
 
+class RxUpdate():
+    '''
+        Slim copy of a telegram Update with only the fields used by the
+        router and the sessions. Way cheaper to pickle through the queues
+        than the Update object graph (bot, message, chat, user, ...).
+    '''
+    __slots__ = ('update_id', 'chat_id', 'user_id', 'message_id', 'text',
+                 'callback_query_id', 'callback_data')
+
+    def __init__(self, update_id=None, chat_id=None, user_id=None, message_id=None, text=None,
+                 callback_query_id=None, callback_data=None):
+        '''
+            update_id           -> telegram update id
+            chat_id             -> chat the message/callback query comes from
+            user_id             -> user that sent the message/pressed the button
+            message_id          -> message (or message holding the keyboard for callback queries)
+            text                -> text of the message
+            callback_query_id   -> id to answer the callback query, None if not a callback query
+            callback_data       -> data of the button pressed
+        '''
+        self.update_id = update_id
+        self.chat_id = chat_id
+        self.user_id = user_id
+        self.message_id = message_id
+        self.text = text
+        self.callback_query_id = callback_query_id
+        self.callback_data = callback_data
+
+    @classmethod
+    def from_update(cls, update):
+        ''' build from a telegram Update '''
+        query = update.callback_query
+        if query is not None:
+            message = query.message
+            return cls(update_id=update.update_id,
+                       chat_id=message.chat.id if message else None,
+                       user_id=query.from_user.id,
+                       message_id=message.message_id if message else None,
+                       text=message.text if message else None,
+                       callback_query_id=query.id,
+                       callback_data=query.data)
+
+        message = update.message
+        if message is not None:
+            return cls(update_id=update.update_id,
+                       chat_id=message.chat.id,
+                       user_id=message.from_user.id if message.from_user else None,
+                       message_id=message.message_id,
+                       text=message.text)
+
+        return cls(update_id=update.update_id)
+
+    @classmethod
+    def from_dict(cls, data):
+        ''' build from the json of an update (dict), as posted to a webhook '''
+        query = data.get('callback_query')
+        if query is not None:
+            message = query.get('message')
+            return cls(update_id=data.get('update_id'),
+                       chat_id=message['chat']['id'] if message else None,
+                       user_id=query['from']['id'],
+                       message_id=message['message_id'] if message else None,
+                       text=message.get('text') if message else None,
+                       callback_query_id=query['id'],
+                       callback_data=query.get('data'))
+
+        message = data.get('message')
+        if message is not None:
+            user = message.get('from')
+            return cls(update_id=data.get('update_id'),
+                       chat_id=message['chat']['id'],
+                       user_id=user['id'] if user else None,
+                       message_id=message['message_id'],
+                       text=message.get('text'))
+
+        return cls(update_id=data.get('update_id'))
+
+    def is_callback_query(self):
+        return self.callback_query_id is not None
+
+    def __reduce__(self):
+        # Pickle as a plain tuple, no attribute names in the payload
+        return (RxUpdate, (self.update_id, self.chat_id, self.user_id, self.message_id,
+                           self.text, self.callback_query_id, self.callback_data))
+
+    def __str__(self):
+        if self.is_callback_query():
+            return 'Update {} Callback query: {}'.format(self.update_id, self.callback_data)
+        return 'Update {} Message: {}'.format(self.update_id, self.text)
+
+    def __repr__(self):
+        return self.__str__()
+
+
 class RxQItem():
     ''' item in the rx message queue to be passed to the filter '''
     TEXT_MSG = 0
@@ -34,6 +132,7 @@ class RxQItem():
             game_code   -> game code to match in Instance to assign this message
             args        -> 'payload' of the message in a list
             kwargs      -> 'payload' of the message in a dict
+                            messages from telegram carry an RxUpdate in kwargs['update']
         '''
         self.route_by = route_by
         self.chat_id = chat_id
@@ -46,15 +145,21 @@ class RxQItem():
 
         self.delivery_attempts = 0
 
+        # Stage stamps (time.monotonic()) for the metrics: received and routed
+        self.rx_at = time.monotonic()
+        self.routed_at = None
+        # Set by the receiving side for the sampled messages, see tracing
+        self.trace_id = None
+
     def __str__(self):
 
         out_str = 'Game Code: {} '.format(self.game_code)
         out_str += 'Chat ID: {} '.format(self.chat_id)
         out_str += 'User ID: {}'.format(self.user_id)
 
-        if 'update' in self.kwargs and self.kwargs['update'].message:
+        if 'update' in self.kwargs and self.kwargs['update'].text:
             out_str += ' Message: {}'.format(
-                self.kwargs['update'].message.text)
+                self.kwargs['update'].text)
 
         return out_str
 
@@ -81,6 +186,18 @@ class TxQItem():
         self.args = args if args else []
         self.kwargs = kwargs if kwargs else {}
 
+        # Stage stamp (time.monotonic()) for the metrics
+        self.queued_at = time.monotonic()
+        # Trace of the message being handled when the call was made
+        self.trace_id = tracing.current_trace()
+
+    def get_chat_id(self):
+        ''' chat this Bot call is addressed to, None if unknown '''
+        try:
+            return get_bot_call(self.func_call).chat_id(self.args, self.kwargs)
+        except AttributeError:
+            return None
+
     def __str__(self):
         return 'Func: {} Args: {} Kwargs: {}'.format(self.func_call, self.args, self.kwargs)
 
@@ -114,16 +231,119 @@ class TxMessageQ(mpq.Queue):
         return lambda *args, **kwargs: self.put_func_call(attr, *args, **kwargs)
 
     def put_func_call(self, func_name, *args, **kwargs):
-        ''' Initialize and put() a TxQItem in the queue '''
-        # logger.debug('{}{}{}'.format(func_name, args, kwargs))
-        item = TxQItem(func_call=func_name, args=args, kwargs=kwargs)
+        '''
+            Initialize and put() a TxQItem in the queue
+            The call is validated against the Bot signature before being queued
+            so an invalid call raises (AttributeError/TypeError) in the caller.
+        '''
+        item = make_tx_item(func_name, args, kwargs)
         self.put(item)
-        logger.debug('Put item: {}'.format(item))
+        logger.debug('Put item: %s', item)
 
 
-# There are three 'kinds' of queues
+def make_tx_item(func_name, args, kwargs):
+    ''' validate a Bot call and build its TxQItem '''
+    # logger.debug('{}{}{}'.format(func_name, args, kwargs))
+    get_bot_call(func_name).validate(args, kwargs)
+    return TxQItem(func_call=func_name, args=args, kwargs=kwargs)
+
+
+class RxBatcher():
+    '''
+        Micro batching in front of a queue: the items put are sent as lists,
+        one queue put (one pickle, one pipe write) per list.
+        A list goes out once it has max_items or its first item has waited max_delay seconds.
+        Adaptive: the mean gap between items is tracked, while less than two items
+        are expected within max_delay (light traffic) an item goes out right away,
+        alone, so batching only adds latency under load.
+        Thread safe, the consumer must accept lists (see unbatch()).
+    '''
+
+    def __init__(self, q, max_items=64, max_delay=200e-6, clock=time.perf_counter):
+        self._q = q
+        self.max_items = max_items
+        self.max_delay = max_delay
+        self._clock = clock
+
+        self._cond = Condition()
+        self._buffer = []
+        self._deadline = None
+        # Moving average of the time between two puts, capped so a
+        # long silence is forgotten after a few puts
+        self._max_gap = 4 * max_delay
+        self._gap = self._max_gap
+        self._last_put = clock()
+        self._closed = False
+        self._flusher = None
+
+    def put(self, item):
+        self.put_many((item,))
+
+    def put_many(self, items):
+        if not items:
+            return
+        with self._cond:
+            was_empty = not self._buffer
+            self._buffer.extend(items)
+            now = self._clock()
+            self._gap = 0.8 * self._gap + 0.2 * min(now - self._last_put, self._max_gap)
+            self._last_put = now
+
+            if len(self._buffer) >= self.max_items or self._closed \
+                    or (was_empty and 2 * self._gap > self.max_delay):
+                self._flush()
+            elif was_empty:
+                self._deadline = now + self.max_delay
+                if self._flusher is None:
+                    self._flusher = Thread(target=self._run, daemon=True,
+                                           name='{}:flusher'.format(type(self).__name__))
+                    self._flusher.start()
+                self._cond.notify()
+
+    def _flush(self):
+        # Put under the lock, concurrent flushes must not swap the order of the lists
+        batch, self._buffer = self._buffer, []
+        self._deadline = None
+        for start in range(0, len(batch), self.max_items):
+            chunk = batch[start:start + self.max_items]
+            self._q.put(chunk if len(chunk) > 1 else chunk[0])
+
+    def _run(self):
+        with self._cond:
+            while not self._closed:
+                if self._deadline is None:
+                    self._cond.wait()
+                    continue
+                wait = self._deadline - self._clock()
+                if wait > 0:
+                    self._cond.wait(wait)
+                    continue
+                self._flush()
+
+    def flush(self):
+        ''' send whatever is buffered now '''
+        with self._cond:
+            if self._buffer:
+                self._flush()
+
+    def close(self):
+        ''' flush, from now on every put is sent right away '''
+        with self._cond:
+            self._closed = True
+            if self._buffer:
+                self._flush()
+            self._cond.notify()
+
+
+def unbatch(item):
+    ''' queue items are either a single item or a list of them (RxBatcher), returns a list '''
+    return item if type(item) is list else [item]
+
+
+# There are four 'kinds' of queues
 # 1- Inbound queue:
 # Anyone can put items to this queue (Instances or Updater).
+# Items are RxQItem or lists of RxQItem (RxBatcher).
 # Only the router it allowed to get items from it.
 # The router will then dispatch the messages to the input Q of Instances
 # INBOUND_MSG_QUEUE = RxMessageQ()
@@ -137,7 +357,12 @@ INBOUND_MSG_QUEUE = Queue()
 OUTBOUND_MSG_QUEUE = TxMessageQ()
 # OUTBOUND_MSG_QUEUE = TxMessageQ()
 
-# 3- Instance input queue
+# 3- Routing updates queue
+# Instances put their membership changes (chat ids, user ids, game code) in this queue.
+# Only the RoutingTable is allowed to get from this queue
+ROUTING_UPDATES_QUEUE = Queue()
+
+# 4- Instance input queue
 # Each instance will have an input queue where the router will put the corresponging
 # message obtained from the INBOUND_MSG_QUEUE
 # Definition is inside each Instance
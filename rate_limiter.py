@@ -0,0 +1,289 @@
+''' schedule outbound Bot calls within the telegram flood limits '''
+import heapq
+import logging
+import time
+
+from collections import deque
+from threading import Condition
+
+from coalescer import OutboundCoalescer
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class TokenBucket():
+    ''' classic token bucket, 'rate' tokens per second up to 'capacity' '''
+    __slots__ = ('rate', 'capacity', 'tokens', 'stamp')
+
+    def __init__(self, rate, capacity, now):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.stamp = now
+
+    def _refill(self, now):
+        if now > self.stamp:
+            self.tokens = min(self.capacity,
+                              self.tokens + (now - self.stamp) * self.rate)
+            self.stamp = now
+
+    def ready_in(self, now):
+        ''' seconds until a token is available, 0 if there is one now '''
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class OutboundScheduler():
+    '''
+        Sits between OUTBOUND_MSG_QUEUE and the Bot.
+        - One FIFO per chat, at most one call in flight per chat (keeps the order
+          even when a call has to be retried)
+        - Token bucket per chat (private and group chats have different limits)
+        - Global token bucket for the whole bot
+        - Round robin between the chats which are ready to send
+        Calls without a chat (eg. answer_callback_query) only use the global bucket.
+        - Calls still waiting in a chat FIFO are merged/dropped by an OutboundCoalescer
+          when newer calls make them redundant (coalescer=None to send everything)
+
+        Thread safe: push() is called by the tx thread, next_item() by the
+        scheduling thread and done()/defer() by the sender workers.
+    '''
+
+    # Default limits as documented by telegram
+    GLOBAL_RATE = 30
+    CHAT_RATE = 1
+    GROUP_RATE = 20 / 60
+
+    # Forget the buckets of chats that have been quiet for this long
+    PRUNE_INTERVAL = 60
+
+    def __init__(self, global_rate=GLOBAL_RATE, chat_rate=CHAT_RATE, group_rate=GROUP_RATE,
+                 global_burst=GLOBAL_RATE, chat_burst=3, group_burst=3, clock=time.monotonic,
+                 coalescer=True):
+        '''
+            coalescer -> OutboundCoalescer, True for a default one, None to disable coalescing
+        '''
+
+        self._clock = clock
+        self.coalescer = OutboundCoalescer() if coalescer is True else coalescer
+        self._cond = Condition()
+
+        self._chat_rate = chat_rate
+        self._chat_burst = chat_burst
+        self._group_rate = group_rate
+        self._group_burst = group_burst
+
+        now = clock()
+        self._global_bucket = TokenBucket(global_rate, global_burst, now)
+        self._global_blocked_until = 0
+
+        # chat_id -> deque of pending items
+        self._pending = {}
+        # chat_id -> TokenBucket
+        self._buckets = {}
+        # chat_id -> monotonic time before which nothing should be sent (retry_after)
+        self._blocked_until = {}
+        # chat ids with a call currently being executed by a worker
+        self._in_flight = set()
+
+        # chat ids that can send as soon as there is a global token, in round robin order
+        self._ready = deque()
+        # (time, chat_id) for chats waiting for their bucket or a retry_after
+        self._waiting = []
+
+        # Calls without a chat id
+        self._no_chat = deque()
+
+        self._last_prune = now
+        self._closed = False
+
+        # Optional callable, called (without arguments) whenever an item may have become ready.
+        # For consumers that can't wait on the internal condition (eg. an asyncio loop)
+        self.listener = None
+
+    @staticmethod
+    def _is_group(chat_id):
+        # Group and channel ids are negative
+        return isinstance(chat_id, int) and chat_id < 0
+
+    def _bucket(self, chat_id, now):
+        bucket = self._buckets.get(chat_id)
+        if bucket is None:
+            if self._is_group(chat_id):
+                bucket = TokenBucket(self._group_rate, self._group_burst, now)
+            else:
+                bucket = TokenBucket(self._chat_rate, self._chat_burst, now)
+            self._buckets[chat_id] = bucket
+        return bucket
+
+    def _schedule_chat(self, chat_id, now):
+        ''' put a chat with pending items either in the ready ring or the waiting heap '''
+        wait = max(self._bucket(chat_id, now).ready_in(now),
+                   self._blocked_until.get(chat_id, 0) - now)
+        if wait <= 0:
+            self._ready.append(chat_id)
+        else:
+            heapq.heappush(self._waiting, (now + wait, chat_id))
+
+    def push(self, item):
+        ''' add a TxQItem at the end of its chat queue, unless the coalescer absorbs it '''
+        chat_id = item.get_chat_id()
+        with self._cond:
+            now = self._clock()
+            if chat_id is None:
+                self._no_chat.append(item)
+            else:
+                chat_q = self._pending.get(chat_id)
+                if self.coalescer is not None and self.coalescer.absorb(chat_id, chat_q, item, now):
+                    return
+                if chat_q is None:
+                    chat_q = self._pending[chat_id] = deque()
+                chat_q.append(item)
+                # First item of an idle chat, it has to be scheduled
+                if len(chat_q) == 1 and chat_id not in self._in_flight:
+                    self._schedule_chat(chat_id, now)
+            self._cond.notify()
+        self._notify_listener()
+
+    def _notify_listener(self):
+        if self.listener is not None:
+            self.listener()
+
+    def done(self, item, sent=True):
+        '''
+            a worker finished with item, the next one of its chat can go
+            sent -> False if the Bot call failed
+        '''
+        chat_id = item.get_chat_id()
+        if chat_id is None:
+            return
+        with self._cond:
+            if self.coalescer is not None:
+                self.coalescer.done(chat_id, item, sent)
+            self._in_flight.discard(chat_id)
+            if not self._pending.get(chat_id):
+                return
+            self._schedule_chat(chat_id, self._clock())
+            self._cond.notify()
+        self._notify_listener()
+
+    def defer(self, item, retry_after):
+        ''' telegram answered 429, put item back in front and hold its chat for retry_after seconds '''
+        chat_id = item.get_chat_id()
+        with self._cond:
+            now = self._clock()
+            if chat_id is None:
+                self._no_chat.appendleft(item)
+                self._global_blocked_until = max(self._global_blocked_until, now + retry_after)
+            else:
+                self._in_flight.discard(chat_id)
+                self._pending.setdefault(chat_id, deque()).appendleft(item)
+                self._blocked_until[chat_id] = now + retry_after
+                self._schedule_chat(chat_id, now)
+            self._cond.notify()
+        self._notify_listener()
+
+    def _pop(self, now):
+        '''
+            Returns (item, 0) if an item can be sent now
+            otherwise (None, seconds to wait) (None if there is nothing pending)
+        '''
+        global_wait = max(self._global_bucket.ready_in(now),
+                          self._global_blocked_until - now)
+
+        while self._waiting and self._waiting[0][0] <= now:
+            _, chat_id = heapq.heappop(self._waiting)
+            self._ready.append(chat_id)
+
+        if not self._ready and not self._no_chat:
+            return None, (self._waiting[0][0] - now) if self._waiting else None
+
+        if global_wait > 0:
+            return None, global_wait
+
+        if self._no_chat:
+            self._global_bucket.take(now)
+            return self._no_chat.popleft(), 0
+
+        while self._ready:
+            chat_id = self._ready.popleft()
+            bucket = self._bucket(chat_id, now)
+            # The bucket may have been emptied by a retry, check again
+            wait = max(bucket.ready_in(now), self._blocked_until.get(chat_id, 0) - now)
+            if wait > 0:
+                heapq.heappush(self._waiting, (now + wait, chat_id))
+                continue
+
+            chat_q = self._pending[chat_id]
+            item = chat_q.popleft()
+            if not chat_q:
+                del self._pending[chat_id]
+                if self.coalescer is not None:
+                    self.coalescer.forget(chat_id)
+            self._blocked_until.pop(chat_id, None)
+
+            bucket.take(now)
+            self._global_bucket.take(now)
+            self._in_flight.add(chat_id)
+            return item, 0
+
+        return None, (self._waiting[0][0] - now) if self._waiting else None
+
+    def _prune(self, now):
+        ''' drop buckets of idle chats, a new full bucket is equivalent '''
+        for chat_id in [c for (c, b) in self._buckets.items()
+                        if c not in self._pending and c not in self._in_flight and b.is_full(now)]:
+            del self._buckets[chat_id]
+        self._last_prune = now
+
+    def poll(self):
+        '''
+            Non blocking version of next_item()
+            Returns (item, 0) if an item can be sent now
+            otherwise (None, seconds to wait before polling again, None if nothing is pending)
+        '''
+        with self._cond:
+            now = self._clock()
+            if now - self._last_prune > self.PRUNE_INTERVAL:
+                self._prune(now)
+            return self._pop(now)
+
+    def next_item(self):
+        '''
+            Block until an item can be sent without breaking the limits
+            Returns None once close() has been called
+        '''
+        with self._cond:
+            while not self._closed:
+                now = self._clock()
+                if now - self._last_prune > self.PRUNE_INTERVAL:
+                    self._prune(now)
+
+                item, wait = self._pop(now)
+                if item is not None:
+                    return item
+                self._cond.wait(wait)
+        return None
+
+    def close(self):
+        ''' wake up and release whoever waits in next_item() '''
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def pending(self):
+        ''' number of items waiting to be sent '''
+        with self._cond:
+            return len(self._no_chat) + sum(len(q) for q in self._pending.values())
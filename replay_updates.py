@@ -0,0 +1,119 @@
+'''
+    replay a recording of inbound updates (see update_log.UpdateRecorder,
+    RECORD_UPDATES_PATH) through the whole pipeline, against a fake Bot
+
+    The updates are put in INBOUND_MSG_QUEUE with their original inter arrival
+    times, sped up by --speed (or as fast as possible with --speed max), and go
+    Router -> MasterInstance/instances -> OUTBOUND_MSG_QUEUE -> sender -> fake Bot.
+    Nothing reaches telegram, no token is needed.
+
+    python replay_updates.py updates.jsonl.gz --speed 10 --max-gap 5
+'''
+import argparse
+import sys
+import threading
+import time
+
+from fake_telegram import FAKE_TOKEN, FakeTelegramServer, fake_bot
+from instance_manager import InstanceManager
+import metrics
+from metrics import MetricsServer, core_queue_depths
+from queues import INBOUND_MSG_QUEUE, RxBatcher
+from rate_limiter import OutboundScheduler
+from router import Router
+from telegram_abstraction_layer import TelegramAbstractionLayer
+from update_log import read_recording, replay
+
+
+def parse_speed(value):
+    if value == 'max':
+        return None
+    speed = float(value)
+    if speed <= 0:
+        raise argparse.ArgumentTypeError('speed must be positive or max')
+    return speed
+
+
+class CallCounter():
+    ''' counts the Bot calls and remembers when the last one happened '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.last_call = time.monotonic()
+
+    def __call__(self, endpoint, data):
+        with self._lock:
+            self.calls += 1
+            self.last_call = time.monotonic()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', help='file written by an UpdateRecorder')
+    parser.add_argument('--speed', type=parse_speed, default=1.0, help='1, 10, ... or max')
+    parser.add_argument('--max-gap', type=float, default=None,
+                        help='shorten the idle periods of the recording to this many seconds')
+    parser.add_argument('--hosts', type=int, default=0, help='InstanceManager hosts')
+    parser.add_argument('--master-shards', type=int, default=1, help='MasterInstance processes')
+    parser.add_argument('--bot-latency', type=float, default=0, help='seconds each Bot call takes')
+    parser.add_argument('--flood-limits', action='store_true', help='keep the telegram flood limits')
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='serve the metrics on 127.0.0.1:port while replaying')
+    parser.add_argument('--settle', type=float, default=2, help='seconds without Bot calls to call it done')
+    args = parser.parse_args()
+
+    # Before the processes are started, like main.py
+    metrics.install(enabled=args.metrics_port is not None)
+
+    counter = CallCounter()
+    bot = fake_bot(FakeTelegramServer(latency=args.bot_latency, on_call=counter))
+    scheduler = None if args.flood_limits else OutboundScheduler(global_rate=1e9, global_burst=1e9,
+                                                                 chat_rate=1e9, chat_burst=1e9)
+    tal = TelegramAbstractionLayer(FAKE_TOKEN, bot=bot, scheduler=scheduler)
+    im = InstanceManager(hosts=args.hosts, master_shards=args.master_shards)
+    rtr = Router(im)
+
+    # Only the sending side, the recording takes the place of telegram
+    tal.start(receiver=False)
+    im.start()
+    rtr.start()
+
+    metrics_server = None
+    if args.metrics_port is not None:
+        metrics_server = MetricsServer(port=args.metrics_port, queue_depths=(
+            core_queue_depths, tal.queue_depths, im.queue_depths, rtr.queue_depths))
+        metrics_server.start()
+
+    # Let the processes come up
+    time.sleep(1)
+
+    inbound = RxBatcher(INBOUND_MSG_QUEUE)
+    start = counter.last_call = time.monotonic()
+    try:
+        replayed = replay(read_recording(args.recording), inbound.put,
+                          speed=args.speed, max_gap=args.max_gap)
+    except KeyboardInterrupt:
+        replayed = None
+    inbound.close()
+    replay_time = time.monotonic() - start
+
+    # Done once the pipeline went quiet
+    while time.monotonic() - counter.last_call < args.settle:
+        time.sleep(0.1)
+    total_time = counter.last_call - start
+
+    if metrics_server is not None:
+        metrics_server.stop()
+    rtr.stop()
+    im.stop()
+    tal.stop()
+
+    print('replayed {} updates in {:.2f}s ({:.0f}/s), {} Bot calls, last one {:.2f}s after the start'.format(
+        replayed, replay_time, (replayed or 0) / replay_time if replay_time else 0,
+        counter.calls, total_time))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
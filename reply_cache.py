@@ -0,0 +1,23 @@
+''' static replies built and serialized once '''
+from functools import lru_cache
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+
+@lru_cache(maxsize=None)
+def inline_keyboard(rows):
+    '''
+        reply_markup of an inline keyboard as the JSON string the Bot api expects
+        rows -> tuple of rows, each one a tuple of (text, callback_data)
+        The Bot passes a str reply_markup on untouched: the markup is built and
+        serialized once per process, and goes through OUTBOUND_MSG_QUEUE as a short string
+    '''
+    return InlineKeyboardMarkup(
+        [[InlineKeyboardButton(text, callback_data=data) for (text, data) in row] for row in rows]
+    ).to_json()
+
+
+@lru_cache(maxsize=1024)
+def render(template, *args):
+    ''' template.format(*args), for texts with a handful of possible values '''
+    return template.format(*args)
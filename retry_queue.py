@@ -0,0 +1,149 @@
+''' delayed redelivery of inbound messages with a dead letter store '''
+import heapq
+import logging
+import time
+
+from collections import deque
+from itertools import count
+from threading import Condition
+
+from misc import StoppableThread
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class DeadLetterStore():
+    '''
+        Messages which could not be delivered after all their attempts.
+        Bounded, the oldest entries are dropped when full.
+        Entries are (timestamp, reason, msg)
+    '''
+
+    def __init__(self, max_items=1000):
+        self._items = deque(maxlen=max_items)
+        self.total = 0
+
+    def add(self, msg, reason):
+        logger.warning('Giving up on message after {} attempts ({}): {}'.format(
+            msg.delivery_attempts, reason, msg))
+        self._items.append((time.time(), reason, msg))
+        self.total += 1
+
+    def items(self):
+        ''' snapshot of the stored entries, oldest first '''
+        return list(self._items)
+
+    def pop_all(self):
+        ''' remove and return all the stored entries '''
+        items = []
+        while self._items:
+            items.append(self._items.popleft())
+        return items
+
+    def __len__(self):
+        return len(self._items)
+
+
+class RetryQueue(StoppableThread):
+    '''
+        Holds messages which could not be delivered and hands them back to
+        'deliver' once their delay is over.
+        The delay doubles with every attempt (base_delay * 2^attempts, up to max_delay).
+        After max_attempts the message goes to the dead letter store.
+    '''
+
+    def __init__(self, deliver, base_delay=0.05, max_delay=5, max_attempts=10, dead_letters=None):
+        '''
+            deliver         -> callable(msg) to call when a message is due
+            base_delay      -> delay in seconds before the first retry
+            max_delay       -> cap of the delay in seconds
+            max_attempts    -> attempts after which a message is given up
+            dead_letters    -> DeadLetterStore for the given up messages (new one if None)
+        '''
+        super().__init__()
+
+        self._deliver = deliver
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+        self.dead_letters = dead_letters if dead_letters is not None else DeadLetterStore()
+
+        self._cond = Condition()
+        # (due time, sequence, msg), sequence keeps FIFO order between equal due times
+        self._heap = []
+        self._seq = count()
+        self._stopping = False
+
+        # Optional callable, called (without arguments) when a message becomes the next one due.
+        # For consumers driving the queue with pop_due() instead of the thread (eg. an asyncio loop)
+        self.listener = None
+
+    def retry(self, msg, reason):
+        '''
+            schedule a new delivery attempt of msg
+            returns False if msg has no attempts left and went to the dead letters
+        '''
+        if msg.delivery_attempts >= self.max_attempts:
+            self.dead_letters.add(msg, reason)
+            return False
+
+        delay = min(self.base_delay * (2 ** msg.delivery_attempts), self.max_delay)
+        msg.delivery_attempts += 1
+
+        with self._cond:
+            heapq.heappush(self._heap, (time.monotonic() + delay, next(self._seq), msg))
+            # Only wake the thread up if this is now the earliest message
+            earliest = self._heap[0][2] is msg
+            if earliest:
+                self._cond.notify()
+        if earliest and self.listener is not None:
+            self.listener()
+        return True
+
+    def pop_due(self):
+        '''
+            Returns (messages due now, seconds until the next one is due or None)
+            To drive the queue without its thread
+        '''
+        with self._cond:
+            return self._pop_due(time.monotonic())
+
+    def _pop_due(self, now):
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            due.append(heapq.heappop(self._heap)[2])
+        return due, (self._heap[0][0] - now) if self._heap else None
+
+    def pending(self):
+        ''' number of messages waiting for their retry '''
+        return len(self._heap)
+
+    def start(self):
+        self._stopping = False
+        super().start()
+
+    def stop(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify()
+        return super().stop()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._stopping:
+                    now = time.monotonic()
+                    if self._heap and self._heap[0][0] <= now:
+                        break
+                    self._cond.wait(self._heap[0][0] - now if self._heap else None)
+
+                if self._stopping:
+                    break
+
+                due, _ = self._pop_due(time.monotonic())
+
+            # Deliver outside of the lock, deliver may end up calling retry()
+            for msg in due:
+                self._deliver(msg)
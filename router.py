@@ -2,9 +2,14 @@
 import logging
 
 import queue
+import time
+from threading import Thread
 
-from queues import INBOUND_MSG_QUEUE, RxQItem
+import metrics
+import tracing
+from queues import INBOUND_MSG_QUEUE, RxQItem, unbatch
 from misc import StoppableThread
+from retry_queue import RetryQueue
 from master_instance import MasterInstance
 
 from pb_cfg import LOGGER_NAME
@@ -19,52 +24,198 @@ class Router(StoppableThread):
     MULTIPLE_TGT_INSTANCES = 2
     COULD_ROUTE = 3
 
-    def __init__(self, instance_manager):
+    def __init__(self, instance_manager, shards=0, max_attempts=10, batch_size=256):
+        '''
+            instance_manager    -> InstanceManager used to find and reach the instances
+            shards              -> number of routing threads. Messages are spread by chat id
+                                    so the messages of a chat are always routed in order.
+                                    0 to route in the thread reading INBOUND_MSG_QUEUE.
+            max_attempts        -> delivery attempts before a message goes to the dead letters
+            batch_size          -> max number of queue items drained from INBOUND_MSG_QUEUE at once.
+                                    A batch is routed as a whole, the messages for the same
+                                    instance are dispatched with a single put
+        '''
         super().__init__()
 
         self.IM = instance_manager
+        self._batch_size = max(1, batch_size)
+
+        # Messages that can't be delivered yet wait here and are routed again later
+        self.retries = RetryQueue(self._submit, max_attempts=max_attempts)
+        # Messages given up after max_attempts, kept for inspection
+        self.dead_letters = self.retries.dead_letters
+
+        # Due retries for the router thread when not sharded, kept out of INBOUND_MSG_QUEUE
+        self._due_retries = queue.SimpleQueue()
+
+        self._shard_qs = [queue.Queue() for _ in range(shards)]
+        self._shard_threads = []
+
+    def start(self):
+        for (idx, shard_q) in enumerate(self._shard_qs):
+            shard = Thread(target=self._shard_worker, args=(shard_q,),
+                           name='{}:shard_{}'.format(type(self).__name__, idx))
+            shard.daemon = True
+            shard.start()
+            self._shard_threads.append(shard)
+
+        self.retries.start()
+        super().start()
+
+    def stop(self):
+        alive = super().stop()
+        alive = self.retries.stop() or alive
+        pending = self.retries.pending() + self._due_retries.qsize()
+        if pending:
+            logger.warning('Dropping {} messages waiting for a retry'.format(pending))
+
+        # Let the shards route what they already have and stop them
+        for shard_q in self._shard_qs:
+            shard_q.put(None)
+        for shard in self._shard_threads:
+            shard.join(2)
+            alive = alive or shard.is_alive()
+        self._shard_threads = []
+
+        return alive
+
+    def shard_depths(self):
+        ''' number of messages waiting in each shard '''
+        return [shard_q.qsize() for shard_q in self._shard_qs]
+
+    def queue_depths(self):
+        ''' dict queue name -> depth, for the MetricsServer '''
+        return {'router_shard_{}'.format(idx): depth for (idx, depth) in enumerate(self.shard_depths())}
 
     def _run(self):
 
         while True:
 
-            next_message = None
+            # Retries that became due since the last batch
+            retried = []
+            while not self._due_retries.empty():
+                retried.append(self._due_retries.get())
+            if retried:
+                self._handle_rx_batch(retried)
+
+            batch = []
             try:
                 # Give a timeout so thread can be stopped if left with an empty q
-                next_message = INBOUND_MSG_QUEUE.get(timeout=1)
+                # Shorter while retries are waiting, nothing wakes this thread up when one is due
+                batch.append(INBOUND_MSG_QUEUE.get(
+                    timeout=self.retries.base_delay if self.retries.pending() else 1))
             except queue.Empty:
                 pass
 
-            if next_message:
-                result, inst_id = self._route_rx_message(next_message)
-                if result == self.COULD_ROUTE:
-                    self._dispatch_message(inst_id, next_message)
-
-                elif next_message.delivery_attempts > 10:
-                    # Message has been attempted to re-deliver more than 10 times
-                    # Seems there is some problem, to be safe for now, discard the message
-                    pass
-
-                elif result == self.TGT_INSTANCE_NOT_ACTIVE:
-                    # TODO Call instance manager to try to wake up
-                    next_message.delivery_attempts += 1
-                    # Put item at the end of the queue
-                    INBOUND_MSG_QUEUE.put(next_message)
-                elif result == self.MULTIPLE_TGT_INSTANCES:
-                    # TODO Call the game manager to resolve the issue
-                    next_message.delivery_attempts += 1
-                    # Put item at the end of the queue
-                    INBOUND_MSG_QUEUE.put(next_message)
-                elif result == self.COULD_NOT_ROUTE:
-                    # New 'user'
-                    next_message.delivery_attempts += 1
-                    msg = {'task': MasterInstance.TASK_HANDLE_NEW_USER,
-                           'msg': next_message}
-                    self.IM.send_to_master_instance(msg)
+            # Take whatever else is already waiting without blocking
+            while batch and len(batch) < self._batch_size and not INBOUND_MSG_QUEUE.empty():
+                try:
+                    batch.append(INBOUND_MSG_QUEUE.get_nowait())
+                except queue.Empty:
+                    break
+
+            if batch:
+                self._submit_batch([msg for item in batch for msg in unbatch(item)])
 
             if self.should_stop():
                 break
 
+    def _submit(self, msg):
+        '''
+            hand a due retry to the thread routing its chat, its shard or the router
+            thread: the messages of a chat are never routed by two threads at once
+            A retried message can still be routed after newer messages of its chat
+        '''
+        if self._shard_qs:
+            self._shard_qs[hash(msg.chat_id) % len(self._shard_qs)].put(msg)
+        else:
+            self._due_retries.put(msg)
+
+    def _submit_batch(self, msgs):
+        ''' route a batch in the shards (one put per shard), or right away if not sharded '''
+        if not self._shard_qs:
+            self._handle_rx_batch(msgs)
+            return
+
+        by_shard = {}
+        for msg in msgs:
+            by_shard.setdefault(hash(msg.chat_id) % len(self._shard_qs), []).append(msg)
+        for (shard, shard_msgs) in by_shard.items():
+            self._shard_qs[shard].put(shard_msgs)
+
+    def _shard_worker(self, shard_q):
+        while True:
+            item = shard_q.get()
+            if item is None:
+                break
+            if type(item) is list:
+                self._handle_rx_batch(item)
+            else:
+                self._handle_rx_message(item)
+
+    def route_batch(self, msgs):
+        ''' route and dispatch a batch of inbound messages in the calling thread, for a runtime driving the router '''
+        self._handle_rx_batch(msgs)
+
+    def _handle_rx_batch(self, msgs):
+        ''' route a batch of inbound messages, dispatch them grouped per instance '''
+        # inst_id -> messages for it, in order
+        outbox = {}
+        # A batch is routed within microseconds, one stamp is enough for all its messages
+        now = time.monotonic()
+        for msg in msgs:
+            self._handle_rx_message(msg, outbox, now)
+
+        for (inst_id, inst_msgs) in outbox.items():
+            if not self._dispatch_message(inst_id, inst_msgs if len(inst_msgs) > 1 else inst_msgs[0]):
+                for msg in inst_msgs:
+                    self.retries.retry(msg, 'TGT_INSTANCE_GONE')
+
+    def _handle_rx_message(self, next_message, outbox=None, now=None):
+        '''
+            route and dispatch an inbound message
+            outbox  -> dict inst_id -> list, to collect the routed messages instead of dispatching them
+            now     -> time.monotonic() taken for the batch of the message
+        '''
+
+        if now is None:
+            now = time.monotonic()
+        previous, next_message.routed_at = next_message.routed_at, now
+        if previous is None:
+            # Retries are not new arrivals, their wait is the retry delay
+            metrics.observe(metrics.HOP_RX_TO_ROUTER, now - next_message.rx_at)
+
+        result, inst_id = self._route_rx_message(next_message)
+        metrics.count_route(result)
+
+        if next_message.trace_id is not None:
+            # Routed before: it was waiting in the retries since
+            tracing.span(next_message.trace_id, 'retry_wait' if previous else 'inbound_queue',
+                         previous or next_message.rx_at, now)
+            tracing.span(next_message.trace_id, 'route', now, time.monotonic(),
+                         result=metrics.ROUTER_RESULTS[result], attempts=next_message.delivery_attempts)
+        if result == self.COULD_ROUTE:
+            if outbox is not None:
+                outbox.setdefault(inst_id, []).append(next_message)
+            elif not self._dispatch_message(inst_id, next_message):
+                # Instance gone between lookup and dispatch, the routing table may be behind
+                self.retries.retry(next_message, 'TGT_INSTANCE_GONE')
+
+        elif result == self.TGT_INSTANCE_NOT_ACTIVE:
+            # Instance hibernated, wake it up and try again a bit later
+            self.IM.wake_instance(inst_id)
+            self.retries.retry(next_message, 'TGT_INSTANCE_NOT_ACTIVE')
+        elif result == self.MULTIPLE_TGT_INSTANCES:
+            # TODO Call the game manager to resolve the issue
+            # Try again later, with backoff
+            self.retries.retry(next_message, 'MULTIPLE_TGT_INSTANCES')
+        elif result == self.COULD_NOT_ROUTE:
+            # New 'user'
+            next_message.delivery_attempts += 1
+            msg = {'task': MasterInstance.TASK_HANDLE_NEW_USER,
+                   'msg': next_message}
+            self.IM.send_to_master_instance(msg)
+
     def _route_rx_message(self, msg):
         ''' route an inbound msg '''
 
@@ -72,24 +223,24 @@ class Router(StoppableThread):
         by_chat_id = []
         by_user_id = []
 
-        logger.debug('Routing -- {}'.format(msg))
+        logger.debug('Routing -- %s', msg)
 
         # Shoule we route by GROUP
         if bool(msg.route_by & RxQItem.ROUTE_BY_GAME_CODE):
             by_game_code = self.IM.game_code_to_instance_id(
                 msg.game_code)
             if len(by_game_code) == 1:
-                return self.COULD_ROUTE, by_game_code[0]
+                return self._found(by_game_code[0])
         if bool(msg.route_by & RxQItem.ROUTE_BY_CHAT_ID):
-            by_chat_id = self.IM.game_code_to_instance_id(
+            by_chat_id = self.IM.chat_id_to_instance_id(
                 msg.chat_id)
             if len(by_chat_id) == 1:
-                return self.COULD_ROUTE, by_chat_id[0]
+                return self._found(by_chat_id[0])
         if bool(msg.route_by & RxQItem.ROUTE_BY_USER_ID):
-            by_user_id = self.IM.game_code_to_instance_id(
-                msg.chat_id)
+            by_user_id = self.IM.user_id_to_instance_id(
+                msg.user_id)
             if len(by_user_id) == 1:
-                return self.COULD_ROUTE, by_user_id[0]
+                return self._found(by_user_id[0])
 
         # User/Chat/Game not registered in any instance
         if not by_game_code and not by_chat_id and not by_user_id:
@@ -98,5 +249,19 @@ class Router(StoppableThread):
         else:
             return self.MULTIPLE_TGT_INSTANCES, by_game_code + by_chat_id + by_user_id
 
+    def _found(self, inst_id):
+        ''' result for a message with a single target instance '''
+        if not self.IM.is_active(inst_id):
+            return self.TGT_INSTANCE_NOT_ACTIVE, inst_id
+        return self.COULD_ROUTE, inst_id
+
     def _dispatch_message(self, instance_id, msg):
-        return self.IM.get(instance_id).input_msg_q.put(msg)
+        ''' put msg (a message or a list of them) in the q of an instance '''
+        inst = self.IM.get(instance_id)
+        if inst is None:
+            # Instance destroyed since the lookup, its id is not valid anymore
+            logger.debug('Instance %s does not exist anymore', instance_id)
+            return False
+        inst.input_msg_q.put(msg)
+        self.IM.touch(instance_id)
+        return True
@@ -0,0 +1,180 @@
+''' chat/user/game code -> instance id table shared by every process '''
+import logging
+
+from queue import Empty
+from threading import Lock as TLock
+
+from misc import StoppableThread
+from queues import ROUTING_UPDATES_QUEUE
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class RoutingTable(StoppableThread):
+    '''
+        Lives in the main process, next to the router.
+        Instances run in their own process, so they can't touch the table directly.
+        They publish their membership changes in ROUTING_UPDATES_QUEUE
+        (see Instance.register()/unregister()) and the thread of this class
+        applies them as soon as they arrive.
+
+        Lookups never take a lock nor do any IPC: index values are tuples which
+        are replaced on every write, never mutated.
+        version is incremented for every change applied to the table.
+    '''
+
+    # Update operations
+    OP_REGISTER = 0
+    OP_UNREGISTER = 1
+
+    def __init__(self, updates_q=ROUTING_UPDATES_QUEUE):
+        super().__init__()
+
+        self._updates_q = updates_q
+
+        self._lock = TLock()
+        self._by_chat_id = {}
+        self._by_user_id = {}
+        self._by_game_code = {}
+        # instance id -> (chat ids, user ids, game codes) registered by it
+        # Only instances in here can register members
+        self._members = {}
+
+        self.version = 0
+
+    @staticmethod
+    def _index_add(index, key, inst_id):
+        ids = index.get(key, ())
+        if inst_id not in ids:
+            index[key] = ids + (inst_id,)
+
+    @staticmethod
+    def _index_remove(index, key, inst_id):
+        ids = tuple(x for x in index.get(key, ()) if x != inst_id)
+        if ids:
+            index[key] = ids
+        else:
+            index.pop(key, None)
+
+    @property
+    def updates_q(self):
+        ''' q the instances publish their changes to, applied by the thread or by apply() '''
+        return self._updates_q
+
+    def add_instance(self, inst_id):
+        ''' allow an instance to register members '''
+        with self._lock:
+            self._members.setdefault(inst_id, (set(), set(), set()))
+            self.version += 1
+
+    def drop_instance(self, inst_id):
+        '''
+            remove every entry pointing to an instance
+            updates still in flight for it will be ignored
+        '''
+        with self._lock:
+            chats, users, codes = self._members.pop(
+                inst_id, (set(), set(), set()))
+            for chat_id in chats:
+                self._index_remove(self._by_chat_id, chat_id, inst_id)
+            for user_id in users:
+                self._index_remove(self._by_user_id, user_id, inst_id)
+            for game_code in codes:
+                self._index_remove(self._by_game_code, game_code, inst_id)
+            self.version += 1
+
+    def register(self, inst_id, chat_ids=(), user_ids=(), game_code=None):
+        ''' make an instance reachable by the given chat ids, user ids and/or game code '''
+        with self._lock:
+            if inst_id not in self._members:
+                logger.debug('Ignoring registration for unknown instance %s', inst_id)
+                return False
+            chats, users, codes = self._members[inst_id]
+
+            for chat_id in chat_ids:
+                self._index_add(self._by_chat_id, chat_id, inst_id)
+                chats.add(chat_id)
+            for user_id in user_ids:
+                self._index_add(self._by_user_id, user_id, inst_id)
+                users.add(user_id)
+            if game_code is not None:
+                # An instance has a single game code
+                for old_code in codes:
+                    self._index_remove(self._by_game_code, old_code, inst_id)
+                codes.clear()
+                self._index_add(self._by_game_code, game_code, inst_id)
+                codes.add(game_code)
+
+            self.version += 1
+            return True
+
+    def unregister(self, inst_id, chat_ids=(), user_ids=(), game_code=None):
+        ''' opposite of register '''
+        with self._lock:
+            if inst_id not in self._members:
+                return False
+            chats, users, codes = self._members[inst_id]
+
+            for chat_id in chat_ids:
+                self._index_remove(self._by_chat_id, chat_id, inst_id)
+                chats.discard(chat_id)
+            for user_id in user_ids:
+                self._index_remove(self._by_user_id, user_id, inst_id)
+                users.discard(user_id)
+            if game_code is not None:
+                self._index_remove(self._by_game_code, game_code, inst_id)
+                codes.discard(game_code)
+
+            self.version += 1
+            return True
+
+    def members(self, inst_id):
+        ''' (chat ids, user ids, game code) currently registered for an instance '''
+        chats, users, codes = self._members.get(inst_id, (set(), set(), set()))
+        return list(chats), list(users), next(iter(codes), None)
+
+    def apply(self, update):
+        ''' apply an update tuple as published in ROUTING_UPDATES_QUEUE '''
+        op, inst_id, chat_ids, user_ids, game_code = update
+        if op == self.OP_REGISTER:
+            self.register(inst_id, chat_ids, user_ids, game_code)
+        elif op == self.OP_UNREGISTER:
+            self.unregister(inst_id, chat_ids, user_ids, game_code)
+        else:
+            logger.error('Routing update with incorrect format {}'.format(update))
+
+    def by_chat_id(self, chat_id):
+        return self._by_chat_id.get(chat_id, ())
+
+    def by_user_id(self, user_id):
+        return self._by_user_id.get(user_id, ())
+
+    def by_game_code(self, game_code):
+        return self._by_game_code.get(game_code, ())
+
+    def _run(self):
+        while True:
+
+            if self.should_stop():
+                break
+
+            try:
+                update = self._updates_q.get(timeout=1)
+            except Empty:
+                continue
+
+            self.apply(update)
+
+
+def publish_register(updates_q, inst_id, chat_ids=(), user_ids=(), game_code=None):
+    ''' to be called from any process, see RoutingTable '''
+    updates_q.put((RoutingTable.OP_REGISTER, inst_id,
+                   tuple(chat_ids), tuple(user_ids), game_code))
+
+
+def publish_unregister(updates_q, inst_id, chat_ids=(), user_ids=(), game_code=None):
+    ''' to be called from any process, see RoutingTable '''
+    updates_q.put((RoutingTable.OP_UNREGISTER, inst_id,
+                   tuple(chat_ids), tuple(user_ids), game_code))
@@ -3,11 +3,12 @@
 import logging
 import time
 
+from collections import deque
 from copy import deepcopy
 
 from queues import TxQItem
-
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+from reply_cache import inline_keyboard, render
+from state_machine import StateTable, Step
 
 from pb_cfg import LOGGER_NAME
 
@@ -18,15 +19,23 @@ class Session():
     '''
         Session between user and bot.
         It is volatile, will be lost after a timeout or disconection.
+        Subclasses describe their flow with a StateTable in STATES,
+        iterate() runs it from the current state.
     '''
+    __slots__ = ('messages', 'alive_timestamp', 'state', 'with_user', 'with_chat',
+                 'output_q', 'on_refresh')
+
     TIMEOUT = 60
+    STATES = None
+    # Updates kept in messages, the oldest ones are dropped
+    MAX_MESSAGES = 8
 
-    def __init__(self, output_q=None):
+    def __init__(self, output_q=None, on_refresh=None):
 
         if not output_q:
             raise "Output queue needed !"
 
-        self.messages = []
+        self.messages = deque(maxlen=self.MAX_MESSAGES)
         self.alive_timestamp = time.time()
         self.state = None
 
@@ -35,10 +44,37 @@ class Session():
 
         self.output_q = output_q
 
+        # Called with the session every time it is refreshed (eg. to re-arm its timeout)
+        self.on_refresh = on_refresh
+
     def iterate(self, *args, **kwargs):
         self.alive_timestamp = time.time()
-
-    def end_sesion(self):
+        if 'update' in kwargs:
+            self.messages.append(kwargs['update'])
+        if self.on_refresh is not None:
+            self.on_refresh(self)
+        if self.STATES is not None:
+            self.state = self.STATES.run(self, self.state, kwargs)
+
+    def save_state(self):
+        ''' picklable snapshot of the session, the queues and callbacks are not part of it '''
+        return {
+            'messages': list(self.messages),
+            'alive_timestamp': self.alive_timestamp,
+            'state': self.state,
+            'with_user': self.with_user,
+            'with_chat': self.with_chat,
+        }
+
+    def restore_state(self, state):
+        ''' opposite of save_state, called on a freshly constructed session '''
+        self.messages = deque(state['messages'], maxlen=self.MAX_MESSAGES)
+        self.alive_timestamp = state['alive_timestamp']
+        self.state = state['state']
+        self.with_user = state['with_user']
+        self.with_chat = state['with_chat']
+
+    def end_session(self):
 
         if self.with_chat and self.output_q:
             # Send timeout message
@@ -49,6 +85,8 @@ class SelectGameSession(Session):
     '''
         Session to start a new game
     '''
+    __slots__ = ('game_selected',)
+
     # States:
     S_FIRST_CONTACT = 0
     S_OFFER_GAMES = 1
@@ -68,98 +106,94 @@ class SelectGameSession(Session):
 
     ]
 
-    def __init__(self, intit_state=S_FIRST_CONTACT, output_q=None):
+    WELCOME_TEXT = '''Welcome ! I am the Game Master !\nWhat game you would like to play ?'''
+    GAME_SELECTED_TEXT = 'Great ! You have selected {}'
+    CREATING_INSTANCE_TEXT = 'Creating new game instance for {}'
+
+    def __init__(self, intit_state=S_FIRST_CONTACT, output_q=None, on_refresh=None):
 
-        super().__init__(output_q)
+        super().__init__(output_q, on_refresh)
 
         self.state = intit_state
 
         self.game_selected = None
 
-    def iterate(self, *args, **kwargs):
-        '''
-            Given args and kwargs move the state machine if possible
-        '''
-
-        super().iterate(*args, **kwargs)
-
-        while True:
-
-            if self.state == self.S_FIRST_CONTACT:
-                if 'update' not in kwargs:
-                    self.state = self.S_ERROR
-                    continue
-                msg = kwargs['update'].message
-                text = '''Welcome ! I am the Game Master !\nWhat game you would like to play ?'''
-                keyboard_markup = InlineKeyboardMarkup(
-                    [
-                        [InlineKeyboardButton(game['name'], callback_data=game['ID'])] for game in self.GAMES
-                    ]
-                )
-
-                self.output_q.send_message(
-                    msg.chat.id, text, reply_markup=keyboard_markup)
-
-                self.state = self.S_GAME_OFFER_RESPONSE
-
-                self.with_chat = msg.chat.id
-                self.with_user = msg.from_user.id
-                return True
-
-            elif self.state == self.S_OFFER_GAMES:
-                pass
-            elif self.state == self.S_GAME_OFFER_RESPONSE:
-                logger.debug('Hi !'.format())
-                if 'update' not in kwargs
-                        or not kwargs['update'].callback_query:
-                    self.state=self.S_ERROR
-                    continue
-
-                upd=kwargs['update']
-                query=upd.callback_query
-
-                self.output_q.answer_callback_query(query.id)
-                # Get user selection
-                if not query.data or query.data == "" or int(query.data) >= len(self.GAMES):
-                    # Strange answer
-                    # Ignore it
-                    return
-
-                # Delete the inline keyboard after the repply
-                self.output_q.edit_message_reply_markup(
-                    chat_id = query.message.chat.id,
-                    message_id = query.message.message_id,
-                    reply_markup = None)
-
-                self.game_selected=int(query.data)
-                self.state=self.S_GAME_SELECTED
-
-            elif self.state == self.S_GAME_SELECTED:
-                if self.game_selected is None:
-                    self.state=self.S_ERROR
-                    logger.error('No game selected !')
-                    continue
-
-                text="Great ! You have selected {}".format(
-                    self.GAMES[self.game_selected]['name'])
-
-                self.output_q.send_message(self.with_chat, text)
-
-                self.state=self.S_CREATE_GAME_INSTANCE
-
-            elif self.state == self.S_CREATE_GAME_INSTANCE:
-                self.output_q.send_message(self.with_chat, 'Creating new game instance for {}'.format(
-                    self.GAMES[self.game_selected]['name']))
-
-                self.state=self.S_EXIT
-
-            elif self.state == self.S_GAME_INSTANCE_CREATED:
-                pass
-            elif self.state == self.S_REDIRECT_USER:
-                pass
-            elif self.state == self.S_EXIT:
-                break
-
-            elif self.state == self.S_ERROR:
-                logger.error('Entered in error state !'.format())
-                break
+    @classmethod
+    def games_keyboard(cls):
+        ''' one button per game, serialized once '''
+        return inline_keyboard(tuple(((game['name'], game['ID']),) for game in cls.GAMES))
+
+    def save_state(self):
+        state = super().save_state()
+        state['game_selected'] = self.game_selected
+        return state
+
+    def restore_state(self, state):
+        super().restore_state(state)
+        self.game_selected = state['game_selected']
+
+    def _first_contact(self, kwargs):
+        if 'update' not in kwargs:
+            return self.S_ERROR
+        upd = kwargs['update']
+        self.output_q.send_message(
+            upd.chat_id, self.WELCOME_TEXT, reply_markup=self.games_keyboard())
+
+        self.with_chat = upd.chat_id
+        self.with_user = upd.user_id
+        return self.S_GAME_OFFER_RESPONSE
+
+    def _game_offer_response(self, kwargs):
+        if 'update' not in kwargs \
+                or not kwargs['update'].is_callback_query():
+            return self.S_ERROR
+
+        upd = kwargs['update']
+
+        self.output_q.answer_callback_query(upd.callback_query_id)
+        # Get user selection
+        if not upd.callback_data or upd.callback_data == "" or int(upd.callback_data) >= len(self.GAMES):
+            # Strange answer
+            # Ignore it
+            return self.S_GAME_OFFER_RESPONSE
+
+        # Delete the inline keyboard after the repply
+        self.output_q.edit_message_reply_markup(
+            chat_id=upd.chat_id,
+            message_id=upd.message_id,
+            reply_markup=None)
+
+        self.game_selected = int(upd.callback_data)
+        return self.S_GAME_SELECTED
+
+    def _game_selected(self, kwargs):
+        if self.game_selected is None:
+            logger.error('No game selected !')
+            return self.S_ERROR
+
+        text = render(self.GAME_SELECTED_TEXT, self.GAMES[self.game_selected]['name'])
+
+        self.output_q.send_message(self.with_chat, text)
+        return self.S_CREATE_GAME_INSTANCE
+
+    def _create_game_instance(self, kwargs):
+        self.output_q.send_message(self.with_chat, render(
+            self.CREATING_INSTANCE_TEXT, self.GAMES[self.game_selected]['name']))
+        return self.S_EXIT
+
+    def _exit(self, kwargs):
+        return self.S_EXIT
+
+    def _error(self, kwargs):
+        logger.error('Entered in error state !')
+        return self.S_ERROR
+
+    # S_OFFER_GAMES, S_GAME_INSTANCE_CREATED and S_REDIRECT_USER have no step yet
+    STATES = StateTable({
+        S_FIRST_CONTACT: Step(_first_contact, (S_GAME_OFFER_RESPONSE, S_ERROR), needs_input=True),
+        S_GAME_OFFER_RESPONSE: Step(_game_offer_response, (S_GAME_SELECTED, S_ERROR), needs_input=True),
+        S_GAME_SELECTED: Step(_game_selected, (S_CREATE_GAME_INSTANCE, S_ERROR)),
+        S_CREATE_GAME_INSTANCE: Step(_create_game_instance, (S_EXIT,)),
+        S_EXIT: Step(_exit),
+        S_ERROR: Step(_error),
+    }, error_state=S_ERROR)
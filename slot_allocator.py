@@ -0,0 +1,78 @@
+''' O(1) allocation of instance slots with generation tagged ids '''
+import logging
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class SlotAllocator():
+    '''
+        Hands out instance ids backed by a growable list of slots.
+        - acquire()/release() are O(1), free slots are kept in a stack
+        - Capacity doubles when there are no free slots, up to max_capacity
+        - An id is (generation << SLOT_BITS) | slot. The generation of a slot
+          is bumped every time it is released, so an id kept by someone after
+          its instance was destroyed never resolves to the next instance in that slot.
+    '''
+    SLOT_BITS = 24
+    SLOT_MASK = (1 << SLOT_BITS) - 1
+
+    def __init__(self, initial_capacity=16, max_capacity=4096):
+
+        if max_capacity > self.SLOT_MASK + 1:
+            raise ValueError('max_capacity can not be bigger than {}'.format(
+                self.SLOT_MASK + 1))
+
+        self.max_capacity = max_capacity
+        self._generations = []
+        self._in_use = []
+        self._free = []
+        self._grow(max(1, min(initial_capacity, max_capacity)))
+
+    @property
+    def capacity(self):
+        return len(self._generations)
+
+    def __len__(self):
+        ''' number of slots in use '''
+        return len(self._generations) - len(self._free)
+
+    def _grow(self, new_capacity):
+        old_capacity = len(self._generations)
+        self._generations.extend([0] * (new_capacity - old_capacity))
+        self._in_use.extend([False] * (new_capacity - old_capacity))
+        # Lowest slots are handed out first
+        self._free.extend(range(new_capacity - 1, old_capacity - 1, -1))
+
+    def acquire(self):
+        ''' returns a new instance id, None if max_capacity is reached '''
+        if not self._free:
+            if self.capacity >= self.max_capacity:
+                return None
+            self._grow(min(self.capacity * 2, self.max_capacity))
+            logger.debug('Instance slots grown to %s', self.capacity)
+
+        slot = self._free.pop()
+        self._in_use[slot] = True
+        return (self._generations[slot] << self.SLOT_BITS) | slot
+
+    def release(self, inst_id):
+        ''' give back the slot of inst_id, False if inst_id is not valid (anymore) '''
+        slot = self.slot_of(inst_id)
+        if slot is None:
+            return False
+        self._in_use[slot] = False
+        self._generations[slot] += 1
+        self._free.append(slot)
+        return True
+
+    def slot_of(self, inst_id):
+        ''' slot backing inst_id, None if the id is stale or was never handed out '''
+        if inst_id is None or inst_id < 0:
+            return None
+        slot = inst_id & self.SLOT_MASK
+        if slot >= len(self._generations) or not self._in_use[slot] \
+                or self._generations[slot] != inst_id >> self.SLOT_BITS:
+            return None
+        return slot
@@ -0,0 +1,116 @@
+''' table driven state machines for the sessions '''
+import logging
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class Step():
+    '''
+        One state of a StateTable
+        handler     -> function(session, kwargs) returning the next state,
+                        its own state to stay (eg. input ignored)
+        next_states -> states the handler may return, empty for a final state
+        needs_input -> True if the state handles a message: the machine stops when
+                        entering it and runs it on the next iterate()
+    '''
+    __slots__ = ('handler', 'next_states', 'needs_input')
+
+    def __init__(self, handler, next_states=(), needs_input=False):
+        self.handler = handler
+        self.next_states = frozenset(next_states)
+        self.needs_input = needs_input
+
+
+class StateTable():
+    '''
+        Transition table of a state machine: state -> Step
+        The table is checked when it is built, a state which could hand over to
+        a missing state or a loop of states which never wait for input raise ValueError.
+        run() finds the handler of each state with one dict lookup.
+    '''
+
+    def __init__(self, steps, error_state):
+        '''
+            steps       -> dict state -> Step
+            error_state -> where the machine goes when something unexpected happens,
+                            must be in steps
+        '''
+        self._steps = dict(steps)
+        self.error_state = error_state
+
+        self._check()
+
+        # Each state runs at most once per run() in a valid table
+        self._max_steps = len(self._steps) + 1
+
+    def _check(self):
+        if self.error_state not in self._steps:
+            raise ValueError('Error state {} has no step'.format(self.error_state))
+
+        for (state, step) in self._steps.items():
+            missing = [s for s in step.next_states if s not in self._steps]
+            if missing:
+                raise ValueError('State {} leads to states without step: {}'.format(state, missing))
+
+        # A cycle of states that don't wait for input would spin forever
+        DONE, ON_PATH = 0, 1
+        marks = {}
+
+        def visit(state, path):
+            marks[state] = ON_PATH
+            path.append(state)
+            for nxt in self._steps[state].next_states:
+                if nxt == state or self._steps[nxt].needs_input:
+                    continue
+                if marks.get(nxt) == ON_PATH:
+                    raise ValueError('States {} loop without waiting for input'.format(
+                        path[path.index(nxt):]))
+                if nxt not in marks:
+                    visit(nxt, path)
+            path.pop()
+            marks[state] = DONE
+
+        for state in self._steps:
+            if state not in marks:
+                visit(state, [])
+
+    def __contains__(self, state):
+        return state in self._steps
+
+    def run(self, session, state, kwargs):
+        '''
+            Run the machine from state with the input kwargs, returns the state
+            it stopped in: one waiting for input, a final one or the error state
+        '''
+        steps = self._steps
+        for _ in range(self._max_steps):
+            step = steps.get(state)
+            if step is None:
+                logger.error('No step for state {} in {}'.format(state, type(session).__name__))
+                return self._enter_error(session, kwargs)
+
+            next_state = step.handler(session, kwargs)
+
+            if next_state == state:
+                if step.needs_input or not step.next_states:
+                    return state
+                logger.error('State {} of {} made no progress'.format(state, type(session).__name__))
+                return self._enter_error(session, kwargs)
+
+            if next_state not in step.next_states:
+                logger.error('Invalid transition {} -> {} in {}'.format(
+                    state, next_state, type(session).__name__))
+                return self._enter_error(session, kwargs)
+
+            state = next_state
+            if steps[state].needs_input:
+                return state
+
+        logger.error('{} did not settle, stopped in state {}'.format(type(session).__name__, state))
+        return self._enter_error(session, kwargs)
+
+    def _enter_error(self, session, kwargs):
+        self._steps[self.error_state].handler(session, kwargs)
+        return self.error_state
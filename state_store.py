@@ -0,0 +1,210 @@
+''' durable sessions and instance snapshots '''
+import logging
+import os
+import pickle
+import sqlite3
+import zlib
+
+from threading import Condition, Lock, Thread
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+class StateStore():
+    '''
+        SQLite database (WAL mode) with the sessions of the master instances and
+        the snapshots of the game instances, a restart resumes from it.
+
+        Sessions are written behind: put_session()/delete_session() only keep the
+        latest value of each chat in memory, a writer thread commits whatever
+        accumulated every flush_interval seconds in a single transaction.
+        The message path never waits for the disk.
+        Instance snapshots are rare, save()/load()/delete() (same interface as
+        HibernationStore) are committed right away.
+
+        Only holds the path and settings, can be passed to other processes:
+        every process opens its own connection and writer thread on first use.
+    '''
+
+    def __init__(self, path, flush_interval=0.05):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._pid = None
+
+    def __getstate__(self):
+        return {'path': self.path, 'flush_interval': self.flush_interval}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def _open(self):
+        ''' connection of the current process, forked children get their own '''
+        if self._pid == os.getpid():
+            return
+        self._pid = os.getpid()
+
+        self._db_lock = Lock()
+        self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        self._conn.execute('PRAGMA journal_mode=WAL')
+        # Durable at each checkpoint, a crash can only lose the last group commits
+        self._conn.execute('PRAGMA synchronous=NORMAL')
+        self._conn.execute('PRAGMA busy_timeout=5000')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS sessions (chat_id PRIMARY KEY, data BLOB)')
+        self._conn.execute('CREATE TABLE IF NOT EXISTS instances (inst_id INTEGER PRIMARY KEY, data BLOB)')
+        # Snapshots of the previous runs waiting to be resumed, see stage_instances()
+        self._conn.execute('CREATE TABLE IF NOT EXISTS staged_instances '
+                           '(key INTEGER PRIMARY KEY AUTOINCREMENT, data BLOB)')
+
+        # chat_id -> pickled session, None to delete it
+        self._pending = {}
+        self._cond = Condition()
+        self._closed = False
+        self._writer = None
+
+    def _start_writer(self):
+        self._writer = Thread(target=self._write_behind, daemon=True,
+                              name='{}:writer'.format(type(self).__name__))
+        self._writer.start()
+
+    def _write_behind(self):
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed and not self._pending:
+                    return
+            # Let a few more writes accumulate in the same transaction
+            with self._cond:
+                self._cond.wait_for(lambda: self._closed, self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        ''' commit the pending session writes now '''
+        self._open()
+        with self._cond:
+            batch, self._pending = self._pending, {}
+        if not batch:
+            return
+
+        upserts = [(chat_id, data) for (chat_id, data) in batch.items() if data is not None]
+        deletes = [(chat_id,) for (chat_id, data) in batch.items() if data is None]
+        with self._db_lock:
+            try:
+                self._conn.execute('BEGIN')
+                self._conn.executemany('INSERT OR REPLACE INTO sessions VALUES (?, ?)', upserts)
+                self._conn.executemany('DELETE FROM sessions WHERE chat_id = ?', deletes)
+                self._conn.execute('COMMIT')
+            except sqlite3.Error as ex:
+                self._conn.execute('ROLLBACK')
+                logger.error('Failed to write {} sessions because of {}'.format(len(batch), ex))
+
+    def close(self):
+        ''' flush and stop the writer thread of this process '''
+        if self._pid != os.getpid():
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        if self._writer is not None:
+            self._writer.join()
+        self.flush()
+
+    def _queue_session(self, chat_id, data):
+        self._open()
+        with self._cond:
+            self._pending[chat_id] = data
+            self._cond.notify()
+        if self._writer is None:
+            self._start_writer()
+
+    def put_session(self, chat_id, kind, state):
+        ''' record the state of the session of chat_id, written in the background '''
+        self._queue_session(chat_id, pickle.dumps((kind, state), protocol=pickle.HIGHEST_PROTOCOL))
+
+    def delete_session(self, chat_id):
+        self._queue_session(chat_id, None)
+
+    def load_sessions(self):
+        ''' list of (chat_id, kind, state) of the saved sessions '''
+        self.flush()
+        with self._db_lock:
+            rows = self._conn.execute('SELECT chat_id, data FROM sessions').fetchall()
+
+        sessions = []
+        for (chat_id, data) in rows:
+            try:
+                kind, state = pickle.loads(data)
+            except Exception as ex:
+                logger.error('Dropping unreadable session of chat {} because of {}'.format(chat_id, ex))
+                self.delete_session(chat_id)
+                continue
+            sessions.append((chat_id, kind, state))
+        return sessions
+
+    def save(self, inst_id, kind, state):
+        ''' snapshot of an instance, returns its size in bytes '''
+        self._open()
+        data = zlib.compress(pickle.dumps((kind, state), protocol=pickle.HIGHEST_PROTOCOL))
+        with self._db_lock:
+            self._conn.execute('INSERT OR REPLACE INTO instances VALUES (?, ?)', (inst_id, data))
+        return len(data)
+
+    def load(self, inst_id):
+        ''' returns (kind, state), raises KeyError if there is no snapshot '''
+        self._open()
+        with self._db_lock:
+            row = self._conn.execute('SELECT data FROM instances WHERE inst_id = ?', (inst_id,)).fetchone()
+        if row is None:
+            raise KeyError(inst_id)
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def delete(self, inst_id):
+        self._open()
+        with self._db_lock:
+            self._conn.execute('DELETE FROM instances WHERE inst_id = ?', (inst_id,))
+
+    def exists(self, inst_id):
+        self._open()
+        with self._db_lock:
+            return self._conn.execute('SELECT 1 FROM instances WHERE inst_id = ?', (inst_id,)).fetchone() is not None
+
+    def instance_ids(self):
+        ''' ids of the saved instance snapshots '''
+        self._open()
+        with self._db_lock:
+            return [row[0] for row in self._conn.execute('SELECT inst_id FROM instances')]
+
+    def stage_instances(self):
+        '''
+            move the instance snapshots aside to be resumed, in one transaction:
+            the resumed instances get new ids, which may be the ids of snapshots not resumed yet.
+            Returns the keys of the staged snapshots (those of older runs too), see
+            load_staged()/delete_staged(). A snapshot stays staged until it is deleted.
+        '''
+        self._open()
+        with self._db_lock:
+            try:
+                self._conn.execute('BEGIN')
+                self._conn.execute('INSERT INTO staged_instances (data) SELECT data FROM instances')
+                self._conn.execute('DELETE FROM instances')
+                self._conn.execute('COMMIT')
+            except sqlite3.Error:
+                self._conn.execute('ROLLBACK')
+                raise
+            return [row[0] for row in self._conn.execute('SELECT key FROM staged_instances ORDER BY key')]
+
+    def load_staged(self, key):
+        ''' returns (kind, state) of a staged snapshot, raises KeyError if there is none '''
+        self._open()
+        with self._db_lock:
+            row = self._conn.execute('SELECT data FROM staged_instances WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            raise KeyError(key)
+        return pickle.loads(zlib.decompress(row[0]))
+
+    def delete_staged(self, key):
+        self._open()
+        with self._db_lock:
+            self._conn.execute('DELETE FROM staged_instances WHERE key = ?', (key,))
@@ -2,17 +2,20 @@
 
 import time
 import logging
+from queue import Empty, Queue
 from threading import Lock, Thread
 
-from inspect import signature
-
 from telegram import Bot
+from telegram.error import TelegramError, RetryAfter
 from telegram.ext import Updater, CallbackQueryHandler, MessageHandler
 from telegram.ext.filters import Filters
 
+import metrics
+import tracing
+from bot_dispatch import build_dispatch_table
 from pb_cfg import LOGGER_NAME
-from pvt_cfg import TELEGRAM_API_TOKEN
-from queues import OUTBOUND_MSG_QUEUE, INBOUND_MSG_QUEUE, RxQItem, TxQItem
+from rate_limiter import OutboundScheduler
+from queues import OUTBOUND_MSG_QUEUE, INBOUND_MSG_QUEUE, RxBatcher, RxQItem, RxUpdate, TxQItem
 
 
 logger = logging.getLogger(LOGGER_NAME)
@@ -21,19 +24,59 @@ logger = logging.getLogger(LOGGER_NAME)
 class TelegramAbstractionLayer():
     ''' I/O with telegram server '''
 
-    def __init__(self, api_key):
+    def __init__(self, api_key, sender_workers=4, tx_batch_size=32, scheduler=None, bot=None,
+                 webhook=None, webhook_url=None, updater=None, recorder=None):
+        '''
+            api_key         -> telegram bot token
+            bot             -> Bot (or look alike) to send with, a new Bot(api_key) if None
+            updater         -> Updater (or look alike) to poll with, a new Updater(api_key) if None
+            recorder        -> UpdateRecorder keeping a copy of every inbound update (polled
+                                or posted to the webhook), started and stopped with the TAL
+            sender_workers  -> number of threads calling the Bot concurrently
+            tx_batch_size   -> max number of TxQItem drained from the outbound queue at once
+            scheduler       -> OutboundScheduler enforcing the flood limits (default limits if None)
+            webhook         -> WebhookReceiver to get the updates from instead of polling
+            webhook_url     -> public url of the webhook, registered with telegram on start.
+                                None to leave the registration alone (eg. tests with a fake client)
+        '''
 
         self._exit_lock = Lock()
 
         self._api_key = api_key
         # 'Bot' telegram instance
-        self._bot = None
+        self._bot = bot
         self._tx_thread = None
         # 'Updater' telegram instance
         self._rx_thread = None
-
-    def start(self):
-        ''' start the main loop '''
+        self._updater = updater
+        # Bot method name -> BotCall, built once the Bot exists
+        self._dispatch = {}
+        # Receives the updates when set, replaces the Updater
+        self._webhook = webhook
+        self._webhook_url = webhook_url
+        self._webhook_running = False
+        # The updates of the polling handlers go to INBOUND_MSG_QUEUE in micro batches
+        self._inbound = RxBatcher(INBOUND_MSG_QUEUE)
+        self._recorder = recorder
+        if webhook is not None and recorder is not None:
+            webhook.recorder = recorder
+
+        # Outbound items go OUTBOUND_MSG_QUEUE -> scheduler -> sender workers
+        # The scheduler releases only one item per chat at a time, so the
+        # workers can share a single q without breaking the per chat order
+        self._scheduler = scheduler if scheduler else OutboundScheduler()
+        self._sched_thread = None
+        self._sender_workers = max(1, sender_workers)
+        self._tx_batch_size = max(1, tx_batch_size)
+        self._send_q = Queue()
+        self._worker_threads = []
+
+    def start(self, sender=True, receiver=True):
+        '''
+            start the main loop
+            sender      -> False to leave the outbound side to someone else (eg. AsyncRuntime)
+            receiver    -> False to not receive updates from telegram (polling or webhook)
+        '''
 
         logger.info('Staring {}'.format(type(self).__name__))
 
@@ -45,38 +88,65 @@ class TelegramAbstractionLayer():
             return False
 
         try:
-            self._bot = Bot(self._api_key)
-            self._rx_thread = Updater(self._api_key, use_context=True)
+            if self._bot is None:
+                self._bot = Bot(self._api_key)
+            self._dispatch = build_dispatch_table(self._bot)
+            if receiver and self._webhook is None:
+                self._rx_thread = self._updater if self._updater is not None \
+                    else Updater(self._api_key, use_context=True)
         except Exception as ex:
             logger.fatal('Could not start {}! Error: {}'.format(
                 type(self).__name__, ex))
             return False
 
-        self._tx_thread = Thread(target=self._run)
-        self._tx_thread.daemon = True
-        self._tx_thread.start()
+        if sender:
+            self._start_sender_workers()
+
+            self._sched_thread = Thread(target=self._schedule)
+            self._sched_thread.daemon = True
+            self._sched_thread.start()
+
+            self._tx_thread = Thread(target=self._run)
+            self._tx_thread.daemon = True
+            self._tx_thread.start()
+
+        if receiver and self._recorder is not None:
+            self._recorder.start()
 
-        # Handler for callback querries
-        self._rx_thread.dispatcher.add_handler(
-            CallbackQueryHandler(self.callback_query_handler))
+        if receiver and self._webhook is not None:
+            self._start_webhook()
 
-        # Handler for all commands
-        self._rx_thread.dispatcher.add_handler(
-            MessageHandler(Filters.regex(r'/.*'), self.command_handler))
+        elif receiver:
+            # Handler for callback querries
+            self._rx_thread.dispatcher.add_handler(
+                CallbackQueryHandler(self.callback_query_handler))
 
-        # Handler for all non-commands
-        self._rx_thread.dispatcher.add_handler(MessageHandler(
-            Filters.regex(r'.*'), self.non_command_handler))
+            # Handler for all commands, texts starting with a slash (as webhook.rx_item_from_json)
+            self._rx_thread.dispatcher.add_handler(
+                MessageHandler(Filters.regex(r'^/'), self.command_handler))
 
-        logger.info('Staring {}:_rx_thread'.format(type(self).__name__))
-        self._rx_thread.start_polling()
+            # Handler for all non-commands
+            self._rx_thread.dispatcher.add_handler(MessageHandler(
+                Filters.regex(r'.*'), self.non_command_handler))
+
+            logger.info('Staring {}:_rx_thread'.format(type(self).__name__))
+            self._rx_thread.start_polling()
 
         return True
 
+    def _start_webhook(self):
+        ''' updates are posted to the webhook, parsed straight from json '''
+        self._webhook.start()
+        self._webhook_running = True
+        if self._webhook_url:
+            logger.info('Registering webhook {}'.format(self._webhook_url))
+            if self._webhook.secret_token is None:
+                logger.warning('Webhook without secret_token, anyone can post updates to it')
+            self._bot.set_webhook(url=self._webhook_url, secret_token=self._webhook.secret_token)
+
     def non_command_handler(self, update, context):
         ''' forward text messages '''
-        logger.debug('TXT {}: {}'.format(
-            update.message.message_id, update.message.text))
+        logger.debug('TXT %s: %s', update.message.message_id, update.message.text)
 
         # Attempt to get the IDs
         if update.message:
@@ -89,19 +159,18 @@ class TelegramAbstractionLayer():
             logger.error('Received update without message: {}'.format(update))
             return
 
-        INBOUND_MSG_QUEUE.put(RxQItem(
+        self._receive(RxQItem(
             RxQItem.TEXT_MSG,
             route_by=RxQItem.ROUTE_BY_CHAT_ID | RxQItem.ROUTE_BY_USER_ID,
             chat_id=chat_id,
             user_id=user_id,
-            kwargs={'update': update}))
+            kwargs={'update': RxUpdate.from_update(update)}))
         # Context seems to contain a lock so it cannot be pickled not put into a q
         # args=[update, context]))
 
     def command_handler(self, update, context):
         ''' forward command messages '''
-        logger.debug('CMD {}: {}'.format(
-            update.message.message_id, update.message.text))
+        logger.debug('CMD %s: %s', update.message.message_id, update.message.text)
 
         # Attempt to get the IDs
         if update.message:
@@ -114,12 +183,12 @@ class TelegramAbstractionLayer():
             logger.error('Received update without message: {}'.format(update))
             return
 
-        INBOUND_MSG_QUEUE.put(RxQItem(
+        self._receive(RxQItem(
             RxQItem.COMMAND_MSG,
             route_by=RxQItem.ROUTE_BY_CHAT_ID | RxQItem.ROUTE_BY_USER_ID,
             chat_id=chat_id,
             user_id=user_id,
-            kwargs={'update': update}))
+            kwargs={'update': RxUpdate.from_update(update)}))
         # Context seems to contain a lock so it cannot be pickled not put into a q
         # args=[update, context]))
 
@@ -127,35 +196,56 @@ class TelegramAbstractionLayer():
         ''' forward callback messages '''
 
         # Attempt to get the IDs
-        if update.callback_query:
-            chat_id = update.callback_query.chat_instance
+        if update.callback_query and update.callback_query.message:
+            chat_id = update.callback_query.message.chat.id
             user_id = update.callback_query.from_user.id
+        elif update.callback_query:
+            # Button of an inline mode message, there is no chat to route it to
+            # (dropped by the webhook too, see webhook.rx_item_from_json)
+            logger.info('Dropping callback query {} without message'.format(update.callback_query.id))
+            return
         else:
             logger.error(
                 'Received update without callback_query: {}'.format(update))
             return
 
-        logger.debug('CBK QRY {}: DATA: {} MESSAGE: {}'.format(
-            update.callback_query.id,
-            update.callback_query.data,
-            update.callback_query.message.text))
+        logger.debug('CBK QRY %s: DATA: %s MESSAGE: %s',
+                     update.callback_query.id,
+                     update.callback_query.data,
+                     update.callback_query.message.text)
 
-        INBOUND_MSG_QUEUE.put(RxQItem(
+        self._receive(RxQItem(
             RxQItem.CALLBACK_QUERY_MSG,
             route_by=RxQItem.ROUTE_BY_CHAT_ID | RxQItem.ROUTE_BY_USER_ID,
             chat_id=chat_id,
             user_id=user_id,
-            kwargs={'update': update}))
+            kwargs={'update': RxUpdate.from_update(update)}))
         # Context seems to contain a lock so it cannot be pickled not put into a q
         # args=[update, context]))
 
+    def _receive(self, item):
+        ''' hand an RxQItem of the polling handlers over to the router '''
+        tracing.sample(item)
+        if self._recorder is not None:
+            self._recorder.record(item)
+        self._inbound.put(item)
+
+    @property
+    def scheduler(self):
+        ''' OutboundScheduler the outbound items go through, see send_item '''
+        return self._scheduler
+
+    def queue_depths(self):
+        ''' dict queue name -> depth, for the MetricsServer '''
+        return {'outbound_scheduled': self._scheduler.pending()}
+
     def stop(self):
         ''' stop the main loop '''
         if not self._exit_lock.locked():
             logger.error('Thread for {} is not currently running !'.format(
                 type(self).__name__))
             return False
-        elif self._tx_thread is None:
+        elif self._tx_thread is None and self._rx_thread is None and not self._webhook_running:
             logger.error('Thread for {} does not exist !'.format(
                 type(self).__name__))
             return False
@@ -163,56 +253,142 @@ class TelegramAbstractionLayer():
 
             # Stop the bot
             self._exit_lock.release()
+            if self._tx_thread is not None:
+                # The tx thread blocks on the outbound queue, wake it up
+                OUTBOUND_MSG_QUEUE.put(None)
+
+            if self._rx_thread is not None:
+                logger.info('Stopping {}:{}'.format(
+                    type(self).__name__, "_rx_thread"))
+                # Stop the updater
+                self._rx_thread.stop()
+                self._inbound.close()
 
-            logger.info('Stopping {}:{}'.format(
-                type(self).__name__, "_rx_thread"))
-            # Stop the updater
-            self._rx_thread.stop()
+            if self._webhook_running:
+                self._webhook.stop()
+                self._webhook_running = False
+
+            if self._recorder is not None:
+                self._recorder.stop()
 
             # Ensure bot has been stopped
-            self._tx_thread.join()
+            if self._tx_thread is not None:
+                self._tx_thread.join()
+
+    def _start_sender_workers(self):
+        ''' start the threads which perform the Bot calls '''
+        self._worker_threads = []
+
+        for idx in range(self._sender_workers):
+            worker = Thread(target=self._sender_worker,
+                            name='{}:sender_{}'.format(type(self).__name__, idx))
+            worker.daemon = True
+            worker.start()
+            self._worker_threads.append(worker)
+
+    def _stop_sender_workers(self):
+        ''' let the workers finish their pending items and join them '''
+        for _ in self._worker_threads:
+            self._send_q.put(None)
+        for worker in self._worker_threads:
+            worker.join(2)
 
     def _run(self):
-        ''' main loop '''
+        ''' main loop, drain the outbound queue into the scheduler '''
         logger.info('Staring {}:_tx_thread'.format(type(self).__name__))
         while True:
 
+            # Block until there is something to send
+            # A None item is only meant to wake up the thread
+            batch = [OUTBOUND_MSG_QUEUE.get()]
+
+            # Take whatever else is already waiting without blocking
+            while len(batch) < self._tx_batch_size:
+                try:
+                    batch.append(OUTBOUND_MSG_QUEUE.get_nowait())
+                except Empty:
+                    break
+
+            for msg in batch:
+                if msg is not None:
+                    self._scheduler.push(msg)
+
             if self._exit_lock.acquire(blocking=False):
                 break
 
-            # Pop output_q and send the messages
-            if not OUTBOUND_MSG_QUEUE.empty():
-                msg = OUTBOUND_MSG_QUEUE.get()
-
-                if msg.func_call:
-                    # If a message has the func_call parameter set
-                    # The is meant to call 'func_call' function of the Telegram Bot
-                    # args and kwargs are passed as parameters
-                    try:
-                        method = getattr(self._bot, msg.func_call)
-
-                        # For debugging purposes compare the arguments passed in the queue
-                        # with those in the official purpose
-                        sig = signature(method)
-                        args = [p.name for p in sig.parameters.values() if (p.default == p.empty) and (p.name != 'kwargs')]  # nopep8
-                        kwargs = [p.name for p in sig.parameters.values() if (p.default != p.empty)]  # nopep8
-
-                        for param in msg.kwargs:
-                            if param not in kwargs:
-                                logger.error('Function {} takes {} params. Param {} is not defined'.format(
-                                    msg.func_call, sig, param))
-                                continue
-
-                        if len(args) != len(msg.args):
-                            logger.error('Function {} takes {} params. {} positional argument but {} provided'.format(
-                                msg.func_call, sig, len(args), len(msg.args)))
-                            continue
-
-                        method(*msg.args, **msg.kwargs)
-
-                    except AttributeError:
-                        logger.error(
-                            'Could not find method {} in Bot'.format(msg.func_call))
-                        continue
-
+        self._scheduler.close()
+        self._sched_thread.join(2)
+        self._stop_sender_workers()
         logger.info('Stopping {}:_tx_thread'.format(type(self).__name__))
+
+    def _schedule(self):
+        ''' hand the items to the workers as fast as the flood limits allow '''
+        while True:
+            msg = self._scheduler.next_item()
+            if msg is None:
+                break
+            self._send_q.put(msg)
+
+    def _sender_worker(self):
+        ''' pop the send q and perform the Bot calls '''
+        while True:
+            msg = self._send_q.get()
+            if msg is None:
+                break
+
+            self.send_item(msg)
+
+    def send_item(self, msg):
+        '''
+            send msg and tell the scheduler how it went
+            Never raises: whatever happens the chat of msg is released (or deferred),
+            a chat left in flight would never send anything again
+        '''
+        start = time.monotonic()
+        metrics.observe(metrics.HOP_TX_QUEUE, start - msg.queued_at)
+        deferred = sent = False
+        try:
+            sent = self._send(msg)
+        except RetryAfter as ex:
+            logger.warning('Flood limit reached, retrying {} in {}s'.format(
+                msg.func_call, ex.retry_after))
+            self._scheduler.defer(msg, ex.retry_after)
+            deferred = True
+        except TelegramError as ex:
+            logger.error('Bot call {} failed: {}'.format(msg.func_call, ex))
+        except Exception as ex:
+            logger.exception('Bot call {} raised: {}'.format(msg.func_call, ex))
+        finally:
+            end = time.monotonic()
+            metrics.observe(metrics.HOP_BOT_CALL, end - start)
+            if msg.trace_id is not None:
+                tracing.span(msg.trace_id, 'outbound_queue', msg.queued_at, start)
+                tracing.span(msg.trace_id, 'bot_call', start, end, func_call=msg.func_call)
+            if not deferred:
+                self._scheduler.done(msg, sent)
+
+    def _send(self, msg):
+        ''' perform the Bot call described by a TxQItem, True if it was made '''
+
+        if not msg.func_call:
+            return False
+
+        # If a message has the func_call parameter set
+        # The is meant to call 'func_call' function of the Telegram Bot
+        # args and kwargs are passed as parameters
+        call = self._dispatch.get(msg.func_call)
+        if call is None:
+            logger.error(
+                'Could not find method {} in Bot'.format(msg.func_call))
+            return False
+
+        # Producers already validate their calls, this only guards against
+        # items put in the queue by other means
+        try:
+            call.validate(msg.args, msg.kwargs)
+        except TypeError as ex:
+            logger.error('Invalid call to Bot: {}'.format(ex))
+            return False
+
+        call.method(*msg.args, **msg.kwargs)
+        return True
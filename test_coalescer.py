@@ -0,0 +1,209 @@
+''' unit tests of OutboundCoalescer, python -m pytest test_coalescer.py '''
+import unittest
+
+from collections import deque
+
+from coalescer import OutboundCoalescer
+from queues import TxQItem
+from rate_limiter import OutboundScheduler
+from reply_cache import inline_keyboard
+
+CHAT = 42
+KEYBOARD_A = inline_keyboard(((('Rock', 'R'), ('Paper', 'P')),))
+KEYBOARD_B = inline_keyboard(((('Played', 'X'),),))
+
+
+def text(value, **kwargs):
+    return TxQItem('send_message', kwargs=dict(kwargs, chat_id=CHAT, text=value))
+
+
+def edit_markup(markup, message_id=1):
+    return TxQItem('edit_message_reply_markup', [CHAT], {'message_id': message_id, 'reply_markup': markup})
+
+
+def edit_text(value, markup=None, message_id=1):
+    return TxQItem('edit_message_text', [value, CHAT], {'message_id': message_id, 'reply_markup': markup})
+
+
+class CoalescerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.coalescer = OutboundCoalescer(window=0.5, max_text=20)
+        self.chat_q = deque()
+
+    def push(self, item, now=0):
+        ''' what the scheduler does, True if the item was queued '''
+        if self.coalescer.absorb(CHAT, self.chat_q or None, item, now):
+            return False
+        self.chat_q.append(item)
+        return True
+
+    def send(self, sent=True):
+        ''' the next queued call is made '''
+        item = self.chat_q.popleft()
+        self.coalescer.done(CHAT, item, sent)
+        return item
+
+    # send_message
+
+    def test_texts_merged(self):
+        self.assertTrue(self.push(text('one')))
+        self.assertFalse(self.push(text('two')))
+        self.assertEqual(len(self.chat_q), 1)
+        self.assertEqual(self.chat_q[0].kwargs['text'], 'one\ntwo')
+        self.assertEqual(self.coalescer.merged, 1)
+
+    def test_text_not_merged_after_window(self):
+        self.push(text('one'), now=0)
+        self.assertTrue(self.push(text('two'), now=1))
+        self.assertEqual(len(self.chat_q), 2)
+
+    def test_text_not_merged_below_keyboard(self):
+        self.push(text('pick', reply_markup=KEYBOARD_A))
+        self.assertTrue(self.push(text('two')))
+
+    def test_text_not_merged_with_other_options(self):
+        self.push(text('one', parse_mode='HTML'))
+        self.assertTrue(self.push(text('two')))
+
+    def test_text_not_merged_past_max_text(self):
+        self.push(text('a' * 15))
+        self.assertTrue(self.push(text('b' * 10)))
+
+    def test_text_not_merged_into_sent_text(self):
+        self.push(text('one'))
+        self.send()
+        self.assertTrue(self.push(text('two')))
+
+    # Edits waiting in the queue
+
+    def test_queued_edit_superseded(self):
+        self.push(edit_markup(KEYBOARD_A))
+        self.push(text('between'))
+        self.assertFalse(self.push(edit_markup(KEYBOARD_B)))
+        self.assertEqual([item.func_call for item in self.chat_q], ['edit_message_reply_markup', 'send_message'])
+        self.assertIs(self.chat_q[0].kwargs['reply_markup'], KEYBOARD_B)
+        self.assertEqual(self.coalescer.superseded, 1)
+
+    def test_edit_of_other_message_not_superseded(self):
+        self.push(edit_markup(KEYBOARD_A, message_id=1))
+        self.assertTrue(self.push(edit_markup(KEYBOARD_B, message_id=2)))
+
+    def test_older_edit_not_superseded_across_other_kind(self):
+        # Replacing the first edit would send B before A, the message would end up with A
+        self.push(edit_markup(KEYBOARD_A))
+        self.push(edit_text('hi', markup=KEYBOARD_A))
+        self.assertTrue(self.push(edit_markup(KEYBOARD_B)))
+        self.assertEqual(len(self.chat_q), 3)
+
+    # Unchanged edits
+
+    def test_unchanged_edit_dropped_once_sent(self):
+        self.push(edit_markup(KEYBOARD_A))
+        self.send()
+        self.assertFalse(self.push(edit_markup(inline_keyboard(((('Rock', 'R'), ('Paper', 'P')),)))))
+        self.assertEqual(self.coalescer.unchanged, 1)
+
+    def test_edit_of_other_kind_updates_rendered(self):
+        self.push(edit_markup(KEYBOARD_A))
+        self.send()
+        self.push(edit_text('hi', markup=KEYBOARD_B))
+        self.send()
+        # The message shows B now, going back to A is a change
+        self.assertTrue(self.push(edit_markup(KEYBOARD_A)))
+        self.send()
+        # Text and keyboard of the message both known
+        self.assertFalse(self.push(edit_text('hi', markup=KEYBOARD_A)))
+
+    def test_edit_text_without_markup_drops_keyboard(self):
+        self.push(edit_markup(KEYBOARD_A))
+        self.send()
+        self.push(edit_text('hi'))
+        self.send()
+        self.assertTrue(self.push(edit_markup(KEYBOARD_A)))
+
+    def test_failed_edit_not_rendered(self):
+        self.push(edit_markup(KEYBOARD_A))
+        self.send(sent=False)
+        self.assertTrue(self.push(edit_markup(KEYBOARD_A)))
+
+    def test_failed_edit_forgets_rendered(self):
+        self.push(edit_markup(KEYBOARD_A))
+        self.send()
+        self.push(edit_markup(KEYBOARD_B))
+        self.send(sent=False)
+        # The message may show A or B
+        self.assertTrue(self.push(edit_markup(KEYBOARD_A)))
+
+    def test_edit_not_dropped_while_other_edit_pending(self):
+        self.push(edit_markup(KEYBOARD_A))
+        self.send()
+        self.push(edit_markup(KEYBOARD_B))
+        in_flight = self.chat_q.popleft()
+        # B may be shown once the call in flight is done, A is a change
+        self.assertTrue(self.push(edit_markup(KEYBOARD_A)))
+        self.coalescer.done(CHAT, in_flight, True)
+        self.send()
+        self.assertFalse(self.push(edit_markup(KEYBOARD_A)))
+
+    def test_edit_without_message_id_kept(self):
+        item = TxQItem('edit_message_reply_markup', kwargs={'inline_message_id': 'x', 'reply_markup': KEYBOARD_A})
+        self.assertTrue(self.push(item))
+        self.assertTrue(self.push(item))
+
+    def test_rendered_bounded(self):
+        coalescer = OutboundCoalescer(max_rendered=2)
+        for message_id in (1, 2, 3):
+            item = edit_markup(KEYBOARD_A, message_id=message_id)
+            self.assertFalse(coalescer.absorb(CHAT, None, item, 0))
+            coalescer.done(CHAT, item, True)
+        self.assertEqual(len(coalescer._rendered), 2)
+        # The oldest was forgotten, sent again
+        self.assertFalse(coalescer.absorb(CHAT, None, edit_markup(KEYBOARD_A, message_id=1), 0))
+        self.assertTrue(coalescer.absorb(CHAT, None, edit_markup(KEYBOARD_A, message_id=3), 0))
+
+
+class SchedulerCoalescingTest(unittest.TestCase):
+    ''' the coalescer as driven by the OutboundScheduler '''
+
+    def setUp(self):
+        self.now = [0.0]
+        self.scheduler = OutboundScheduler(clock=lambda: self.now[0])
+
+    def drain(self, sent=True):
+        calls = []
+        while True:
+            item, wait = self.scheduler.poll()
+            if item is not None:
+                calls.append(item)
+                self.scheduler.done(item, sent)
+            elif wait is None:
+                return calls
+            else:
+                self.now[0] += max(wait, 1e-6)
+
+    def test_repeated_edit_sent_once(self):
+        self.scheduler.push(edit_markup(KEYBOARD_A))
+        self.assertEqual(len(self.drain()), 1)
+        self.scheduler.push(edit_markup(KEYBOARD_A))
+        self.assertEqual(self.drain(), [])
+        self.assertEqual(self.scheduler.pending(), 0)
+
+    def test_repeated_edit_retried_after_failure(self):
+        self.scheduler.push(edit_markup(KEYBOARD_A))
+        self.assertEqual(len(self.drain(sent=False)), 1)
+        self.scheduler.push(edit_markup(KEYBOARD_A))
+        self.assertEqual(len(self.drain()), 1)
+
+    def test_order_kept(self):
+        for item in (text('one'), edit_markup(KEYBOARD_A), text('two'), text('three'), edit_markup(KEYBOARD_B)):
+            self.scheduler.push(item)
+        calls = self.drain()
+        self.assertEqual([(c.func_call, c.kwargs.get('text')) for c in calls],
+                         [('send_message', 'one'), ('edit_message_reply_markup', None),
+                          ('send_message', 'two\nthree')])
+        self.assertIs(calls[1].kwargs['reply_markup'], KEYBOARD_B)
+
+
+if __name__ == '__main__':
+    unittest.main()
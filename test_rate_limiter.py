@@ -0,0 +1,201 @@
+''' unit tests of OutboundScheduler and TokenBucket, python -m pytest test_rate_limiter.py '''
+import threading
+import unittest
+
+from queues import TxQItem
+from rate_limiter import OutboundScheduler, TokenBucket
+
+PRIVATE = 42
+GROUP = -42
+
+
+def text(chat_id, value):
+    return TxQItem('send_message', kwargs={'chat_id': chat_id, 'text': value})
+
+
+def answer(query_id):
+    return TxQItem('answer_callback_query', [query_id])
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def test_burst_then_rate(self):
+        bucket = TokenBucket(2, 3, now=0)
+        for _ in range(3):
+            self.assertEqual(bucket.ready_in(0), 0)
+            bucket.take(0)
+        self.assertAlmostEqual(bucket.ready_in(0), 0.5)
+        self.assertEqual(bucket.ready_in(0.5), 0)
+
+    def test_refill_capped(self):
+        bucket = TokenBucket(2, 3, now=0)
+        bucket.take(0)
+        self.assertFalse(bucket.is_full(0))
+        self.assertTrue(bucket.is_full(100))
+        self.assertEqual(bucket.tokens, 3)
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.scheduler = self.make()
+
+    def make(self, **kwargs):
+        # No coalescing, every pushed item is a Bot call
+        return OutboundScheduler(clock=lambda: self.now[0], coalescer=None, **kwargs)
+
+    def drain(self, scheduler=None):
+        ''' (time, item) of every call, each one done right away, the clock jumps to the next ready one '''
+        scheduler = scheduler or self.scheduler
+        calls = []
+        while True:
+            item, wait = scheduler.poll()
+            if item is not None:
+                calls.append((self.now[0], item))
+                scheduler.done(item)
+            elif wait is None:
+                break
+            else:
+                self.now[0] += max(wait, 1e-9)
+        return calls
+
+    def test_chat_fifo(self):
+        for idx in range(6):
+            self.scheduler.push(text(PRIVATE, str(idx)))
+        calls = self.drain()
+        self.assertEqual([item.kwargs['text'] for (_, item) in calls], [str(idx) for idx in range(6)])
+
+    def test_private_chat_rate(self):
+        for idx in range(6):
+            self.scheduler.push(text(PRIVATE, str(idx)))
+        times = [at for (at, _) in self.drain()]
+        # Burst of 3, then 1 per second
+        self.assertEqual(times[:3], [0, 0, 0])
+        for (expected, at) in zip((1, 2, 3), times[3:]):
+            self.assertAlmostEqual(at, expected)
+
+    def test_group_rate_below_global(self):
+        for idx in range(6):
+            self.scheduler.push(text(GROUP, str(idx)))
+        for chat_id in range(1, 61):
+            self.scheduler.push(text(chat_id, 'hi'))
+
+        calls = self.drain()
+        group = [at for (at, item) in calls if item.get_chat_id() == GROUP]
+        private = [at for (at, item) in calls if item.get_chat_id() != GROUP]
+
+        # The group never gets more than its burst of 3 plus 20 per minute...
+        self.assertEqual(len(group), 6)
+        for (idx, at) in enumerate(group[3:], 1):
+            self.assertGreaterEqual(at, idx * 3 - 1e-6)
+        # ...while the private chats are only held by the global 30/s: the burst of 30
+        # (shared with the group) at once, the others 1/30s apart
+        self.assertEqual(group[0], 0)
+        self.assertEqual(len([at for at in private if at == 0]), 29)
+        self.assertAlmostEqual(private[-1], 31 / 30)
+
+    def test_global_rate(self):
+        for chat_id in range(1, 61):
+            self.scheduler.push(text(chat_id, 'hi'))
+        times = [at for (at, _) in self.drain()]
+        self.assertEqual(times[:30], [0] * 30)
+        for (idx, at) in enumerate(times[30:], 1):
+            self.assertAlmostEqual(at, idx / 30)
+
+    def test_one_call_in_flight_per_chat(self):
+        self.scheduler.push(text(PRIVATE, 'one'))
+        self.scheduler.push(text(PRIVATE, 'two'))
+        first, _ = self.scheduler.poll()
+        # Tokens left, but 'one' is not done yet
+        self.assertEqual(self.scheduler.poll(), (None, None))
+        self.now[0] += 10
+        self.assertEqual(self.scheduler.poll(), (None, None))
+
+        # done() puts the chat back in the ready ring
+        self.scheduler.done(first)
+        second, wait = self.scheduler.poll()
+        self.assertEqual((second.kwargs['text'], wait), ('two', 0))
+
+    def test_done_of_failed_call_rearms_chat(self):
+        self.scheduler.push(text(PRIVATE, 'one'))
+        self.scheduler.push(text(PRIVATE, 'two'))
+        first, _ = self.scheduler.poll()
+        self.scheduler.done(first, sent=False)
+        second, _ = self.scheduler.poll()
+        self.assertEqual(second.kwargs['text'], 'two')
+
+    def test_other_chats_go_while_one_in_flight(self):
+        self.scheduler.push(text(PRIVATE, 'one'))
+        self.scheduler.push(text(PRIVATE, 'two'))
+        self.scheduler.push(text(PRIVATE + 1, 'other'))
+        self.scheduler.poll()
+        item, _ = self.scheduler.poll()
+        self.assertEqual(item.kwargs['text'], 'other')
+
+    def test_defer_resends_first_after_retry_after(self):
+        self.scheduler.push(text(PRIVATE, 'one'))
+        self.scheduler.push(text(PRIVATE, 'two'))
+        first, _ = self.scheduler.poll()
+        # 429 from telegram
+        self.scheduler.defer(first, 5)
+        item, wait = self.scheduler.poll()
+        self.assertIsNone(item)
+        self.assertAlmostEqual(wait, 5)
+
+        calls = self.drain()
+        self.assertEqual([(at, item.kwargs['text']) for (at, item) in calls], [(5, 'one'), (5, 'two')])
+
+    def test_defer_holds_only_its_chat(self):
+        self.scheduler.push(text(PRIVATE, 'one'))
+        first, _ = self.scheduler.poll()
+        self.scheduler.defer(first, 5)
+        self.scheduler.push(text(PRIVATE + 1, 'other'))
+        item, _ = self.scheduler.poll()
+        self.assertEqual(item.kwargs['text'], 'other')
+
+    def test_defer_without_chat_holds_everything(self):
+        self.scheduler.push(answer('q1'))
+        first, _ = self.scheduler.poll()
+        self.scheduler.defer(first, 2)
+        self.scheduler.push(text(PRIVATE, 'one'))
+        self.assertEqual(self.scheduler.poll()[0], None)
+
+        calls = self.drain()
+        self.assertEqual([(at, item.func_call) for (at, item) in calls],
+                         [(2, 'answer_callback_query'), (2, 'send_message')])
+
+    def test_no_chat_calls_use_global_bucket_only(self):
+        scheduler = self.make(global_rate=1, global_burst=2)
+        for idx in range(3):
+            scheduler.push(answer(str(idx)))
+        times = [at for (at, _) in self.drain(scheduler)]
+        self.assertEqual(times, [0, 0, 1])
+
+    def test_pending(self):
+        self.scheduler.push(text(PRIVATE, 'one'))
+        self.scheduler.push(text(PRIVATE, 'two'))
+        self.scheduler.push(answer('q1'))
+        self.assertEqual(self.scheduler.pending(), 3)
+        self.drain()
+        self.assertEqual(self.scheduler.pending(), 0)
+
+    def test_close_releases_next_item(self):
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(self.scheduler.next_item()))
+        waiter.start()
+        self.scheduler.close()
+        waiter.join(2)
+        self.assertFalse(waiter.is_alive())
+        self.assertEqual(got, [None])
+
+    def test_close_drains_nothing_more(self):
+        self.scheduler.push(text(PRIVATE, 'one'))
+        self.scheduler.close()
+        # Whatever is left is not handed out anymore, it stays counted
+        self.assertIsNone(self.scheduler.next_item())
+        self.assertEqual(self.scheduler.pending(), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
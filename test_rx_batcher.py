@@ -0,0 +1,127 @@
+''' unit tests of RxBatcher and unbatch, python -m pytest test_rx_batcher.py '''
+import queue
+import unittest
+
+from queues import RxBatcher, unbatch
+
+
+class RxBatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.q = queue.Queue()
+        self.batcher = RxBatcher(self.q, max_items=64, max_delay=200e-6, clock=lambda: self.now[0])
+
+    def tearDown(self):
+        self.batcher.close()
+
+    def queued(self):
+        items = []
+        while not self.q.empty():
+            items.append(self.q.get_nowait())
+        return items
+
+    def load(self):
+        ''' puts without any gap until the batcher expects more than one item per max_delay '''
+        for _ in range(20):
+            self.batcher.put(-1)
+        self.batcher.flush()
+        self.queued()
+
+    def expire(self):
+        ''' move past the deadline of the buffered items, returns the list the flusher thread put '''
+        self.now[0] += self.batcher.max_delay
+        return self.q.get(timeout=2)
+
+    def test_light_traffic_sent_alone(self):
+        # Items further apart than max_delay are not held back
+        for idx in range(3):
+            self.now[0] += 1e-3
+            self.batcher.put(idx)
+            self.assertEqual(self.queued(), [idx])
+
+    def test_load_held_until_max_items(self):
+        self.load()
+        for idx in range(63):
+            self.batcher.put(idx)
+        self.assertEqual(self.queued(), [])
+
+        # The 64th item sends the list right away, in the calling thread
+        self.batcher.put(63)
+        self.assertEqual(self.queued(), [list(range(64))])
+
+    def test_load_held_until_max_delay(self):
+        self.load()
+        self.batcher.put(1)
+        self.batcher.put(2)
+        self.assertEqual(self.queued(), [])
+
+        self.now[0] += self.batcher.max_delay / 2
+        self.batcher.put(3)
+        self.assertEqual(self.queued(), [])
+
+        # Counted from the first item, the flusher thread sends them
+        self.assertEqual(self.expire(), [1, 2, 3])
+
+    def test_back_to_light_traffic(self):
+        self.load()
+        self.batcher.put(1)
+        self.assertEqual(self.expire(), 1)
+
+        # A few spaced puts, the batcher stops holding them
+        for idx in range(10):
+            self.now[0] += 1
+            self.batcher.put(idx)
+        self.now[0] += 1
+        self.batcher.put('alone')
+        self.assertEqual(self.queued()[-1], 'alone')
+
+    def test_put_many_split_in_max_items(self):
+        self.batcher.put_many(list(range(150)))
+        batches = self.queued()
+        self.assertEqual([len(batch) for batch in batches], [64, 64, 22])
+        self.assertEqual([item for batch in batches for item in unbatch(batch)], list(range(150)))
+
+    def test_order_across_flusher_thread(self):
+        self.load()
+        sent = []
+        for idx in range(3):
+            self.batcher.put(idx)
+        sent.append(self.expire())
+
+        # Filled up in the caller, the next ones by the flusher again
+        for idx in range(3, 67):
+            self.batcher.put(idx)
+        sent.extend(self.queued())
+        for idx in range(67, 71):
+            self.batcher.put(idx)
+        sent.append(self.expire())
+
+        self.assertEqual([len(unbatch(item)) for item in sent], [3, 64, 4])
+        self.assertEqual([msg for item in sent for msg in unbatch(item)], list(range(71)))
+
+    def test_close_flushes(self):
+        self.load()
+        self.batcher.put(1)
+        self.batcher.close()
+        self.assertEqual(self.queued(), [1])
+        # Closed, sent right away
+        self.batcher.put(2)
+        self.assertEqual(self.queued(), [2])
+
+
+class UnbatchTest(unittest.TestCase):
+
+    def test_single_item(self):
+        self.assertEqual(unbatch('msg'), ['msg'])
+
+    def test_list(self):
+        batch = ['a', 'b']
+        self.assertIs(unbatch(batch), batch)
+
+    def test_tuple_is_one_item(self):
+        self.assertEqual(unbatch(('a', 'b')), [('a', 'b')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+''' unit tests of SlotAllocator, python -m pytest test_slot_allocator.py '''
+import unittest
+
+from slot_allocator import SlotAllocator
+
+
+class SlotAllocatorTest(unittest.TestCase):
+
+    def test_lowest_slots_first(self):
+        slots = SlotAllocator(initial_capacity=4)
+        ids = [slots.acquire() for _ in range(4)]
+        self.assertEqual(ids, [0, 1, 2, 3])
+        self.assertEqual(len(slots), 4)
+
+    def test_reacquired_slot_gets_new_generation(self):
+        slots = SlotAllocator(initial_capacity=4)
+        old_id = slots.acquire()
+        self.assertTrue(slots.release(old_id))
+
+        new_id = slots.acquire()
+        self.assertNotEqual(new_id, old_id)
+        self.assertEqual(new_id, (1 << SlotAllocator.SLOT_BITS) | 0)
+        self.assertEqual(slots.slot_of(new_id), 0)
+        # The old id does not resolve to the instance now in its slot
+        self.assertIsNone(slots.slot_of(old_id))
+
+    def test_stale_id_not_released(self):
+        slots = SlotAllocator(initial_capacity=4)
+        old_id = slots.acquire()
+        slots.release(old_id)
+        new_id = slots.acquire()
+
+        self.assertFalse(slots.release(old_id))
+        self.assertEqual(slots.slot_of(new_id), 0)
+        self.assertEqual(len(slots), 1)
+
+    def test_released_id_rejected(self):
+        slots = SlotAllocator(initial_capacity=4)
+        inst_id = slots.acquire()
+        slots.release(inst_id)
+        self.assertIsNone(slots.slot_of(inst_id))
+        self.assertFalse(slots.release(inst_id))
+
+    def test_unknown_ids_rejected(self):
+        slots = SlotAllocator(initial_capacity=4)
+        slots.acquire()
+        for inst_id in (None, -1, 1, 100, 1 << SlotAllocator.SLOT_BITS):
+            self.assertIsNone(slots.slot_of(inst_id))
+
+    def test_capacity_doubles_up_to_max(self):
+        slots = SlotAllocator(initial_capacity=2, max_capacity=5)
+        ids = [slots.acquire() for _ in range(2)]
+        self.assertEqual(slots.capacity, 2)
+
+        ids.append(slots.acquire())
+        self.assertEqual(slots.capacity, 4)
+        ids.append(slots.acquire())
+        ids.append(slots.acquire())
+        self.assertEqual(slots.capacity, 5)
+        self.assertEqual(sorted(slots.slot_of(inst_id) for inst_id in ids), [0, 1, 2, 3, 4])
+
+        self.assertIsNone(slots.acquire())
+        # A released slot can be handed out again
+        slots.release(ids[0])
+        self.assertEqual(slots.slot_of(slots.acquire()), 0)
+
+    def test_max_capacity_fits_slot_bits(self):
+        with self.assertRaises(ValueError):
+            SlotAllocator(max_capacity=SlotAllocator.SLOT_MASK + 2)
+
+    def test_generation_past_slot_bits(self):
+        # Generations are python ints, they keep growing above the slot bits without wrapping
+        slots = SlotAllocator(initial_capacity=2)
+        slots._generations[1] = (1 << 40) - 1
+        slots.acquire()
+        old_id = slots.acquire()
+        self.assertEqual(slots.slot_of(old_id), 1)
+
+        slots.release(old_id)
+        new_id = slots.acquire()
+        self.assertEqual(new_id >> SlotAllocator.SLOT_BITS, 1 << 40)
+        self.assertEqual(new_id & SlotAllocator.SLOT_MASK, 1)
+        self.assertEqual(slots.slot_of(new_id), 1)
+        self.assertIsNone(slots.slot_of(old_id))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+''' unit tests of StateTable, python -m pytest test_state_machine.py '''
+import unittest
+
+from state_machine import StateTable, Step
+
+ASK, CHECK, DONE, ERROR = 'ask', 'check', 'done', 'error'
+
+
+class Session():
+    ''' records the states whose handler ran '''
+
+    def __init__(self):
+        self.visited = []
+
+
+def goes_to(state):
+    def handler(session, kwargs):
+        session.visited.append(kwargs.get('at'))
+        return state
+    return handler
+
+
+class StateTableCheckTest(unittest.TestCase):
+
+    def test_valid_table(self):
+        table = StateTable({
+            ASK: Step(goes_to(CHECK), (CHECK, ERROR), needs_input=True),
+            CHECK: Step(goes_to(DONE), (DONE, ASK, ERROR)),
+            DONE: Step(goes_to(DONE)),
+            ERROR: Step(goes_to(ERROR)),
+        }, ERROR)
+        self.assertIn(CHECK, table)
+        self.assertNotIn('unknown', table)
+
+    def test_missing_error_state(self):
+        with self.assertRaises(ValueError):
+            StateTable({ASK: Step(goes_to(ASK), needs_input=True)}, ERROR)
+
+    def test_missing_next_state(self):
+        with self.assertRaisesRegex(ValueError, 'without step'):
+            StateTable({
+                ASK: Step(goes_to(CHECK), (CHECK,), needs_input=True),
+                ERROR: Step(goes_to(ERROR)),
+            }, ERROR)
+
+    def test_cycle_without_input(self):
+        with self.assertRaisesRegex(ValueError, 'loop without waiting for input'):
+            StateTable({
+                ASK: Step(goes_to(CHECK), (CHECK,), needs_input=True),
+                CHECK: Step(goes_to(DONE), (DONE,)),
+                DONE: Step(goes_to(CHECK), (CHECK,)),
+                ERROR: Step(goes_to(ERROR)),
+            }, ERROR)
+
+    def test_cycle_through_input_state(self):
+        # Waits for a message on every round, not a loop
+        StateTable({
+            ASK: Step(goes_to(CHECK), (CHECK,), needs_input=True),
+            CHECK: Step(goes_to(ASK), (ASK,)),
+            ERROR: Step(goes_to(ERROR)),
+        }, ERROR)
+
+    def test_self_loop_allowed(self):
+        # Returning its own state stops the machine
+        StateTable({
+            CHECK: Step(goes_to(CHECK), (CHECK, DONE)),
+            DONE: Step(goes_to(DONE)),
+            ERROR: Step(goes_to(ERROR)),
+        }, ERROR)
+
+
+class StateTableRunTest(unittest.TestCase):
+
+    def make(self, check=DONE):
+        self.errors = []
+
+        def error(session, kwargs):
+            self.errors.append(kwargs)
+            return ERROR
+
+        return StateTable({
+            ASK: Step(goes_to(CHECK), (CHECK, ERROR), needs_input=True),
+            CHECK: Step(goes_to(check), (DONE, ASK)),
+            DONE: Step(goes_to(DONE)),
+            ERROR: Step(error),
+        }, ERROR)
+
+    def test_runs_until_input_needed(self):
+        table = self.make(check=ASK)
+        session = Session()
+        self.assertEqual(table.run(session, ASK, {'at': 1}), ASK)
+        self.assertEqual(session.visited, [1, 1])
+
+    def test_runs_until_final_state(self):
+        table = self.make()
+        session = Session()
+        self.assertEqual(table.run(session, ASK, {}), DONE)
+        self.assertEqual(len(session.visited), 3)
+
+    def test_invalid_transition(self):
+        table = self.make(check='elsewhere')
+        self.assertEqual(table.run(Session(), ASK, {}), ERROR)
+        self.assertEqual(len(self.errors), 1)
+
+    def test_unknown_state(self):
+        table = self.make()
+        self.assertEqual(table.run(Session(), 'unknown', {}), ERROR)
+        self.assertEqual(len(self.errors), 1)
+
+    def test_no_progress(self):
+        table = self.make(check=CHECK)
+        self.assertEqual(table.run(Session(), CHECK, {}), ERROR)
+
+    def test_max_steps_guard(self):
+        table = self.make()
+        # A loop the check at build time can't see, eg. a step changed afterwards
+        table._steps[DONE] = Step(goes_to(CHECK), (CHECK,))
+        table._steps[CHECK] = Step(goes_to(DONE), (DONE,))
+        session = Session()
+        self.assertEqual(table.run(session, CHECK, {}), ERROR)
+        self.assertEqual(len(session.visited), table._max_steps)
+        self.assertEqual(len(self.errors), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,95 @@
+''' unit tests of TimerWheel, python -m pytest test_timer_wheel.py '''
+import unittest
+
+from timer_wheel import TimerWheel
+
+
+class TimerWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.now = [0.0]
+        self.wheel = TimerWheel(tick=1.0, slots=512, clock=lambda: self.now[0])
+
+    def advance_to(self, now):
+        self.now[0] = now
+        return self.wheel.advance()
+
+    def test_expires_on_its_tick(self):
+        self.wheel.schedule('a', 10.5)
+        self.assertEqual(self.advance_to(10), [])
+        self.assertEqual(self.advance_to(10.4), [])
+        self.assertEqual(self.advance_to(11), ['a'])
+        self.assertNotIn('a', self.wheel)
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_expires_once(self):
+        self.wheel.schedule('a', 3)
+        self.assertEqual(self.advance_to(3), ['a'])
+        self.assertEqual(self.advance_to(600), [])
+
+    def test_deadline_past_one_revolution(self):
+        # 1000 ticks away, its bucket comes up once before it is due
+        self.wheel.schedule('a', 1000)
+        for now in range(1, 1000, 7):
+            self.assertEqual(self.advance_to(now), [])
+        self.assertIn('a', self.wheel)
+        self.assertEqual(self.advance_to(1000), ['a'])
+
+    def test_deadline_past_one_revolution_single_advance(self):
+        self.wheel.schedule('a', 1000)
+        self.wheel.schedule('b', 2000)
+        # Idle for longer than a revolution, every bucket is visited once
+        self.assertEqual(self.advance_to(1500), ['a'])
+        self.assertEqual(self.advance_to(2000), ['b'])
+
+    def test_cancel(self):
+        self.wheel.schedule('a', 5)
+        self.wheel.schedule('b', 5)
+        self.wheel.cancel('a')
+        self.assertNotIn('a', self.wheel)
+        self.assertEqual(self.advance_to(6), ['b'])
+        # Cancelling an unknown or expired key does nothing
+        self.wheel.cancel('a')
+        self.wheel.cancel('b')
+
+    def test_reschedule_later(self):
+        self.wheel.schedule('a', 5)
+        self.wheel.schedule('a', 20)
+        self.assertEqual(self.advance_to(10), [])
+        self.assertIn('a', self.wheel)
+        self.assertEqual(self.advance_to(20), ['a'])
+
+    def test_reschedule_later_past_one_revolution(self):
+        self.wheel.schedule('a', 5)
+        self.wheel.schedule('a', 5 + 512 * 2)
+        self.assertEqual(self.advance_to(600), [])
+        self.assertEqual(self.advance_to(5 + 512), [])
+        self.assertEqual(self.advance_to(5 + 512 * 2), ['a'])
+
+    def test_reschedule_earlier(self):
+        self.wheel.schedule('a', 100)
+        self.wheel.schedule('a', 5)
+        self.assertEqual(self.advance_to(5), ['a'])
+        self.assertEqual(self.advance_to(100), [])
+
+    def test_reschedule_after_cancel(self):
+        self.wheel.schedule('a', 5)
+        self.wheel.cancel('a')
+        self.wheel.schedule('a', 8)
+        self.assertEqual(self.advance_to(5), [])
+        self.assertEqual(self.advance_to(8), ['a'])
+
+    def test_deadline_already_over(self):
+        self.advance_to(10)
+        self.wheel.schedule('a', 3)
+        self.assertEqual(self.advance_to(11), ['a'])
+
+    def test_next_tick_in(self):
+        self.now[0] = 0.25
+        self.assertAlmostEqual(self.wheel.next_tick_in(), 0.75)
+        self.advance_to(3.5)
+        self.assertAlmostEqual(self.wheel.next_tick_in(), 0.5)
+
+
+if __name__ == '__main__':
+    unittest.main()
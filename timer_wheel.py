@@ -0,0 +1,99 @@
+''' hashed timing wheel for cheap timeouts '''
+import math
+import time
+
+
+class TimerWheel():
+    '''
+        Hashed timing wheel: 'slots' buckets of 'tick' seconds each.
+        A key with a deadline lives in bucket (deadline // tick) % slots.
+
+        schedule() is O(1) and can be called on every message: pushing the
+        deadline of a key already in the wheel only updates its deadline. The
+        stale bucket entry is moved to the right bucket when its tick comes (at
+        most once per refresh period), deadlines further than one revolution
+        simply stay until their round comes. advance() only looks at the buckets of the
+        ticks elapsed since the last call.
+    '''
+
+    def __init__(self, tick=1.0, slots=512, clock=time.time):
+        self.tick = tick
+        self.slots = slots
+        self._clock = clock
+
+        self._buckets = [set() for _ in range(slots)]
+        # key -> deadline
+        self._deadlines = {}
+        # key -> tick number of the bucket holding it
+        self._placed = {}
+        # Last tick already processed
+        self._current = self._tick_of(clock())
+
+    def _tick_of(self, timestamp):
+        return int(math.floor(timestamp / self.tick))
+
+    def _place(self, key, deadline):
+        # A deadline in an already processed tick fires on the next one
+        tick_nb = max(self._tick_of(deadline), self._current + 1)
+        self._buckets[tick_nb % self.slots].add(key)
+        self._placed[key] = tick_nb
+
+    def schedule(self, key, deadline):
+        ''' (re)arm the timeout of key '''
+        self._deadlines[key] = deadline
+        tick_nb = self._placed.get(key)
+        if tick_nb is None:
+            self._place(key, deadline)
+        elif self._tick_of(deadline) < tick_nb:
+            # Brought forward, a later bucket would fire too late
+            self._buckets[tick_nb % self.slots].discard(key)
+            self._place(key, deadline)
+
+    def cancel(self, key):
+        self._deadlines.pop(key, None)
+        tick_nb = self._placed.pop(key, None)
+        if tick_nb is not None:
+            self._buckets[tick_nb % self.slots].discard(key)
+
+    def __contains__(self, key):
+        return key in self._deadlines
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def next_tick_in(self, now=None):
+        ''' seconds until the next call to advance() can expire something '''
+        now = self._clock() if now is None else now
+        return max(0, (self._current + 1) * self.tick - now)
+
+    def advance(self, now=None):
+        ''' returns the keys whose deadline is over, they are removed from the wheel '''
+        now = self._clock() if now is None else now
+        target = self._tick_of(now)
+        if target <= self._current:
+            return []
+
+        # After a long idle period, one revolution visits every bucket
+        first = max(self._current + 1, target - self.slots + 1)
+        self._current = target
+
+        expired = []
+        for tick_nb in range(first, target + 1):
+            bucket = self._buckets[tick_nb % self.slots]
+            if not bucket:
+                continue
+            self._buckets[tick_nb % self.slots] = set()
+
+            for key in bucket:
+                del self._placed[key]
+                deadline = self._deadlines.get(key)
+                if deadline is None:
+                    continue
+                if deadline <= now:
+                    del self._deadlines[key]
+                    expired.append(key)
+                else:
+                    # Refreshed, or due in a later revolution
+                    self._place(key, deadline)
+
+        return expired
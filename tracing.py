@@ -0,0 +1,243 @@
+''' sampled tracing of the path of a message through the processes, dumped as Chrome trace JSON '''
+import atexit
+import itertools
+import json
+import logging
+import multiprocessing as mp
+import os
+import random
+import shutil
+import signal
+import tempfile
+import threading
+import time
+
+from contextvars import ContextVar
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+# Spans kept by each process, the oldest are overwritten
+RING_SIZE = 65536
+
+# Trace of the message being handled, the TxQItems built meanwhile belong to it
+_current = ContextVar('trace_id', default=None)
+
+_sample_rate = 0.0
+_ids = itertools.count(1)
+
+
+class SpanRing():
+    '''
+        Fixed size ring of spans, written without any lock: the slot of a span
+        comes from an itertools.count, whose next() is atomic, and storing in
+        a list slot is atomic too.
+    '''
+
+    def __init__(self, size=RING_SIZE):
+        self._size = size
+        self._spans = [None] * size
+        self._next = itertools.count()
+
+    def add(self, span):
+        self._spans[next(self._next) % self._size] = span
+
+    def spans(self):
+        return [span for span in list(self._spans) if span is not None]
+
+
+_ring = SpanRing()
+
+
+def _forget_parent():
+    # The spans of the parent are dumped by the parent
+    global _ring
+    _ring = SpanRing()
+    if _DUMP_DIR is not None:
+        # Threads don't survive a fork
+        _start_dumper()
+
+
+os.register_at_fork(after_in_child=_forget_parent)
+
+
+def set_sample_rate(rate):
+    ''' fraction (0 to 1) of the inbound messages which get traced '''
+    global _sample_rate
+    _sample_rate = rate
+
+
+def new_trace_id():
+    ''' id for a new inbound message, None if it is not sampled '''
+    if not _sample_rate or random.random() >= _sample_rate:
+        return None
+    # Unique across the processes, ids are only handed out by the receiving side
+    return '{:x}-{:x}'.format(os.getpid(), next(_ids))
+
+
+def sample(item):
+    ''' give a just received RxQItem a trace id if it is sampled '''
+    item.trace_id = new_trace_id()
+    if item.trace_id is not None:
+        span(item.trace_id, 'receive', item.rx_at, time.monotonic(), chat_id=item.chat_id, kind=item.kind)
+
+
+def current_trace():
+    ''' trace of the message being handled in this thread/task, None if not traced '''
+    return _current.get()
+
+
+def span(trace_id, name, start, end, **args):
+    '''
+        record a span of trace_id, start and end are time.monotonic() (the same
+        clock in every process), args end up in the trace viewer
+    '''
+    _ring.add((trace_id, name, start, end, threading.get_ident(), args))
+
+
+class handling():
+    ''' context manager making trace_id the current trace (None leaves everything alone) '''
+    __slots__ = ('_trace_id', '_token')
+
+    def __init__(self, trace_id):
+        self._trace_id = trace_id
+        self._token = None
+
+    def __enter__(self):
+        if self._trace_id is not None:
+            self._token = _current.set(self._trace_id)
+
+    def __exit__(self, *exc):
+        if self._token is not None:
+            _current.reset(self._token)
+
+
+def _events(pid):
+    ''' the spans of this process as Chrome trace events '''
+    return [{'name': name, 'cat': 'message', 'ph': 'X', 'pid': pid, 'tid': tid,
+             'ts': start * 1e6, 'dur': max(0.0, end - start) * 1e6,
+             'args': dict(args, trace_id=trace_id)}
+            for (trace_id, name, start, end, tid, args) in _ring.spans()]
+
+
+# Dumps: the main process asks the others with a signal, they write their spans
+# in _DUMP_DIR, the main process merges them. All inherited by the forked processes
+_DUMP_SIGNAL = signal.SIGUSR1
+_DUMP_DIR = None
+_DUMP_PATH = None
+_MAIN_PID = None
+
+# Set by the signal handler, the dump itself is done by the dumper thread of the
+# process: a handler interrupts whatever the main thread (or its event loop) was doing
+_dump_requested = None
+
+
+def install(sample_rate, dump_path=None):
+    '''
+        To be called in the main process (main thread) before starting the other processes
+        sample_rate -> fraction of the inbound messages to trace
+        dump_path   -> if set, SIGUSR1 to the main process dumps the traces there
+    '''
+    global _DUMP_DIR, _DUMP_PATH, _MAIN_PID
+    set_sample_rate(sample_rate)
+    _MAIN_PID = os.getpid()
+    _DUMP_PATH = dump_path
+    _DUMP_DIR = tempfile.mkdtemp(prefix='traces-')
+    atexit.register(_remove_dump_dir)
+
+    _start_dumper()
+    signal.signal(_DUMP_SIGNAL, lambda signum, frame: _dump_requested.set())
+
+
+def _start_dumper():
+    global _dump_requested
+    _dump_requested = threading.Event()
+    dumper = threading.Thread(target=_dumper, args=(_dump_requested,), name='trace_dumper')
+    dumper.daemon = True
+    dumper.start()
+
+
+def _dumper(requested):
+    while True:
+        requested.wait()
+        requested.clear()
+        try:
+            if os.getpid() != _MAIN_PID:
+                _write_part()
+            elif _DUMP_PATH:
+                dump(_DUMP_PATH)
+        except Exception as ex:
+            logger.error('Could not dump the traces: {}'.format(ex))
+
+
+def _remove_dump_dir():
+    # Forked processes don't run the atexit handlers, still only the main process owns it
+    if os.getpid() == _MAIN_PID:
+        shutil.rmtree(_DUMP_DIR, ignore_errors=True)
+
+
+def _write_part():
+    pid = os.getpid()
+    part = os.path.join(_DUMP_DIR, '{}.json'.format(pid))
+    with open(part + '.tmp', 'w') as out:
+        json.dump(_events(pid), out)
+    # Complete or absent for the reader
+    os.replace(part + '.tmp', part)
+
+
+def dump(path, timeout=2):
+    '''
+        Write the spans of every process to path as Chrome trace JSON
+        (chrome://tracing, ui.perfetto.dev), the spans of a trace are linked by flow arrows
+        Processes which don't answer within timeout seconds are left out.
+        Returns the number of spans written.
+    '''
+    events = _events(os.getpid())
+
+    children = mp.active_children() if _DUMP_DIR is not None else []
+    for child in children:
+        try:
+            os.remove(os.path.join(_DUMP_DIR, '{}.json'.format(child.pid)))
+        except FileNotFoundError:
+            pass
+        os.kill(child.pid, _DUMP_SIGNAL)
+
+    waiting = {child.pid for child in children}
+    deadline = time.monotonic() + timeout
+    while waiting and time.monotonic() < deadline:
+        for pid in list(waiting):
+            part = os.path.join(_DUMP_DIR, '{}.json'.format(pid))
+            if os.path.exists(part):
+                with open(part) as part_file:
+                    events.extend(json.load(part_file))
+                os.remove(part)
+                waiting.discard(pid)
+        if waiting:
+            time.sleep(0.01)
+    if waiting:
+        logger.error('Processes {} did not dump their traces in time'.format(sorted(waiting)))
+
+    spans = len(events)
+    events.extend(_flows(events))
+    with open(path, 'w') as out:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, out)
+    logger.info('Dumped {} spans in {}'.format(spans, path))
+    return spans
+
+
+def _flows(events):
+    ''' flow events linking the consecutive spans of each trace '''
+    by_trace = {}
+    for event in events:
+        by_trace.setdefault(event['args']['trace_id'], []).append(event)
+
+    flows = []
+    for (flow_id, trace_events) in enumerate(by_trace.values()):
+        trace_events.sort(key=lambda e: e['ts'])
+        for (src, dst) in zip(trace_events, trace_events[1:]):
+            flows.append({'name': 'message', 'cat': 'message', 'ph': 's', 'id': flow_id,
+                          'pid': src['pid'], 'tid': src['tid'], 'ts': src['ts']})
+            flows.append({'name': 'message', 'cat': 'message', 'ph': 'f', 'bp': 'e', 'id': flow_id,
+                          'pid': dst['pid'], 'tid': dst['tid'], 'ts': dst['ts']})
+    return flows
@@ -0,0 +1,167 @@
+''' record the inbound updates to a file and play them back with their original timing '''
+import gzip
+import json
+import logging
+import time
+
+from collections import deque
+from threading import Event, Thread
+
+import tracing
+from queues import RxQItem, RxUpdate
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+def _open(path, mode):
+    # Appending to a .gz adds a member, readers see one stream
+    if path.endswith('.gz'):
+        return gzip.open(path, mode + 't', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class UpdateRecorder():
+    '''
+        Appends the RxQItems received from telegram to a file, one compact
+        json array per line:
+            [time, kind, route_by, chat_id, user_id, game_code, [RxUpdate fields] or null]
+        record() only appends to a deque, a writer thread encodes and writes
+        every flush_interval, the receiving threads never wait for the disk.
+        A path ending in .gz is gzipped.
+    '''
+
+    def __init__(self, path, flush_interval=1.0, max_pending=100000):
+        '''
+            max_pending -> updates waiting for the writer, beyond it the oldest are
+                            dropped (counted in dropped) rather than filling the memory
+        '''
+        self.path = path
+        self._flush_interval = flush_interval
+        self._pending = deque(maxlen=max_pending)
+        self._stop = Event()
+        self._writer = None
+        self.recorded = 0
+        self.dropped = 0
+        self._reported_drops = 0
+
+    def start(self):
+        logger.info('Recording the inbound updates in {}'.format(self.path))
+        self._stop.clear()
+        self._writer = Thread(target=self._run, name='{}:writer'.format(type(self).__name__))
+        self._writer.daemon = True
+        self._writer.start()
+
+    def record(self, item):
+        ''' an RxQItem just received, can be called from any thread '''
+        if len(self._pending) == self._pending.maxlen:
+            # The writer is behind or failing, the oldest update is pushed out
+            self.dropped += 1
+        self._pending.append((time.time(), item))
+
+    def _run(self):
+        try:
+            out = _open(self.path, 'a')
+        except OSError as ex:
+            logger.error('Could not open {}, the updates are not recorded: {}'.format(self.path, ex))
+            return
+
+        with out:
+            while True:
+                stopping = self._stop.wait(self._flush_interval)
+                try:
+                    self._write(out)
+                except Exception as ex:
+                    logger.error('Failed to record updates in {}: {}'.format(self.path, ex))
+                if self.dropped != self._reported_drops:
+                    logger.warning('{} updates were not recorded, the writer fell behind'.format(
+                        self.dropped - self._reported_drops))
+                    self._reported_drops = self.dropped
+                if stopping:
+                    break
+
+    def _write(self, out):
+        lines = []
+        while self._pending:
+            stamp, item = self._pending.popleft()
+            try:
+                lines.append(json.dumps(_encode(stamp, item), separators=(',', ':')))
+            except (TypeError, ValueError, AttributeError) as ex:
+                logger.error('Not recording update {}: {}'.format(item, ex))
+        if lines:
+            out.write('\n'.join(lines) + '\n')
+            out.flush()
+            self.recorded += len(lines)
+
+    def stop(self):
+        ''' write what is left and close the file '''
+        if self._writer is None:
+            return
+        self._stop.set()
+        self._writer.join()
+        self._writer = None
+
+
+def _encode(stamp, item):
+    update = item.kwargs.get('update')
+    return [round(stamp, 6), item.kind, item.route_by, item.chat_id, item.user_id, item.game_code,
+            [update.update_id, update.chat_id, update.user_id, update.message_id, update.text,
+             update.callback_query_id, update.callback_data] if update is not None else None]
+
+
+def read_recording(path):
+    ''' yields (time, RxQItem) for every update of a recording, in order '''
+    with _open(path, 'r') as recording:
+        for (line_no, line) in enumerate(recording, 1):
+            if not line.strip():
+                continue
+            try:
+                stamp, kind, route_by, chat_id, user_id, game_code, update = json.loads(line)
+            except ValueError as ex:
+                # The last line of a recording cut short by a crash
+                logger.error('Skipping line {} of {}: {}'.format(line_no, path, ex))
+                continue
+            yield stamp, RxQItem(kind, route_by=route_by, chat_id=chat_id, user_id=user_id,
+                                 game_code=game_code,
+                                 kwargs={'update': RxUpdate(*update)} if update is not None else None)
+
+
+def replay(records, put, speed=1.0, max_gap=None, stop=None):
+    '''
+        put() the RxQItems of records (from read_recording) with their original timing
+        speed   -> 1 for real time, 10 for ten times faster, None for as fast as possible
+        max_gap -> longest wait (recording time) between two updates, idle periods
+                    of the recording are shortened to it. None to keep them
+        stop    -> Event to end the replay early
+        Returns the number of items put.
+    '''
+    count = 0
+    previous = None
+    # Where the replay is, in recording time, and when it got there
+    elapsed = 0
+    start = time.monotonic()
+
+    for (stamp, item) in records:
+        if stop is not None and stop.is_set():
+            break
+
+        if previous is not None and speed is not None:
+            gap = max(0, stamp - previous)
+            if max_gap is not None:
+                gap = min(gap, max_gap)
+            elapsed += gap
+            wait = start + elapsed / speed - time.monotonic()
+            if wait > 0:
+                if stop is not None:
+                    stop.wait(wait)
+                else:
+                    time.sleep(wait)
+        previous = stamp
+
+        # Received now, as far as the pipeline is concerned
+        item.rx_at = time.monotonic()
+        tracing.sample(item)
+        put(item)
+        count += 1
+    return count
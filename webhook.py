@@ -0,0 +1,172 @@
+''' receive the telegram updates through a webhook instead of polling '''
+import json
+import logging
+
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+
+import tracing
+from queues import INBOUND_MSG_QUEUE, RxBatcher, RxQItem, RxUpdate
+
+from pb_cfg import LOGGER_NAME
+
+logger = logging.getLogger(LOGGER_NAME)
+
+
+def rx_item_from_json(data):
+    '''
+        RxQItem for the json of an update (dict)
+        None for the updates the polling handlers ignore too (edited messages, no text, ...)
+    '''
+    query = data.get('callback_query')
+    if query is not None:
+        if not query.get('message'):
+            return None
+        kind = RxQItem.CALLBACK_QUERY_MSG
+    else:
+        message = data.get('message')
+        if message is None or message.get('text') is None:
+            return None
+        # Same as the polling handlers, Filters.regex(r'^/')
+        kind = RxQItem.COMMAND_MSG if message['text'].startswith('/') else RxQItem.TEXT_MSG
+
+    update = RxUpdate.from_dict(data)
+    return RxQItem(
+        kind,
+        route_by=RxQItem.ROUTE_BY_CHAT_ID | RxQItem.ROUTE_BY_USER_ID,
+        chat_id=update.chat_id,
+        user_id=update.user_id,
+        kwargs={'update': update})
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+    ''' one instance per request, the receiver is reachable through the server '''
+
+    # Keep alive, telegram (and the fake clients) reuse their connections
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        receiver = self.server.receiver
+
+        if self.path != receiver.path:
+            self._reply(404)
+            return
+        if receiver.secret_token is not None \
+                and self.headers.get('X-Telegram-Bot-Api-Secret-Token') != receiver.secret_token:
+            self._reply(403)
+            return
+
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        receiver.submit(body)
+        self._reply(200)
+
+    def _reply(self, code):
+        self.send_response(code)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, format, *args):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug('Webhook %s: %s', self.address_string(), format % args)
+
+
+class WebhookReceiver():
+    '''
+        Embedded HTTP server for the telegram webhook.
+        Every POST carries one update (what telegram sends) or a json list of
+        updates. The request is answered as soon as the body is read, the body
+        is parsed by a pool of workers which put the RxQItems in INBOUND_MSG_QUEUE,
+        micro batched across requests by an RxBatcher.
+        Each connection is served by its own thread, so telegram can push
+        on several connections at once (set_webhook max_connections).
+        Plain HTTP unless an ssl_context is given, telegram itself only talks
+        HTTPS (either use ssl_context or a TLS terminating proxy in front).
+    '''
+
+    def __init__(self, host='0.0.0.0', port=8443, path='/', secret_token=None,
+                 parse_workers=4, ssl_context=None, inbound_q=INBOUND_MSG_QUEUE):
+        '''
+            host, port      -> where to listen, port 0 picks a free one (see address)
+            path            -> url path telegram posts to, other paths get a 404
+            secret_token    -> if set, required in the X-Telegram-Bot-Api-Secret-Token header
+            parse_workers   -> number of threads parsing the posted updates
+            ssl_context     -> ssl.SSLContext to serve HTTPS
+            inbound_q       -> where the RxQItems go
+        '''
+        self.host = host
+        self.port = port
+        self.path = path
+        self.secret_token = secret_token
+        self._parse_workers = max(1, parse_workers)
+        self._ssl_context = ssl_context
+        self._inbound = RxBatcher(inbound_q)
+        # UpdateRecorder keeping a copy of the updates, set by the TelegramAbstractionLayer
+        self.recorder = None
+
+        self._server = None
+        self._server_thread = None
+        self._pool = None
+
+    @property
+    def address(self):
+        ''' (host, port) the server is bound to '''
+        return self._server.server_address if self._server else (self.host, self.port)
+
+    def start(self):
+        logger.info('Staring {}'.format(type(self).__name__))
+
+        self._pool = ThreadPoolExecutor(max_workers=self._parse_workers,
+                                        thread_name_prefix='webhook_parser')
+
+        self._server = ThreadingHTTPServer((self.host, self.port), _WebhookHandler)
+        self._server.daemon_threads = True
+        self._server.receiver = self
+        if self._ssl_context is not None:
+            self._server.socket = self._ssl_context.wrap_socket(self._server.socket, server_side=True)
+
+        self._server_thread = Thread(target=self._server.serve_forever,
+                                     name='{}:server'.format(type(self).__name__))
+        self._server_thread.daemon = True
+        self._server_thread.start()
+        logger.info('Webhook listening on {}:{}{}'.format(*self.address, self.path))
+
+    def stop(self):
+        if self._server is None:
+            logger.error('{} is not currently running !'.format(type(self).__name__))
+            return
+
+        logger.info('Stopping {}'.format(type(self).__name__))
+        self._server.shutdown()
+        self._server.server_close()
+        self._server_thread.join(2)
+        # Whatever was already accepted still reaches the queue
+        self._pool.shutdown(wait=True)
+        self._inbound.close()
+        self._server = None
+
+    def submit(self, body):
+        ''' parse a posted body in the worker pool '''
+        self._pool.submit(self._ingest, body)
+
+    def _ingest(self, body):
+        try:
+            data = json.loads(body)
+        except ValueError as ex:
+            logger.error('Dropping webhook post which is not json: {}'.format(ex))
+            return
+
+        items = []
+        for update in data if isinstance(data, list) else (data,):
+            try:
+                item = rx_item_from_json(update)
+            except (KeyError, TypeError, AttributeError) as ex:
+                logger.error('Dropping malformed update {}: {}'.format(update, ex))
+                continue
+            if item is not None:
+                tracing.sample(item)
+                items.append(item)
+        if self.recorder is not None:
+            for item in items:
+                self.recorder.record(item)
+        self._inbound.put_many(items)